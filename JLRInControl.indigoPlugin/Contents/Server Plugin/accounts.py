@@ -0,0 +1,210 @@
+""" Shared, long-lived jlrpy connections for the JLR InControl plugin
+
+One authenticated jlrpy.Connection is kept per InControl account and handed out to the poll thread and
+to the action callbacks, so the four call login only happens when the account is first used or when the
+JLR servers reject the tokens we hold. The refresh token, device id and user id are kept on disk so a
+plugin restart only costs a token refresh.
+"""
+
+from urllib.error import HTTPError
+
+import calendar
+import datetime
+import json
+import logging
+import os
+import threading
+
+import jlrpy
+
+logger = logging.getLogger('Plugin.accounts')
+
+# Refresh the access token this many seconds before JLR says it expires
+TOKEN_REFRESH_MARGIN = 300
+
+
+class TokenStore:
+    """Refresh token, device id, user id and expiry per account, in a JSON file only the owner can read"""
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+
+    def load(self, email):
+        with self._lock:
+            return self._read().get(email)
+
+    def save(self, email, session):
+        with self._lock:
+            sessions = self._read()
+            sessions[email] = session
+            self._write(sessions)
+
+    def forget(self, email):
+        with self._lock:
+            sessions = self._read()
+            if sessions.pop(email, None) is not None:
+                self._write(sessions)
+
+    def _read(self):
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except (IOError, OSError, ValueError):
+            return {}
+
+    def _write(self, sessions):
+        folder = os.path.dirname(self.path)
+        if folder and not os.path.isdir(folder):
+            os.makedirs(folder)
+        temp_path = self.path + ".tmp"
+        # Create the file with owner only permissions before any token is written to it
+        fd = os.open(temp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, 'w') as f:
+            json.dump(sessions, f)
+        os.chmod(temp_path, 0o600)
+        os.replace(temp_path, self.path)
+
+
+class Account:
+    """A single InControl account and its (lazily created) connection"""
+
+    def __init__(self, email, password):
+        self.email = email
+        self.password = password
+        self.connection = None
+        self.lock = threading.RLock()
+        # Cleared once a stored session has been rejected, the next login then uses the password
+        self.use_stored_session = True
+        self.saved_refresh_token = None
+
+
+class ConnectionManager:
+    """Keeps one authenticated jlrpy.Connection per InControl account
+
+    Safe to use from the poll thread and from Indigo's action callbacks at the same time. Creating,
+    refreshing and dropping a connection is serialised per account; requests on an established
+    connection run concurrently.
+    """
+
+    def __init__(self, token_store=None, timeout=jlrpy.DEFAULT_TIMEOUT, status_max_age=jlrpy.STATUS_MAX_AGE):
+        self._lock = threading.Lock()
+        self._accounts = {}
+        self.token_store = token_store
+        # Socket timeout (seconds) for the requests of connections made from now on
+        self.timeout = timeout
+        # Seconds a vehicle status is reused by the polls and commands of connections made from now on
+        self.status_max_age = status_max_age
+
+    def _account(self, email, password):
+        with self._lock:
+            account = self._accounts.get(email)
+            if account is None:
+                account = Account(email, password)
+                self._accounts[email] = account
+            elif account.password != password:
+                # Password changed in the plugin config, the next login should use the new one
+                account.password = password
+            return account
+
+    def get(self, email, password):
+        """Return the shared connection for an account, logging in or refreshing tokens if needed"""
+        account = self._account(email, password)
+        with account.lock:
+            if account.connection is None:
+                account.connection = self._login(account)
+            elif self._near_expiry(account.connection):
+                logger.debug("Refreshing InControl tokens for %s" % email)
+                try:
+                    account.connection.refresh_tokens()
+                except HTTPError as e:
+                    if not jlrpy.is_auth_error(e):
+                        raise
+                    account.use_stored_session = False
+                    account.connection = self._login(account)
+            self._save_session(account)
+            return account.connection
+
+    def _login(self, account):
+        """Start from the stored session if there is one, falling back to a password login"""
+        session = None
+        if self.token_store is not None and account.use_stored_session:
+            session = self.token_store.load(account.email)
+        if session:
+            logger.debug("Resuming stored InControl session for %s" % account.email)
+            try:
+                return jlrpy.Connection(account.email, account.password,
+                                        device_id=session['device_id'],
+                                        refresh_token=session['refresh_token'],
+                                        user_id=session['user_id'],
+                                        timeout=self.timeout,
+                                        status_max_age=self.status_max_age)
+            except HTTPError as e:
+                if e.code != 400 and not jlrpy.is_auth_error(e):
+                    raise
+                logger.debug("Stored InControl session for %s rejected (HTTP %d)" % (account.email, e.code))
+                self.token_store.forget(account.email)
+        logger.debug("Logging in to InControl for %s" % account.email)
+        account.use_stored_session = True
+        return jlrpy.Connection(account.email, account.password, timeout=self.timeout,
+                                status_max_age=self.status_max_age)
+
+    def _save_session(self, account):
+        connection = account.connection
+        if self.token_store is None or connection.refresh_token == account.saved_refresh_token:
+            return
+        try:
+            self.token_store.save(account.email, {
+                'device_id': connection.device_id,
+                'refresh_token': connection.refresh_token,
+                'user_id': connection.user_id,
+                'expiration': connection.expiration})
+            account.saved_refresh_token = connection.refresh_token
+        except (IOError, OSError) as e:
+            logger.warning("Unable to store InControl session for %s: %s" % (account.email, e))
+
+    def run(self, email, password, func, resend=True):
+        """Call func(connection), logging in again once if JLR rejects the tokens
+
+        Only a 401, or a 403 about the tokens, leads to a new login. A 403 from throttling is raised as it
+        is, a password login would cost three more requests against an account that is already throttled.
+        With resend False the connection is dropped so the next use logs in, but func is not called again,
+        for requests such as vehicle commands that must not be sent twice.
+        """
+        connection = self.get(email, password)
+        try:
+            return func(connection)
+        except HTTPError as e:
+            if not jlrpy.is_auth_error(e):
+                raise
+            logger.debug("InControl returned HTTP %d for %s, logging in again" % (e.code, email))
+            self.invalidate(email, connection)
+            if not resend:
+                raise
+            return func(self.get(email, password))
+
+    def invalidate(self, email, connection=None):
+        """Drop the connection for an account so the next use logs in again
+
+        If a connection is given it is only dropped if it is still the current one, so two threads that
+        both saw a 401 on the same connection only cause a single new login.
+        """
+        with self._lock:
+            account = self._accounts.get(email)
+        if account is None:
+            return
+        with account.lock:
+            if connection is None or account.connection is connection:
+                account.connection = None
+                # The stored session belongs to the rejected connection, log in with the password next time
+                account.use_stored_session = False
+
+    def reset(self):
+        """Forget every account, e.g. after the plugin preferences change"""
+        with self._lock:
+            self._accounts = {}
+
+    @staticmethod
+    def _near_expiry(connection):
+        now = calendar.timegm(datetime.datetime.now().timetuple())
+        return now > connection.expiration - TOKEN_REFRESH_MARGIN
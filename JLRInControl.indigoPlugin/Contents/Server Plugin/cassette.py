@@ -0,0 +1,246 @@
+""" Record and replay of JLR API traffic for the JLR InControl plugin
+
+A Recorder writes every request jlrpy makes and the response (or network error) it got to a cassette: a
+gzipped file of JSON lines. Tokens, passwords, PINs and other secrets are replaced, and VINs, user ids
+and email addresses are swapped for stable aliases, so a cassette can be shared to reproduce an issue.
+Request bodies are never stored.
+
+A Player serves a cassette back without any network. Responses for the same request are given in the
+order they were recorded and, when looping, start again from the first once used up. The recorded
+response times can be kept, sped up or skipped. Install either with jlrpy.set_cassette().
+"""
+
+from http.client import HTTPMessage
+from urllib.parse import urlsplit
+
+import datetime
+import gzip
+import json
+import logging
+import re
+import threading
+import time
+
+logger = logging.getLogger('Plugin.cassette')
+
+FORMAT_VERSION = 1
+REDACTED = "REDACTED"
+# Keys whose values are secrets or identify the owner or car, replaced wherever they appear
+SECRET_KEYS = frozenset(('access_token', 'authorization_token', 'refresh_token', 'token', 'pin', 'password',
+                         'Authorization', 'imei', 'serialNumber', 'registrationNumber', 'loginName', 'email'))
+# Vehicle status entries ({'key': ..., 'value': ...}) whose values identify the car
+SECRET_STATUS_KEYS = frozenset(('TU_STATUS_IMEI', 'TU_STATUS_SERIAL_NUMBER'))
+VIN_PATTERN = re.compile(r'\b[A-HJ-NPR-Z0-9]{17}\b')
+EMAIL_PATTERN = re.compile(r'[\w.+-]+(@|%40)[\w-]+(\.[\w-]+)+')
+EMAIL_ALIAS = "owner@example.com"
+# Network errors are replayed as these exception types
+ERRORS = {'TimeoutError': TimeoutError, 'ConnectionResetError': ConnectionResetError,
+          'ConnectionRefusedError': ConnectionRefusedError, 'ConnectionError': ConnectionError}
+
+
+class CassetteError(Exception):
+    """Raised by a Player asked for a request the cassette has no response for"""
+
+
+class Redactor:
+    """Replaces secrets and swaps identifiers for aliases, the same identifier always gets the same alias"""
+
+    def __init__(self):
+        self._aliases = {}
+
+    def alias(self, value, kind):
+        if value not in self._aliases:
+            count = sum(1 for a in self._aliases.values() if a.startswith(kind)) + 1
+            if kind == "VIN":
+                # 17 characters like a VIN, but with an I so it can never be taken for a real one
+                self._aliases[value] = "VIN%014d" % count
+            else:
+                self._aliases[value] = "%s%d" % (kind, count)
+        return self._aliases[value]
+
+    def learn(self, data):
+        """Pick up the VINs and user ids in a response so they are replaced wherever they appear"""
+        if isinstance(data, dict):
+            for key, value in data.items():
+                if key == 'vin' and isinstance(value, str):
+                    self.alias(value, "VIN")
+                elif key == 'userId' and isinstance(value, str) and value:
+                    self.alias(value, "user")
+                else:
+                    self.learn(value)
+        elif isinstance(data, list):
+            for item in data:
+                self.learn(item)
+
+    def text(self, value):
+        for real, alias in self._aliases.items():
+            value = value.replace(real, alias)
+        value = VIN_PATTERN.sub(lambda m: self.alias(m.group(0), "VIN"), value)
+        return EMAIL_PATTERN.sub(EMAIL_ALIAS, value)
+
+    def data(self, data):
+        if isinstance(data, dict):
+            if data.get('key') in SECRET_STATUS_KEYS and 'value' in data:
+                return dict(data, value=REDACTED)
+            return {key: (REDACTED if key in SECRET_KEYS and value is not None else self.data(value))
+                    for key, value in data.items()}
+        if isinstance(data, list):
+            return [self.data(item) for item in data]
+        if isinstance(data, str):
+            return self.text(data)
+        return data
+
+
+def request_key(method, url):
+    """What a request is matched on, the method and path with query but not the host"""
+    parts = urlsplit(url)
+    return "%s %s" % (method, parts.path + ("?%s" % parts.query if parts.query else ""))
+
+
+class Recorder:
+    """Appends the traffic of every jlrpy Connection to a cassette file"""
+
+    replaying = False
+
+    def __init__(self, path):
+        self.path = path
+        self.redactor = Redactor()
+        self.recorded = 0
+        self._lock = threading.Lock()
+        self._started = time.monotonic()
+        self._file = gzip.open(path, 'wt', encoding='utf8')
+        self._write({'cassette': FORMAT_VERSION, 'created': datetime.datetime.now().isoformat()})
+
+    def record(self, method, url, status, headers, raw, elapsed):
+        """Store a response, the body is kept as JSON where it parses so it can be redacted"""
+        entry = {'s': status, 'c': headers.get('Content-Type')}
+        text = raw.decode(headers.get_content_charset('utf-8'), 'replace')
+        try:
+            body = json.loads(text) if text else None
+        except ValueError:
+            entry['x'] = text
+        else:
+            if body is not None:
+                entry['j'] = body
+        self._add(method, url, entry, elapsed)
+
+    def record_error(self, method, url, error, elapsed):
+        """Store a request that failed without a response, such as a timeout"""
+        self._add(method, url, {'e': type(error).__name__, 'm': str(error)}, elapsed)
+
+    def _add(self, method, url, entry, elapsed):
+        with self._lock:
+            if self._file is None:
+                return
+            if 'j' in entry:
+                self.redactor.learn(entry['j'])
+                entry['j'] = self.redactor.data(entry['j'])
+            if 'x' in entry:
+                entry['x'] = self.redactor.text(entry['x'])
+            if 'm' in entry:
+                entry['m'] = self.redactor.text(entry['m'])
+            entry['r'] = self.redactor.text(request_key(method, url))
+            entry['t'] = round(time.monotonic() - self._started, 3)
+            entry['d'] = round(elapsed, 3)
+            try:
+                self._write(entry)
+            except (IOError, OSError) as e:
+                # Never let the recording get in the way of the request itself
+                logger.error("Stopped recording to %s: %s" % (self.path, e))
+                self._file = None
+                return
+            self.recorded += 1
+
+    def _write(self, entry):
+        self._file.write(json.dumps(entry, separators=(',', ':')) + "\n")
+        # Flushed per entry so the cassette is readable up to the last request even if never closed
+        self._file.flush()
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+
+class ReplayResponse:
+    """The parts of an http.client response jlrpy uses"""
+
+    def __init__(self, status, content_type):
+        self.status = status
+        self.reason = ""
+        self.headers = HTTPMessage()
+        if content_type:
+            self.headers['Content-Type'] = content_type
+
+
+class Player:
+    """Serves the responses of a cassette in place of the JLR servers
+
+    speed scales the recorded response times, 2 plays twice as fast and 0 does not wait at all. With
+    loop the responses for a request start again from the first once they are used up, otherwise
+    CassetteError is raised.
+    """
+
+    replaying = True
+
+    def __init__(self, path, speed=0, loop=True):
+        self.path = path
+        self.speed = speed
+        self.loop = loop
+        self.redactor = Redactor()
+        self.played = 0
+        self.missed = 0
+        self._lock = threading.Lock()
+        self._entries = {}
+        self._next = {}
+        for entry in self.read(path):
+            self._entries.setdefault(entry['r'], []).append(entry)
+
+    @staticmethod
+    def read(path):
+        """The recorded entries of a cassette, a file cut short by a crash is read up to the break"""
+        entries = []
+        try:
+            with gzip.open(path, 'rt', encoding='utf8') as f:
+                for line in f:
+                    entry = json.loads(line)
+                    if 'r' in entry:
+                        entries.append(entry)
+        except (EOFError, ValueError) as e:
+            logger.warning("Cassette %s is incomplete, replaying the %d requests read: %s" % (path, len(entries), e))
+        return entries
+
+    def vehicles(self):
+        """Number of vehicles on the recorded account"""
+        for key, entries in self._entries.items():
+            if key.startswith("GET ") and "/vehicles?" in key:
+                return len((entries[0].get('j') or {}).get('vehicles') or [])
+        return 0
+
+    def play(self, method, url):
+        """Return (response, body bytes) for a request, or raise the network error that was recorded"""
+        key = self.redactor.text(request_key(method, url))
+        with self._lock:
+            entries = self._entries.get(key)
+            index = self._next.get(key, 0)
+            if entries and index >= len(entries) and self.loop:
+                index = 0
+            if not entries or index >= len(entries):
+                self.missed += 1
+                raise CassetteError("No recorded response for %s" % key)
+            self._next[key] = index + 1
+            self.played += 1
+        entry = entries[index]
+        if self.speed > 0 and entry.get('d'):
+            time.sleep(entry['d'] / self.speed)
+        if 'e' in entry:
+            raise ERRORS.get(entry['e'], OSError)(entry.get('m', entry['e']))
+        if 'j' in entry:
+            raw = json.dumps(entry['j']).encode('utf8')
+        else:
+            raw = entry.get('x', '').encode('utf8')
+        return ReplayResponse(entry['s'], entry.get('c')), raw
+
+    def close(self):
+        pass
@@ -0,0 +1,195 @@
+""" Charging session analytics for the JLR InControl plugin
+
+Works out the charge rate, power, energy added and time to a target state of charge from the plugin's
+own successive polls, rather than trusting EV_CHARGING_RATE_SOC_PER_HOUR and EV_MINUTES_TO_FULLY_CHARGED,
+which JLR often leaves stale or at zero. A session starts when EV_CHARGING_STATUS turns to charging and
+ends when it stops. While it runs each poll's state of charge is added to a least squares fit of SoC
+against time, weighted so older samples fade with a half life of FIT_HALF_LIFE, which lets the rate
+follow the taper towards full. The fit is kept as running sums, so a poll costs the same however long
+the session. No extra requests are made.
+"""
+
+import threading
+import time
+
+import scheduler
+
+# Seconds for a sample's weight in the rate fit to halve
+FIT_HALF_LIFE = 1800
+# Shortest span of samples (seconds) before the fitted rate is trusted over JLR's own figure
+MIN_FIT_SPAN = 300
+FULL_SOC = 100.0
+# JLR reports whole percents, while charging the true SoC is on average this much above the reported one
+SOC_ROUNDING = 0.5
+# Battery energy in kWh x 100
+ENERGY_STATE = 'EV_RANGE_VSC_REVISED_HV_BATT_ENERGYx100'
+# The car's one-off charge limit in percent SoC, used as the target when the device does not set one and
+# the car reports the limit as set
+LIMIT_STATE = 'EV_ONE_OFF_MAX_VALUE'
+LIMIT_CHOICE_STATE = 'EV_ONE_OFF_MAX_SOC_CHARGE_SETTING_CHOICE'
+
+
+def number(value):
+    """A status value as a float, None if it is missing or not a number"""
+    if value is None or isinstance(value, bool):
+        return None
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+class RateFit:
+    """Exponentially weighted least squares line through (time, SoC), from running sums"""
+
+    def __init__(self, origin, half_life=FIT_HALF_LIFE):
+        # Times are hours since origin, which keeps the sums well conditioned
+        self.origin = origin
+        self.half_life = half_life
+        self.last = None
+        self.first = None
+        self.w = self.wt = self.ws = self.wtt = self.wts = 0.0
+
+    def add(self, when, soc):
+        t = (when - self.origin) / 3600.0
+        if self.last is not None:
+            decay = 0.5 ** ((when - self.last) / self.half_life)
+            self.w *= decay
+            self.wt *= decay
+            self.ws *= decay
+            self.wtt *= decay
+            self.wts *= decay
+        else:
+            self.first = when
+        self.last = when
+        self.w += 1.0
+        self.wt += t
+        self.ws += soc
+        self.wtt += t * t
+        self.wts += t * soc
+
+    @property
+    def span(self):
+        return self.last - self.first if self.last is not None else 0
+
+    def rate(self):
+        """SoC percent per hour, None until there are samples at two different times"""
+        denominator = self.w * self.wtt - self.wt * self.wt
+        if self.w < 1.5 or denominator <= 1e-12:
+            return None
+        return (self.w * self.wts - self.wt * self.ws) / denominator
+
+
+class ChargeSession:
+    def __init__(self, now, soc, energy):
+        self.started = now
+        self.start_soc = soc
+        self.start_energy = energy
+        self.fit = RateFit(now)
+        self.soc = soc
+        self.energy = energy
+        self.active = True
+
+    def add(self, now, soc, energy):
+        if soc is not None:
+            self.fit.add(now, soc)
+            self.soc = soc
+        if energy is not None:
+            self.energy = energy
+
+
+class ChargeTracker:
+    """Charge session of each vehicle, turning each poll's states into the charging analytics states"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._sessions = {}
+        # Battery capacity in kWh learned from the energy and SoC states, for cars that stop sending energy
+        self._capacity = {}
+
+    def update(self, device_id, device_states, target=None, now=None):
+        """Feed the states of a poll, returns the charging states to add to it
+
+        target is the SoC to work out the time to, by default the car's own charge limit or full.
+        Vehicles without a state of charge get no charging states.
+        """
+        states = dict((state['key'], state['value']) for state in device_states)
+        soc = number(states.get('EV_STATE_OF_CHARGE'))
+        if soc is None:
+            return []
+        if now is None:
+            now = time.time()
+        energy = number(states.get(ENERGY_STATE))
+        if energy is not None:
+            energy /= 100.0
+        charging = str(states.get('EV_CHARGING_STATUS', '')).upper() in scheduler.CHARGING_VALUES
+        target = self.target(states, target)
+        with self._lock:
+            if energy and soc > 0:
+                self._capacity[device_id] = energy / soc * FULL_SOC
+            capacity = self._capacity.get(device_id)
+            session = self._sessions.get(device_id)
+            if charging:
+                if session is None or not session.active:
+                    session = self._sessions[device_id] = ChargeSession(now, soc, energy)
+                session.add(now, soc, energy)
+            elif session is not None and session.active:
+                session.add(now, soc, energy)
+                session.active = False
+            return self._states(session, states, soc, target, capacity, now)
+
+    @staticmethod
+    def target(states, target=None):
+        """The SoC to charge to, the given target or the car's one-off limit if it is set, or full"""
+        values = [target]
+        if str(states.get(LIMIT_CHOICE_STATE, '')).upper() == 'SET':
+            values.append(states.get(LIMIT_STATE))
+        for value in values:
+            value = number(value)
+            if value is not None and 0 < value <= FULL_SOC:
+                return value
+        return FULL_SOC
+
+    @staticmethod
+    def _states(session, states, soc, target, capacity, now):
+        active = session is not None and session.active
+        rate = None
+        if active:
+            fitted = session.fit.rate()
+            if fitted is not None and fitted > 0 and session.fit.span >= MIN_FIT_SPAN:
+                rate = fitted
+            else:
+                rate = number(states.get('EV_CHARGING_RATE_SOC_PER_HOUR'))
+        if not rate or rate <= 0:
+            rate = None
+        to_target = to_full = 0
+        target_time = ""
+        if rate:
+            charged = soc + SOC_ROUNDING
+            to_target = int(round(max(0.0, target - charged) / rate * 60)) if soc < target else 0
+            to_full = int(round(max(0.0, FULL_SOC - charged) / rate * 60)) if soc < FULL_SOC else 0
+            if to_target:
+                target_time = time.strftime("%H:%M", time.localtime(now + to_target * 60))
+        added = 0.0
+        if session is not None:
+            if session.energy is not None and session.start_energy is not None:
+                added = max(0.0, session.energy - session.start_energy)
+            elif capacity:
+                added = max(0.0, session.soc - session.start_soc) * capacity / FULL_SOC
+        power = rate * capacity / FULL_SOC if rate and capacity else 0.0
+        started = time.strftime("%Y-%m-%d %H:%M", time.localtime(session.started)) if session is not None else ""
+        return [
+            {'key': 'chargeSessionActive', 'value': active},
+            {'key': 'chargeSessionStart', 'value': started},
+            {'key': 'chargeRate', 'value': round(rate or 0, 1), 'uiValue': "%.1f %%/h" % (rate or 0)},
+            {'key': 'chargePower', 'value': round(power, 2), 'uiValue': "%.1f kW" % power},
+            {'key': 'chargeEnergyAdded', 'value': round(added, 2), 'uiValue': "%.1f kWh" % added},
+            {'key': 'chargeTargetSoc', 'value': int(target)},
+            {'key': 'chargeMinutesToTarget', 'value': to_target},
+            {'key': 'chargeTargetTime', 'value': target_time},
+            {'key': 'chargeMinutesToFull', 'value': to_full},
+        ]
+
+    def forget(self, device_id):
+        with self._lock:
+            self._sessions.pop(device_id, None)
@@ -0,0 +1,242 @@
+""" Non-blocking vehicle command queue for the JLR InControl plugin
+
+Actions hand their command to a per-vehicle worker and return straight away. The worker sends the
+commands for a vehicle in order, then follows each one through Vehicle.get_service_status until JLR
+reports that the car carried it out (or didn't), publishing queued / sent / succeeded / failed as it goes.
+Command requests take their share of the account's JLR request budget ahead of background polls.
+
+Commands that set a vehicle state (charging, climate, locks) arriving within a short window are coalesced:
+repeats are merged, a later opposite command cancels the earlier one so only the final intent is sent,
+and a command whose target the vehicle is already in (by its last polled states) is skipped. One-shot
+commands such as honk and blink are sent straight away, every time.
+"""
+
+from urllib.error import HTTPError
+
+import logging
+import queue
+import threading
+import time
+
+import jlrpy
+
+logger = logging.getLogger('Plugin.commands')
+
+QUEUED = "queued"
+SENT = "sent"
+SUCCEEDED = "succeeded"
+FAILED = "failed"
+CANCELLED = "cancelled"
+SKIPPED = "skipped"
+
+SERVICE_SUCCESS = ('SUCCESSFUL', 'SUCCESS', 'COMPLETED')
+SERVICE_FAILURE = ('FAILED', 'FAILURE', 'CANCELLED', 'REJECTED', 'TIMEDOUT')
+# Service status polling backoff (seconds) and how long to follow a command before giving up
+STATUS_POLL_FIRST = 2
+STATUS_POLL_MAX = 30
+STATUS_POLL_TIMEOUT = 300
+# Seconds commands of the same kind are held so repeats and opposites can be coalesced
+DEFAULT_COALESCE_WINDOW = 5
+# Groups of commands that set a state, the only ones coalesced
+COALESCED_GROUPS = frozenset(('charging', 'climate', 'lock'))
+
+
+class Command:
+    """A command for one vehicle
+
+    send(vehicle) posts the command and returns the JLR service status response. on_success and
+    on_failure are called from the worker once the outcome is known. Commands with the same group
+    (one of COALESCED_GROUPS) are coalesced, satisfied(states) returns True if the vehicle's last polled
+    states show the command has nothing to do.
+    """
+
+    def __init__(self, name, send, on_success=None, on_failure=None, group=None, satisfied=None):
+        self.name = name
+        self.send = send
+        self.on_success = on_success
+        self.on_failure = on_failure
+        self.group = group
+        self.satisfied = satisfied
+        self.status = QUEUED
+        self.service_id = None
+        self.error = None
+
+
+class CommandQueue:
+    """One ordered command queue and worker thread per vehicle
+
+    run_with_vehicle(key, func, resend=True) runs func(vehicle) on the account's shared connection, with
+    resend False it logs in again after rejected tokens but leaves func to the next use,
+    publish(key, command) is called every time a command changes status and current_states(key)
+    returns the vehicle's last polled states.
+    """
+
+    def __init__(self, run_with_vehicle, publish, current_states=None, window=DEFAULT_COALESCE_WINDOW):
+        self.run_with_vehicle = run_with_vehicle
+        self.publish = publish
+        self.current_states = current_states
+        self.window = window
+        self._lock = threading.Lock()
+        self._queues = {}
+        # (key, group) -> [command, timer] held for the coalescing window
+        self._held = {}
+        self._stopping = threading.Event()
+        # Commands that never reached JLR: repeats merged, earlier opposites cancelled, already satisfied
+        self.merged = 0
+        self.cancelled = 0
+        self.skipped = 0
+        self.sent = 0
+
+    def submit(self, key, command):
+        """Queue a command for a vehicle and return without waiting for it"""
+        if command.group not in COALESCED_GROUPS or self.window <= 0:
+            self._publish(key, command)
+            self._enqueue(key, command)
+            return command
+        slot = (key, command.group)
+        with self._lock:
+            held = self._held.get(slot)
+            if held is None:
+                timer = threading.Timer(self.window, self._release, args=(slot,))
+                timer.daemon = True
+                self._held[slot] = [command, timer]
+                timer.start()
+                replaced = None
+            elif held[0].name == command.name:
+                self.merged += 1
+                logger.debug("%s merged with the one already queued (%s)" % (command.name, self.saved()))
+                return held[0]
+            else:
+                replaced = held[0]
+                held[0] = command
+                self.cancelled += 1
+        if replaced is not None:
+            replaced.status = CANCELLED
+            self._publish(key, replaced)
+            logger.debug("%s cancelled by %s (%s)" % (replaced.name, command.name, self.saved()))
+        self._publish(key, command)
+        return command
+
+    def saved(self):
+        """Summary of the commands coalescing saved from being sent"""
+        return "%d merged, %d cancelled, %d skipped, %d sent" % (self.merged, self.cancelled, self.skipped,
+                                                                 self.sent)
+
+    def _release(self, slot):
+        with self._lock:
+            held = self._held.pop(slot, None)
+        if held is not None and not self._stopping.is_set():
+            self._enqueue(slot[0], held[0])
+
+    def _enqueue(self, key, command):
+        if command.satisfied is not None and self.current_states is not None:
+            try:
+                satisfied = command.satisfied(self.current_states(key))
+            except Exception as e:
+                logger.debug("Unable to check current state for %s: %s" % (command.name, e))
+                satisfied = False
+            if satisfied:
+                self.skipped += 1
+                logger.debug("%s skipped, vehicle already in that state (%s)" % (command.name, self.saved()))
+                self._finish(key, command, SKIPPED)
+                return
+        with self._lock:
+            if key not in self._queues:
+                self._queues[key] = queue.Queue()
+                threading.Thread(target=self._run, args=(key, self._queues[key]),
+                                 name="JLRCommand-%s" % key, daemon=True).start()
+            self._queues[key].put(command)
+            self.sent += 1
+
+    def pending(self, key):
+        with self._lock:
+            q = self._queues.get(key)
+        return q.qsize() if q is not None else 0
+
+    def stop(self):
+        self._stopping.set()
+        with self._lock:
+            for command, timer in self._held.values():
+                timer.cancel()
+            self._held = {}
+            for q in self._queues.values():
+                q.put(None)
+            self._queues = {}
+
+    def _run(self, key, q):
+        # Commands are waiting on the user, so they go ahead of background polls for the request budget
+        with jlrpy.request_priority(jlrpy.PRIORITY_COMMAND):
+            self._serve(key, q)
+
+    def _serve(self, key, q):
+        while not self._stopping.is_set():
+            command = q.get()
+            if command is None:
+                return
+            try:
+                self._execute(key, command)
+            except Exception as e:
+                command.error = e
+                self._finish(key, command, FAILED)
+
+    def _execute(self, key, command):
+        # _send is the only retry a command gets, a rejected login is not followed by sending it again
+        response = self.run_with_vehicle(key, lambda v: self._send(v, command), resend=False)
+        command.service_id = (response or {}).get('customerServiceId')
+        self._set_status(key, command, SENT)
+        if not command.service_id:
+            # Nothing to follow, the accepted POST is all we will hear about it
+            self._finish(key, command, SUCCEEDED)
+            return
+
+        delay = STATUS_POLL_FIRST
+        deadline = time.monotonic() + STATUS_POLL_TIMEOUT
+        while time.monotonic() < deadline and not self._stopping.is_set():
+            self._stopping.wait(delay)
+            delay = min(delay * 2, STATUS_POLL_MAX)
+            try:
+                result = self.run_with_vehicle(key, lambda v: v.get_service_status(command.service_id))
+            except Exception as e:
+                logger.debug("Service status for %s not available: %s" % (command.name, e))
+                continue
+            status = str((result or {}).get('status', '')).upper()
+            if status in SERVICE_SUCCESS:
+                self._finish(key, command, SUCCEEDED)
+                return
+            if status in SERVICE_FAILURE:
+                command.error = (result or {}).get('failureReason') or status
+                self._finish(key, command, FAILED)
+                return
+        command.error = "No confirmation from the vehicle"
+        self._finish(key, command, FAILED)
+
+    @staticmethod
+    def _send(vehicle, command):
+        try:
+            return command.send(vehicle)
+        except HTTPError as e:
+            if not jlrpy.is_auth_error(e):
+                raise
+            # The cached service token may have been used up, authenticate the service again. The command
+            # was turned away at authentication and never reached the vehicle, so one more send is safe
+            vehicle.clear_service_tokens()
+            return command.send(vehicle)
+
+    def _set_status(self, key, command, status):
+        command.status = status
+        self._publish(key, command)
+
+    def _finish(self, key, command, status):
+        self._set_status(key, command, status)
+        callback = command.on_success if status in (SUCCEEDED, SKIPPED) else command.on_failure
+        if callback is not None:
+            try:
+                callback(command)
+            except Exception as e:
+                logger.error("Error completing %s: %s" % (command.name, e))
+
+    def _publish(self, key, command):
+        try:
+            self.publish(key, command)
+        except Exception as e:
+            logger.error("Error publishing status of %s: %s" % (command.name, e))
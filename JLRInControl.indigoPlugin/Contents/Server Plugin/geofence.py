@@ -0,0 +1,240 @@
+""" Geofence zones for the JLR InControl plugin
+
+Zones are defined in the plugin config, separated by semicolons or new lines, as either a circle
+(name, centre and radius in metres) or a polygon (name and three or more corners):
+
+    Home: 52.40331,-1.50921,150; Office: 52.41,-1.51 52.42,-1.51 52.42,-1.50
+
+Zones are indexed on a grid of GRID_CELL degree cells, so a position is only tested against the zones
+whose bounding box touches its cell. A vehicle is in every zone that contains it and its current zone
+is the smallest of them. It only leaves a zone once it is EXIT_MARGIN metres outside, so a position
+wandering along the boundary does not flap in and out. Entering and leaving zones is reported as
+events for the plugin's triggers.
+"""
+
+import logging
+import math
+import re
+import threading
+import time
+
+logger = logging.getLogger('Plugin.geofence')
+
+EARTH_RADIUS = 6371000.0
+METRES_PER_DEGREE = math.pi * EARTH_RADIUS / 180
+# Grid cell size in degrees, about 1km north to south
+GRID_CELL = 0.01
+# Zones covering more cells than this are kept out of the grid and tested for every position
+MAX_ZONE_CELLS = 2500
+# Metres outside a zone before a vehicle in it counts as having left
+EXIT_MARGIN = 25
+ENTERED_FORMAT = "%Y-%m-%d %H:%M"
+ZONE_SEPARATOR = re.compile(r'[;\n]')
+NUMBER = r'\s*(-?\d+(?:\.\d+)?)\s*'
+POINT = re.compile(r'^' + NUMBER + r',' + NUMBER + r'$')
+CIRCLE = re.compile(r'^' + NUMBER + r',' + NUMBER + r',' + NUMBER + r'$')
+
+
+def distance(lat1, lon1, lat2, lon2):
+    """Great circle distance in metres"""
+    phi1, phi2 = math.radians(lat1), math.radians(lat2)
+    a = (math.sin((phi2 - phi1) / 2) ** 2 +
+         math.cos(phi1) * math.cos(phi2) * math.sin(math.radians(lon2 - lon1) / 2) ** 2)
+    return 2 * EARTH_RADIUS * math.asin(min(1.0, math.sqrt(a)))
+
+
+class CircleZone:
+    def __init__(self, name, latitude, longitude, radius):
+        self.name = name
+        self.latitude = latitude
+        self.longitude = longitude
+        self.radius = radius
+        self.area = math.pi * radius * radius
+        dlat = radius / METRES_PER_DEGREE
+        dlon = radius / (METRES_PER_DEGREE * max(0.01, math.cos(math.radians(latitude))))
+        self.bounds = (latitude - dlat, longitude - dlon, latitude + dlat, longitude + dlon)
+
+    def contains(self, latitude, longitude, margin=0):
+        return distance(self.latitude, self.longitude, latitude, longitude) <= self.radius + margin
+
+
+class PolygonZone:
+    def __init__(self, name, points):
+        self.name = name
+        self.points = points
+        lats = [p[0] for p in points]
+        lons = [p[1] for p in points]
+        self.bounds = (min(lats), min(lons), max(lats), max(lons))
+        # Area on a local flat projection, only used to pick the smallest of overlapping zones
+        scale = math.cos(math.radians(sum(lats) / len(lats)))
+        self.area = abs(sum(points[i - 1][1] * points[i][0] - points[i][1] * points[i - 1][0]
+                            for i in range(len(points)))) / 2 * METRES_PER_DEGREE ** 2 * scale
+
+    def contains(self, latitude, longitude, margin=0):
+        inside = False
+        points = self.points
+        j = len(points) - 1
+        for i in range(len(points)):
+            (lat_i, lon_i), (lat_j, lon_j) = points[i], points[j]
+            if (lon_i > longitude) != (lon_j > longitude) and \
+                    latitude < (lat_j - lat_i) * (longitude - lon_i) / (lon_j - lon_i) + lat_i:
+                inside = not inside
+            j = i
+        if inside or not margin:
+            return inside
+        return self.edge_distance(latitude, longitude) <= margin
+
+    def edge_distance(self, latitude, longitude):
+        """Metres to the nearest edge, on a local flat projection which is plenty for a margin"""
+        scale = math.cos(math.radians(latitude))
+        best = float('inf')
+        points = self.points
+        for i in range(len(points)):
+            ay, ax = points[i - 1][0], points[i - 1][1] * scale
+            by, bx = points[i][0], points[i][1] * scale
+            py, px = latitude, longitude * scale
+            dx, dy = bx - ax, by - ay
+            length = dx * dx + dy * dy
+            f = 0.0 if not length else max(0.0, min(1.0, ((px - ax) * dx + (py - ay) * dy) / length))
+            best = min(best, math.hypot(px - (ax + f * dx), py - (ay + f * dy)))
+        return best * METRES_PER_DEGREE
+
+
+def parse_zones(text):
+    """Zones from the plugin config text, returns (zones, list of problems)"""
+    zones = []
+    errors = []
+    names = set()
+    for entry in ZONE_SEPARATOR.split(text or ""):
+        entry = entry.strip()
+        if not entry:
+            continue
+        name, colon, spec = entry.partition(':')
+        name = name.strip()
+        if not colon or not name:
+            errors.append("'%s' needs a name followed by a colon" % entry)
+            continue
+        if name in names:
+            errors.append("Zone %s is defined twice" % name)
+            continue
+        spec = spec.strip()
+        circle = CIRCLE.match(spec)
+        if circle:
+            latitude, longitude, radius = (float(value) for value in circle.groups())
+            if radius <= 0 or abs(latitude) > 90 or abs(longitude) > 180:
+                errors.append("Zone %s needs a valid position and a radius above 0" % name)
+                continue
+            zones.append(CircleZone(name, latitude, longitude, radius))
+            names.add(name)
+            continue
+        points = [POINT.match(corner) for corner in spec.split()]
+        if len(points) < 3 or not all(points):
+            errors.append("Zone %s needs latitude,longitude,radius or three or more latitude,longitude corners"
+                          % name)
+            continue
+        points = [(float(p.group(1)), float(p.group(2))) for p in points]
+        if any(abs(lat) > 90 or abs(lon) > 180 for lat, lon in points):
+            errors.append("Zone %s has a corner that is not a valid position" % name)
+            continue
+        zones.append(PolygonZone(name, points))
+        names.add(name)
+    return zones, errors
+
+
+class ZoneIndex:
+    """Grid of the zones whose bounding box touches each cell"""
+
+    def __init__(self, zones, cell=GRID_CELL):
+        self.cell = cell
+        self.zones = dict((zone.name, zone) for zone in zones)
+        self._grid = {}
+        self._wide = []
+        for zone in zones:
+            south, west, north, east = self._cell(zone.bounds[0], zone.bounds[1]) + \
+                self._cell(zone.bounds[2], zone.bounds[3])
+            if (north - south + 1) * (east - west + 1) > MAX_ZONE_CELLS:
+                self._wide.append(zone)
+                continue
+            for row in range(south, north + 1):
+                for column in range(west, east + 1):
+                    self._grid.setdefault((row, column), []).append(zone)
+
+    def _cell(self, latitude, longitude):
+        return int(math.floor(latitude / self.cell)), int(math.floor(longitude / self.cell))
+
+    def candidates(self, latitude, longitude):
+        """Zones that may contain the position"""
+        return self._grid.get(self._cell(latitude, longitude), []) + self._wide
+
+    def containing(self, latitude, longitude):
+        return [zone for zone in self.candidates(latitude, longitude) if zone.contains(latitude, longitude)]
+
+
+class GeofenceTracker:
+    """The zones each vehicle is in, turning each position into zone states and enter/exit events"""
+
+    def __init__(self, text=""):
+        self._lock = threading.Lock()
+        self._inside = {}
+        self.configure(text)
+
+    def configure(self, text):
+        """(Re)build the zones from the plugin config, returns the problems found in it"""
+        zones, errors = parse_zones(text)
+        for error in errors:
+            logger.warning("Geofence: %s" % error)
+        with self._lock:
+            self.index = ZoneIndex(zones)
+        return errors
+
+    def update(self, device_id, latitude, longitude, previous=None, now=None):
+        """Returns (device states, [(event, zone name)]) for a vehicle's new position
+
+        previous is the vehicle's device states, read the first time it is seen so a plugin restart
+        does not report the zones it was already in as entered.
+        """
+        if now is None:
+            now = time.time()
+        with self._lock:
+            index = self.index
+            zones = index.zones
+            if not zones and device_id not in self._inside:
+                return [], []
+            inside = self._inside.get(device_id)
+            if inside is None:
+                inside = self._restore(previous or {}, now)
+            now_inside = {}
+            for zone in index.containing(latitude, longitude):
+                now_inside[zone.name] = inside.get(zone.name, now)
+            for name, entered in inside.items():
+                # Zones no longer defined are dropped without an event
+                if name not in now_inside and name in zones and zones[name].contains(latitude, longitude, EXIT_MARGIN):
+                    now_inside[name] = entered
+            self._inside[device_id] = now_inside
+        events = [('zoneExited', name) for name in sorted(inside) if name not in now_inside and name in zones]
+        events += [('zoneEntered', name) for name in sorted(now_inside) if name not in inside]
+        current = min(now_inside, key=lambda name: zones[name].area) if now_inside else ""
+        entered = now_inside.get(current)
+        states = [
+            {'key': 'currentZone', 'value': current, 'uiValue': current or "None"},
+            {'key': 'inZones', 'value': ", ".join(sorted(now_inside))},
+            {'key': 'zoneEnteredAt', 'value': time.strftime(ENTERED_FORMAT, time.localtime(entered)) if entered else ""},
+            {'key': 'zoneDwellMinutes', 'value': int((now - entered) // 60) if entered else 0},
+        ]
+        return states, events
+
+    @staticmethod
+    def _restore(states, now):
+        """Zones the vehicle was in according to its device states"""
+        names = [name.strip() for name in str(states.get('inZones') or "").split(",") if name.strip()]
+        entered = now
+        try:
+            entered = time.mktime(time.strptime(states.get('zoneEnteredAt') or "", ENTERED_FORMAT))
+        except (TypeError, ValueError, OverflowError):
+            pass
+        current = states.get('currentZone')
+        return dict((name, entered if name == current else now) for name in names)
+
+    def forget(self, device_id):
+        with self._lock:
+            self._inside.pop(device_id, None)
@@ -0,0 +1,341 @@
+""" Time series history of vehicle states for the JLR InControl plugin
+
+The numeric states of every poll (state of charge, range, charging rate, odometer, tyre pressures,
+position and so on) are appended to one series per vehicle and state in a SQLite file. Each poll adds one
+small row per series to a staging table, and once a series has BLOCK_SIZE staged samples they are
+compacted into a block, a packed array of (time, value) doubles written once and never rewritten, so a
+sample costs 16 bytes and a range query only reads the blocks that overlap it. Every sample also
+updates minute, hour and day rollups (count, total, min, max, last), so a chart over weeks or months
+is drawn from a few hundred rollup rows rather than the raw samples. Raw samples and each rollup
+resolution are dropped after their own retention.
+"""
+
+from array import array
+
+import logging
+import re
+import sqlite3
+import sys
+import threading
+import time
+
+logger = logging.getLogger('Plugin.history')
+
+# Samples in each stored block of a series
+BLOCK_SIZE = 256
+# Rollup resolutions in seconds
+MINUTE = 60
+HOUR = 3600
+DAY = 86400
+ROLLUPS = (MINUTE, HOUR, DAY)
+# Seconds each resolution is kept for, None for ever, 'raw' is the samples themselves
+RETENTION = {
+    'raw': 14 * DAY,
+    MINUTE: 14 * DAY,
+    HOUR: 2 * 365 * DAY,
+    DAY: None,
+}
+# Seconds between sweeps for data past its retention
+PRUNE_INTERVAL = HOUR
+# States recorded when their value is a number, plus every tyre pressure
+RECORDED_STATES = frozenset((
+    'EV_STATE_OF_CHARGE', 'EV_RANGE_ON_BATTERY_KM', 'EV_RANGE_ON_BATTERY_MILES', 'EV_PHEV_RANGE_COMBINED_KM',
+    'EV_PHEV_RANGE_COMBINED_MILES', 'EV_CHARGING_RATE_KM_PER_HOUR', 'EV_CHARGING_RATE_MILES_PER_HOUR',
+    'EV_CHARGING_RATE_SOC_PER_HOUR', 'EV_MINUTES_TO_FULLY_CHARGED', 'ODOMETER_METER', 'ODOMETER_MILES',
+    'FUEL_LEVEL_PERC', 'DISTANCE_TO_EMPTY_FUEL', 'latitude', 'longitude', 'speed', 'heading', 'chargeRate',
+    'chargePower', 'chargeEnergyAdded'))
+RECORDED_PATTERN = re.compile(r'^TYRE_PRESSURE_')
+AGGREGATES = ('mean', 'min', 'max', 'last', 'count')
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS series (
+    id INTEGER PRIMARY KEY,
+    device INTEGER NOT NULL,
+    key TEXT NOT NULL,
+    UNIQUE (device, key)
+);
+CREATE TABLE IF NOT EXISTS blocks (
+    series INTEGER NOT NULL,
+    start REAL NOT NULL,
+    end REAL NOT NULL,
+    count INTEGER NOT NULL,
+    samples BLOB NOT NULL,
+    PRIMARY KEY (series, start)
+);
+CREATE INDEX IF NOT EXISTS blocks_by_end ON blocks (end);
+CREATE TABLE IF NOT EXISTS staged (
+    series INTEGER NOT NULL,
+    time REAL NOT NULL,
+    value REAL NOT NULL,
+    PRIMARY KEY (series, time)
+);
+CREATE TABLE IF NOT EXISTS rollups (
+    series INTEGER NOT NULL,
+    resolution INTEGER NOT NULL,
+    bucket INTEGER NOT NULL,
+    count INTEGER NOT NULL,
+    total REAL NOT NULL,
+    minimum REAL NOT NULL,
+    maximum REAL NOT NULL,
+    last REAL NOT NULL,
+    PRIMARY KEY (series, resolution, bucket)
+);
+"""
+ROLLUP_UPSERT = """
+INSERT INTO rollups (series, resolution, bucket, count, total, minimum, maximum, last) VALUES (?, ?, ?, 1, ?, ?, ?, ?)
+ON CONFLICT (series, resolution, bucket) DO UPDATE SET
+    count = count + 1, total = total + excluded.total, minimum = MIN(minimum, excluded.minimum),
+    maximum = MAX(maximum, excluded.maximum), last = excluded.last
+"""
+
+
+def recorded_values(device_states):
+    """The recorded states of a poll that hold numbers, as {key: float}"""
+    values = {}
+    for state in device_states:
+        key = state['key']
+        if key not in RECORDED_STATES and not RECORDED_PATTERN.match(key):
+            continue
+        value = state['value']
+        if isinstance(value, bool):
+            continue
+        try:
+            values[key] = float(value)
+        except (TypeError, ValueError):
+            continue
+    return values
+
+
+def pack(values):
+    """Little endian bytes of an array of doubles, whatever the machine"""
+    if sys.byteorder == 'little':
+        return values.tobytes()
+    values = array('d', values)
+    values.byteswap()
+    return values.tobytes()
+
+
+def unpack(data):
+    values = array('d')
+    values.frombytes(data)
+    if sys.byteorder != 'little':
+        values.byteswap()
+    return values
+
+
+class StateHistory:
+    """Raw samples and rollups of the numeric vehicle states, with range, last-N and resample queries
+
+    Times are seconds since the epoch. Queries hand back a pair of arrays (times, values), or for
+    resample a list of (slot start, value).
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        # Shared by the poll workers, every use is under the lock
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        # A commit per poll, the write ahead log makes that an append rather than a rewrite
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.executescript(SCHEMA)
+        self._series = {}
+        # [staged samples, newest sample time] of each series
+        self._tails = {}
+        self._pruned = 0
+        self.samples = 0
+
+    def record(self, device_id, device_states, now=None):
+        """Append the recorded states of a poll, returns the number of samples added"""
+        values = recorded_values(device_states)
+        if not values:
+            return 0
+        if now is None:
+            now = time.time()
+        samples = []
+        rollups = []
+        full = []
+        with self._lock, self._db:
+            for key, value in values.items():
+                series = self._series_id(device_id, key)
+                tail = self._tail(series)
+                if tail[1] is not None and now <= tail[1]:
+                    # Never out of order within a series, a clock step back drops samples until it catches up
+                    continue
+                tail[0] += 1
+                tail[1] = now
+                if tail[0] >= BLOCK_SIZE:
+                    full.append(series)
+                    tail[0] = 0
+                samples.append((series, now, value))
+                for resolution in ROLLUPS:
+                    rollups.append((series, resolution, int(now // resolution * resolution), value, value, value,
+                                    value))
+            self._db.executemany("INSERT INTO staged (series, time, value) VALUES (?, ?, ?)", samples)
+            self._db.executemany(ROLLUP_UPSERT, rollups)
+            for series in full:
+                self._compact(series)
+            if now - self._pruned >= PRUNE_INTERVAL:
+                self._prune(now)
+        self.samples += len(samples)
+        return len(samples)
+
+    def _series_id(self, device_id, key):
+        series = self._series.get((device_id, key))
+        if series is None:
+            self._db.execute("INSERT OR IGNORE INTO series (device, key) VALUES (?, ?)", (device_id, key))
+            series = self._db.execute("SELECT id FROM series WHERE device = ? AND key = ?",
+                                      (device_id, key)).fetchone()[0]
+            self._series[(device_id, key)] = series
+        return series
+
+    def _tail(self, series):
+        """[staged samples, newest sample time] of a series, the time None for a new series"""
+        tail = self._tails.get(series)
+        if tail is None:
+            count, newest = self._db.execute("SELECT COUNT(*), MAX(time) FROM staged WHERE series = ?",
+                                             (series,)).fetchone()
+            if newest is None:
+                newest = self._db.execute("SELECT MAX(end) FROM blocks WHERE series = ?", (series,)).fetchone()[0]
+            tail = self._tails[series] = [count, newest]
+        return tail
+
+    def _compact(self, series):
+        """Move the staged samples of a series into a new block"""
+        samples = array('d')
+        for row in self._db.execute("SELECT time, value FROM staged WHERE series = ? ORDER BY time", (series,)):
+            samples.extend(row)
+        if samples:
+            self._db.execute("INSERT INTO blocks (series, start, end, count, samples) VALUES (?, ?, ?, ?, ?)",
+                             (series, samples[0], samples[-2], len(samples) // 2, pack(samples)))
+        self._db.execute("DELETE FROM staged WHERE series = ?", (series,))
+
+    def _prune(self, now):
+        self._pruned = now
+        removed = self._db.execute("DELETE FROM blocks WHERE end < ?", (now - RETENTION['raw'],)).rowcount
+        removed += self._db.execute("DELETE FROM staged WHERE time < ?", (now - RETENTION['raw'],)).rowcount
+        for resolution in ROLLUPS:
+            if RETENTION[resolution] is not None:
+                removed += self._db.execute("DELETE FROM rollups WHERE resolution = ? AND bucket < ?",
+                                            (resolution, now - RETENTION[resolution])).rowcount
+        if removed:
+            # Staged samples may have gone from a series that has not been written to since
+            self._tails = {}
+            logger.debug("Dropped %d blocks, samples and rollups past their retention" % removed)
+
+    def _find(self, device_id, key):
+        series = self._series.get((device_id, key))
+        if series is None:
+            row = self._db.execute("SELECT id FROM series WHERE device = ? AND key = ?", (device_id, key)).fetchone()
+            series = row[0] if row is not None else None
+        return series
+
+    def keys(self, device_id):
+        """The states with a history for a device"""
+        with self._lock:
+            return [row[0] for row in self._db.execute("SELECT key FROM series WHERE device = ? ORDER BY key",
+                                                       (device_id,))]
+
+    def range(self, device_id, key, start=None, end=None):
+        """Raw samples from start up to and including end, (times, values) arrays oldest first"""
+        times, values = array('d'), array('d')
+        start = float('-inf') if start is None else start
+        end = float('inf') if end is None else end
+        with self._lock:
+            series = self._find(device_id, key)
+            if series is None:
+                return times, values
+            blocks = self._db.execute("SELECT samples FROM blocks WHERE series = ? AND end >= ? AND start <= ? "
+                                      "ORDER BY start", (series, start, end)).fetchall()
+            staged = self._db.execute("SELECT time, value FROM staged WHERE series = ? AND time >= ? AND time <= ? "
+                                      "ORDER BY time", (series, start, end)).fetchall()
+        for (data,) in blocks:
+            samples = unpack(data)
+            for i in range(0, len(samples), 2):
+                if start <= samples[i] <= end:
+                    times.append(samples[i])
+                    values.append(samples[i + 1])
+        # Staged samples are all newer than the blocks
+        for when, value in staged:
+            times.append(when)
+            values.append(value)
+        return times, values
+
+    def last(self, device_id, key, count=1):
+        """The newest count raw samples, (times, values) arrays oldest first"""
+        blocks = []
+        with self._lock:
+            series = self._find(device_id, key)
+            if series is not None:
+                # The staged samples come first, as the newest of the series
+                staged = array('d')
+                for row in self._db.execute("SELECT time, value FROM (SELECT time, value FROM staged WHERE series = ? "
+                                            "ORDER BY time DESC LIMIT ?) ORDER BY time", (series, count)):
+                    staged.extend(row)
+                blocks.append(staged)
+                held = len(staged) // 2
+                for (data,) in self._db.execute("SELECT samples FROM blocks WHERE series = ? ORDER BY start DESC",
+                                                (series,)):
+                    if held >= count:
+                        break
+                    blocks.append(unpack(data))
+                    held += len(blocks[-1]) // 2
+                    if held >= count:
+                        break
+        samples = array('d')
+        for block in reversed(blocks):
+            samples.extend(block)
+        samples = samples[max(0, len(samples) - count * 2):]
+        return samples[0::2], samples[1::2]
+
+    def resample(self, device_id, key, start, end, step, how='mean'):
+        """The series in slots of step seconds from start to end, a list of (slot start, value)
+
+        Slots without samples are left out. The coarsest rollup that step is a multiple of is used, so
+        a month in hour slots reads 720 rows however often the car was polled, and the raw samples
+        only when step is not a whole number of minutes. how is one of AGGREGATES.
+        """
+        if how not in AGGREGATES:
+            raise ValueError("Unknown aggregate %s, expected one of %s" % (how, ", ".join(AGGREGATES)))
+        step = int(step)
+        if step <= 0:
+            raise ValueError("step must be a positive number of seconds")
+        resolution = None
+        for candidate in ROLLUPS:
+            if step % candidate == 0:
+                resolution = candidate
+        if resolution is None:
+            times, values = self.range(device_id, key, start, end)
+            rows = ((t, 1, v, v, v, v) for t, v in zip(times, values))
+        else:
+            with self._lock:
+                series = self._find(device_id, key)
+                if series is None:
+                    return []
+                rows = self._db.execute("SELECT bucket, count, total, minimum, maximum, last FROM rollups "
+                                        "WHERE series = ? AND resolution = ? AND bucket >= ? AND bucket <= ? "
+                                        "ORDER BY bucket", (series, resolution,
+                                                            int(start // resolution * resolution), end)).fetchall()
+        slots = []
+        current = None
+        for bucket, count, total, minimum, maximum, last in rows:
+            slot = int(bucket // step * step)
+            if current is None or current[0] != slot:
+                current = [slot, 0, 0.0, minimum, maximum, last]
+                slots.append(current)
+            current[1] += count
+            current[2] += total
+            current[3] = min(current[3], minimum)
+            current[4] = max(current[4], maximum)
+            current[5] = last
+        pick = {
+            'mean': lambda s: s[2] / s[1],
+            'count': lambda s: s[1],
+            'min': lambda s: s[3],
+            'max': lambda s: s[4],
+            'last': lambda s: s[5],
+        }[how]
+        return [(s[0], pick(s)) for s in slots]
+
+    def close(self):
+        with self._lock:
+            self._db.close()
@@ -2,19 +2,452 @@
 https://github.com/ardevd/jlrpy
 """
 
-from urllib.request import Request, build_opener
-
+from http.client import HTTPConnection, HTTPException, HTTPSConnection
+from urllib.error import HTTPError
+from urllib.parse import urlsplit
+
+import contextlib
+import heapq
+import io
+import itertools
 import json
 import datetime
 import calendar
+import random
+import sys
+import threading
+import time
 import uuid
 import logging
+import zlib
 
 logger = logging.getLogger('jlrpy')
 
 IFAS_BASE_URL = "https://ifas.prod-row.jlrmotor.com/ifas/jlr"
 IFOP_BASE_ULR = "https://ifop.prod-row.jlrmotor.com/ifop/jlr"
 IF9_BASE_URL = "https://if9.prod-row.jlrmotor.com/if9/jlr"
+# SSL context for https connections, None for the default certificate checks
+SSL_CONTEXT = None
+# Cassette recording or replaying the requests of every Connection, see set_cassette()
+CASSETTE = None
+# Receives the timing, size and outcome of every request, see set_metrics()
+METRICS = None
+
+# Idle keep-alive connections older than this (seconds) are closed rather than reused
+POOL_IDLE_TIMEOUT = 60
+# Idle connections kept per host, enough for the concurrent calls of a poll
+POOL_MAX_IDLE_PER_HOST = 4
+# Methods safe to send again when a reused connection drops before the response, anything else may
+# already have been acted on by the server
+IDEMPOTENT_METHODS = frozenset(('GET', 'HEAD'))
+USER_AGENT = "Python-urllib/%d.%d" % sys.version_info[:2]
+# Compressed responses asked for on every request, they are decoded as they are read
+ACCEPT_ENCODING = "gzip, deflate"
+# Bytes read from the socket at a time while decoding a compressed response
+READ_CHUNK = 64 * 1024
+# Seconds a downloaded vehicle status is reused before it is fetched again
+STATUS_MAX_AGE = 10
+# Seconds a service authentication token is reused for further commands to the same service
+SERVICE_TOKEN_MAX_AGE = 120
+# Socket timeout (seconds) for every request unless the Connection is given one
+DEFAULT_TIMEOUT = 30
+# Extra attempts for idempotent GETs that time out or get a 5xx, with jittered exponential backoff
+GET_RETRIES = 2
+RETRY_BACKOFF = 0.5
+# Consecutive 5xx responses or timeouts from a host before its breaker opens, and seconds until a probe
+BREAKER_THRESHOLD = 5
+BREAKER_COOLDOWN = 120
+# Request budget per account for each JLR service: (requests per second, burst)
+RATE_LIMITS = {
+    'ifas': (0.2, 3),
+    'ifop': (0.2, 3),
+    'if9': (2.0, 10),
+}
+# Waiting requests are served lowest priority first, user commands ahead of background polls, and polls
+# ahead of bulk downloads such as trip routes
+PRIORITY_COMMAND = 0
+PRIORITY_POLL = 1
+PRIORITY_BACKGROUND = 2
+# Words in the body of a 403 that show JLR rejected the tokens, rather than throttling the account
+AUTH_ERROR_MARKERS = ('token', 'auth', 'credential', 'expired', 'unauthori')
+
+
+def set_base_urls(root=None, ssl_context=None):
+    """Point jlrpy at other servers, such as a local stand-in for the JLR API
+
+    root is a url like http://127.0.0.1:8080, the /ifas/jlr, /ifop/jlr and /if9/jlr paths are added to it.
+    With no root the production servers are used again. ssl_context is used for https connections,
+    for instance to trust the stand-in's own certificate.
+    """
+    global IFAS_BASE_URL, IFOP_BASE_ULR, IF9_BASE_URL, SSL_CONTEXT
+    if root:
+        root = root.rstrip('/')
+        IFAS_BASE_URL = root + "/ifas/jlr"
+        IFOP_BASE_ULR = root + "/ifop/jlr"
+        IF9_BASE_URL = root + "/if9/jlr"
+    else:
+        IFAS_BASE_URL = "https://ifas.prod-row.jlrmotor.com/ifas/jlr"
+        IFOP_BASE_ULR = "https://ifop.prod-row.jlrmotor.com/ifop/jlr"
+        IF9_BASE_URL = "https://if9.prod-row.jlrmotor.com/if9/jlr"
+    SSL_CONTEXT = ssl_context
+
+
+def set_metrics(metrics):
+    """Report every request to metrics.request(method, url, seconds, bytes sent, bytes received, error, wire)
+
+    bytes received is the size of the decoded body, wire its size as transferred. None stops the reporting.
+    """
+    global METRICS
+    METRICS = metrics
+
+
+def set_cassette(cassette):
+    """Record every request to a cassette, or replay them from one without any network, None to stop
+
+    The cassette is an object with a replaying attribute. A replaying cassette has play(method, url)
+    returning (response, body bytes), a recording one has record(method, url, status, headers, body bytes,
+    seconds) and record_error(method, url, exception, seconds), see the plugin's cassette module.
+    """
+    global CASSETTE
+    CASSETTE = cassette
+
+
+def is_auth_error(error):
+    """True if an HTTPError means JLR rejected the tokens it was sent
+
+    A 401 always does. JLR also answers 403 when it throttles an account, so a 403 only counts when its
+    body is about the tokens; logging in again after a throttling 403 would only spend more requests.
+    """
+    if error.code == 401:
+        return True
+    if error.code != 403:
+        return False
+    body = getattr(error, 'jlr_body', None)
+    if body is None:
+        try:
+            body = error.read().decode('utf8', 'replace').lower()
+        except Exception:
+            body = ""
+        # The body can only be read once, keep it for the next caller
+        error.jlr_body = body
+    return any(marker in body for marker in AUTH_ERROR_MARKERS)
+
+
+class CircuitOpenError(Exception):
+    """Raised instead of sending a request while a host's circuit breaker is open"""
+
+
+class CircuitBreaker:
+    """Stops requests to a host after repeated failures until a probe after the cooldown succeeds"""
+
+    def __init__(self, threshold=BREAKER_THRESHOLD, cooldown=BREAKER_COOLDOWN):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened_at = None
+        self._probing = False
+        self._lock = threading.Lock()
+
+    @property
+    def is_open(self):
+        return self.opened_at is not None
+
+    def allow(self):
+        """True if a request may be sent, once the cooldown has passed a single probe is let through"""
+        with self._lock:
+            if self.opened_at is None:
+                return True
+            if not self._probing and time.monotonic() - self.opened_at >= self.cooldown:
+                self._probing = True
+                return True
+            return False
+
+    def success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+            self._probing = False
+
+    def release(self):
+        """A request ended without an answer either way, the next one may probe instead"""
+        with self._lock:
+            self._probing = False
+
+    def failure(self):
+        with self._lock:
+            self.failures += 1
+            if self._probing or self.failures >= self.threshold:
+                if self.opened_at is None:
+                    logger.warning("Backing off after %d failed requests" % self.failures)
+                self.opened_at = time.monotonic()
+            self._probing = False
+
+
+_breakers = {}
+_breakers_lock = threading.Lock()
+
+
+def get_breaker(host):
+    """Circuit breaker for a host, shared by every Connection so it survives a new login"""
+    with _breakers_lock:
+        if host not in _breakers:
+            _breakers[host] = CircuitBreaker()
+        return _breakers[host]
+
+
+def backing_off():
+    """True if the circuit breaker of any JLR host is open"""
+    with _breakers_lock:
+        return any(breaker.is_open for breaker in _breakers.values())
+
+
+class TokenBucket:
+    """Token bucket rate limit, waiting callers are served in priority order"""
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        self._cond = threading.Condition()
+        self._waiting = []
+        self._sequence = itertools.count()
+        # Requests let through, how many had to wait and for how long in total, and the longest queue seen
+        self.acquired = 0
+        self.delayed = 0
+        self.wait_time = 0.0
+        self.max_wait = 0.0
+        self.max_depth = 0
+
+    @property
+    def depth(self):
+        """Requests currently waiting for a token"""
+        return len(self._waiting)
+
+    def acquire(self, priority=PRIORITY_POLL):
+        """Block until a token is available and this caller is first in line, return the seconds waited"""
+        start = time.monotonic()
+        with self._cond:
+            ticket = (priority, next(self._sequence))
+            heapq.heappush(self._waiting, ticket)
+            self.max_depth = max(self.max_depth, len(self._waiting))
+            try:
+                while True:
+                    self._refill()
+                    if self._waiting[0] == ticket:
+                        if self.tokens >= 1:
+                            break
+                        self._cond.wait((1 - self.tokens) / self.rate)
+                    else:
+                        self._cond.wait()
+                heapq.heappop(self._waiting)
+                self.tokens -= 1
+            except BaseException:
+                self._waiting.remove(ticket)
+                heapq.heapify(self._waiting)
+                raise
+            finally:
+                # The next caller in line may be able to go now
+                self._cond.notify_all()
+            waited = time.monotonic() - start
+            self.acquired += 1
+            if waited > 0.01:
+                self.delayed += 1
+                self.wait_time += waited
+                self.max_wait = max(self.max_wait, waited)
+        return waited
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def stats(self):
+        with self._cond:
+            return {'depth': len(self._waiting), 'max_depth': self.max_depth, 'acquired': self.acquired,
+                    'delayed': self.delayed, 'wait_time': self.wait_time, 'max_wait': self.max_wait}
+
+
+class RateLimiter:
+    """One token bucket per JLR service (ifas, ifop, if9) for an account"""
+
+    def __init__(self, limits=None):
+        self.buckets = {service: TokenBucket(rate, burst)
+                        for service, (rate, burst) in (limits or RATE_LIMITS).items()}
+
+    def acquire(self, url):
+        """Wait for the budget of the service the url belongs to, at the calling thread's priority"""
+        bucket = self.buckets.get(service_of(url))
+        if bucket is None:
+            return 0.0
+        return bucket.acquire(getattr(_priority, 'value', PRIORITY_POLL))
+
+    def stats(self):
+        return {service: bucket.stats() for service, bucket in self.buckets.items()}
+
+
+_priority = threading.local()
+_limiters = {}
+_limiters_lock = threading.Lock()
+
+
+def service_of(url):
+    """JLR service a url belongs to, taken from the first path segment (/ifas/jlr/...)"""
+    return urlsplit(url).path.lstrip('/').split('/', 1)[0]
+
+
+def get_rate_limiter(account):
+    """Rate limiter for an account, shared by every Connection so the budget survives a new login"""
+    with _limiters_lock:
+        if account not in _limiters:
+            _limiters[account] = RateLimiter()
+        return _limiters[account]
+
+
+def rate_limit_stats():
+    """Rate limiter statistics per account and service"""
+    with _limiters_lock:
+        limiters = dict(_limiters)
+    return {account: limiter.stats() for account, limiter in limiters.items()}
+
+
+@contextlib.contextmanager
+def request_priority(priority):
+    """Requests made by this thread inside the block wait for the rate limiter at the given priority"""
+    previous = getattr(_priority, 'value', PRIORITY_POLL)
+    _priority.value = priority
+    try:
+        yield
+    finally:
+        _priority.value = previous
+
+
+def read_body(resp):
+    """Read a response body, undoing a gzip or deflate Content-Encoding, returns (body, bytes on the wire)
+
+    A compressed body is decoded chunk by chunk as it arrives rather than after the whole of it is read.
+    """
+    encoding = (resp.getheader('Content-Encoding') or '').strip().lower()
+    if encoding not in ('gzip', 'x-gzip', 'deflate'):
+        data = resp.read()
+        return data, len(data)
+    decoder = None
+    parts = []
+    wire = 0
+    try:
+        while True:
+            chunk = resp.read(READ_CHUNK)
+            if not chunk:
+                break
+            if decoder is None:
+                if encoding != 'deflate':
+                    decoder = zlib.decompressobj(16 + zlib.MAX_WBITS)
+                elif len(chunk) > 1 and chunk[0] & 0x0F == 8 and (chunk[0] << 8 | chunk[1]) % 31 == 0:
+                    decoder = zlib.decompressobj(zlib.MAX_WBITS)
+                else:
+                    # Some servers send deflate without the zlib header
+                    decoder = zlib.decompressobj(-zlib.MAX_WBITS)
+            wire += len(chunk)
+            parts.append(decoder.decompress(chunk))
+        if decoder is not None:
+            parts.append(decoder.flush())
+    except zlib.error as e:
+        raise HTTPException("Undecodable %s response body: %s" % (encoding, e))
+    return b''.join(parts), wire
+
+
+class ConnectionPool:
+    """Persistent HTTP(S) connections to the JLR hosts, reused across requests
+
+    Idle connections are evicted after POOL_IDLE_TIMEOUT seconds. A reused connection the server has
+    already dropped is replaced by a fresh one and the request sent again, if it could not be written or
+    is one of the IDEMPOTENT_METHODS. Every request asks for a compressed response, which is handed back
+    decoded.
+    """
+
+    def __init__(self, idle_timeout=POOL_IDLE_TIMEOUT, max_idle_per_host=POOL_MAX_IDLE_PER_HOST,
+                 timeout=DEFAULT_TIMEOUT):
+        self.idle_timeout = idle_timeout
+        self.timeout = timeout
+        self.max_idle_per_host = max_idle_per_host
+        self._idle = {}
+        self._lock = threading.Lock()
+        # Number of new TCP (and TLS) connections made, and of requests sent over them
+        self.connections_opened = 0
+        self.requests = 0
+        # Response body bytes as transferred and after decoding
+        self.bytes_wire = 0
+        self.bytes_decoded = 0
+
+    def request(self, method, url, body=None, headers=None):
+        """Send a request and return (response, decoded body bytes), response.wire_bytes is its size as transferred"""
+        parts = urlsplit(url)
+        key = (parts.scheme, parts.hostname, parts.port)
+        path = parts.path + ("?%s" % parts.query if parts.query else "")
+        headers = dict(headers or {})
+        headers.setdefault("User-Agent", USER_AGENT)
+        headers.setdefault("Accept-Encoding", ACCEPT_ENCODING)
+
+        while True:
+            conn, reused = self._acquire(key)
+            sent = False
+            try:
+                conn.request(method, path, body=body, headers=headers)
+                sent = True
+                resp = conn.getresponse()
+                data, wire = read_body(resp)
+            except ConnectionError:
+                conn.close()
+                # Server closed the idle connection under us, try again on a new one unless a command
+                # may have reached it
+                if reused and (not sent or method in IDEMPOTENT_METHODS):
+                    logger.debug("Stale connection to %s dropped" % parts.hostname)
+                    continue
+                raise
+            except Exception:
+                conn.close()
+                raise
+            if resp.will_close:
+                conn.close()
+            else:
+                self._release(key, conn)
+            resp.wire_bytes = wire
+            with self._lock:
+                self.bytes_wire += wire
+                self.bytes_decoded += len(data)
+            return resp, data
+
+    def close(self):
+        """Close every idle connection"""
+        with self._lock:
+            idle, self._idle = self._idle, {}
+        for conns in idle.values():
+            for conn, last_used in conns:
+                conn.close()
+
+    def _acquire(self, key):
+        now = time.monotonic()
+        with self._lock:
+            self.requests += 1
+            conns = self._idle.get(key, [])
+            while conns:
+                conn, last_used = conns.pop()
+                if now - last_used < self.idle_timeout:
+                    return conn, True
+                conn.close()
+            self.connections_opened += 1
+        scheme, host, port = key
+        if scheme == "https":
+            return HTTPSConnection(host, port, timeout=self.timeout, context=SSL_CONTEXT), False
+        return HTTPConnection(host, port, timeout=self.timeout), False
+
+    def _release(self, key, conn):
+        with self._lock:
+            conns = self._idle.setdefault(key, [])
+            if len(conns) < self.max_idle_per_host:
+                conns.append((conn, time.monotonic()))
+                return
+        conn.close()
 
 
 class Connection:
@@ -25,14 +458,25 @@ class Connection:
                  password='',
                  device_id='',
                  refresh_token='',
-                 use_china_servers=False):
+                 use_china_servers=False,
+                 user_id='',
+                 timeout=DEFAULT_TIMEOUT,
+                 status_max_age=STATUS_MAX_AGE):
         """Init the connection object
 
         The email address and password associated with your Jaguar InControl account is required.
         A device Id can optionally be specified. If not one will be generated at runtime.
         A refresh token can be supplied for authentication instead of a password
+        A user Id from a previous session can be supplied together with its device Id and refresh token,
+        in which case the device is not registered again and the user is not logged in again
+        The timeout (seconds) applies to every request made on the connection
+        A vehicle status younger than status_max_age seconds is reused rather than downloaded again
         """
         self.email = email
+        self.status_max_age = status_max_age
+        self.user_id = user_id
+        self.pool = ConnectionPool(timeout=timeout)
+        self.limiter = get_rate_limiter(email)
 
         if use_china_servers:
             global IFAS_BASE_URL
@@ -89,7 +533,10 @@ class Connection:
         self.__register_auth(auth)
         self.__set_header(auth['access_token'])
         logger.info("[+] authenticated")
-        self.__register_device_and_log_in()
+        if self.user_id:
+            logger.info("device id and user id restored from previous session")
+        else:
+            self.__register_device_and_log_in()
 
     def __register_device_and_log_in(self):
         self.__register_device(self.head)
@@ -98,19 +545,84 @@ class Connection:
         logger.info("2/2 user logged in, user id retrieved")
 
     def __open(self, url, headers=None, data=None):
-        req = Request(url, headers=headers)
+        body = None
+        method = "GET"
         if data:
-            req.data = bytes(json.dumps(data), encoding="utf8")
-
-        opener = build_opener()
-        resp = opener.open(req)
-        charset = resp.info().get('charset', 'utf-8')
-        resp_data = resp.read().decode(charset)
+            body = bytes(json.dumps(data), encoding="utf8")
+            method = "POST"
+
+        host = urlsplit(url).hostname
+        breaker = get_breaker(host)
+        attempts = 1 + (GET_RETRIES if method == "GET" else 0)
+        for attempt in range(attempts):
+            if not breaker.allow():
+                raise CircuitOpenError("%s is backing off after repeated failures" % host)
+            try:
+                resp, raw = self.__send(method, url, body, headers)
+            except (OSError, HTTPException):
+                # Timeouts and dropped connections count against the host
+                breaker.failure()
+                if attempt + 1 < attempts:
+                    self.__backoff(attempt)
+                    continue
+                raise
+            except BaseException:
+                # Not the host's fault, but a probe let through must not hold the breaker half open for good
+                breaker.release()
+                raise
+            if resp.status < 500:
+                breaker.success()
+                break
+            breaker.failure()
+            if attempt + 1 < attempts:
+                self.__backoff(attempt)
+        if resp.status >= 400:
+            raise HTTPError(url, resp.status, resp.reason, resp.headers, io.BytesIO(raw))
+        charset = resp.headers.get_content_charset('utf-8')
+        resp_data = raw.decode(charset)
         if resp_data:
             return json.loads(resp_data)
         else:
             return None
 
+    def __send(self, method, url, body, headers):
+        metrics = METRICS
+        if metrics is None:
+            return self.__exchange(method, url, body, headers)
+        started = time.perf_counter()
+        try:
+            resp, raw = self.__exchange(method, url, body, headers)
+        except Exception:
+            metrics.request(method, url, time.perf_counter() - started, len(body or b''), 0, True)
+            raise
+        metrics.request(method, url, time.perf_counter() - started, len(body or b''), len(raw), resp.status >= 400,
+                        getattr(resp, 'wire_bytes', len(raw)))
+        return resp, raw
+
+    def __exchange(self, method, url, body, headers):
+        cassette = CASSETTE
+        if cassette is not None and cassette.replaying:
+            return cassette.play(method, url)
+        waited = self.limiter.acquire(url)
+        if waited > 0.01:
+            logger.debug("Waited %.1fs for the %s request budget" % (waited, service_of(url)))
+        started = time.monotonic()
+        try:
+            resp, raw = self.pool.request(method, url, body, headers)
+        except (OSError, HTTPException) as e:
+            if cassette is not None:
+                cassette.record_error(method, url, e, time.monotonic() - started)
+            raise
+        if cassette is not None:
+            cassette.record(method, url, resp.status, resp.headers, raw, time.monotonic() - started)
+        return resp, raw
+
+    @staticmethod
+    def __backoff(attempt):
+        delay = RETRY_BACKOFF * 2 ** attempt * random.uniform(0.5, 1.5)
+        logger.debug("Retrying in %.1fs" % delay)
+        time.sleep(delay)
+
     def __register_auth(self, auth):
         self.access_token = auth['access_token']
         now = calendar.timegm(datetime.datetime.now().timetuple())
@@ -192,6 +704,31 @@ class Connection:
                         self.head)
 
 
+class StatusSnapshot:
+    """A single download of the vehicle status, indexed by key"""
+
+    def __init__(self, result):
+        self.result = result
+        self.fetched = time.monotonic()
+        vehicle_status = result['vehicleStatus']
+        self.core = vehicle_status.get('coreStatus') or []
+        self.ev = vehicle_status.get('evStatus') or []
+        self.values = {d['key']: d['value'] for d in self.core + self.ev}
+
+    def age(self):
+        """Seconds since the status was downloaded"""
+        return time.monotonic() - self.fetched
+
+    def get(self, key, default=None):
+        return self.values.get(key, default)
+
+    def __getitem__(self, key):
+        return self.values[key]
+
+    def __contains__(self, key):
+        return key in self.values
+
+
 class Vehicle(dict):
     """Vehicle class.
 
@@ -204,6 +741,10 @@ class Vehicle(dict):
         super().__init__(data)
         self.connection = connection
         self.vin = data['vin']
+        self.status_max_age = getattr(connection, 'status_max_age', STATUS_MAX_AGE)
+        self._status = None
+        self._status_lock = threading.Lock()
+        self._service_tokens = {}
 
     def get_contact_info(self, mcc):
         """ Get contact info for the specified mobile country code"""
@@ -218,17 +759,23 @@ class Vehicle(dict):
 
     def get_status(self, key=None):
         """Get vehicle status"""
-        headers = self.connection.head.copy()
-        headers["Accept"] = "application/vnd.ngtp.org.if9.healthstatus-v3+json"
-        result = self.get('status?includeInactive=true', headers)
+        snapshot = self.get_status_snapshot()
 
         if key:
-            coreStatusList = result['vehicleStatus']['coreStatus']
-            evStatusList = result['vehicleStatus']['evStatus']
-            coreStatusList = coreStatusList + evStatusList
-            return {d['key']: d['value'] for d in coreStatusList}[key]
+            return snapshot[key]
 
-        return result
+        return snapshot.result
+
+    def get_status_snapshot(self, max_age=None):
+        """Get vehicle status, reusing the last download if it is less than max_age seconds old"""
+        if max_age is None:
+            max_age = self.status_max_age
+        with self._status_lock:
+            if self._status is None or self._status.age() > max_age:
+                headers = self.connection.head.copy()
+                headers["Accept"] = "application/vnd.ngtp.org.if9.healthstatus-v3+json"
+                self._status = StatusSnapshot(self.get('status?includeInactive=true', headers))
+            return self._status
 
     def get_health_status(self):
         """Get vehicle health status"""
@@ -624,14 +1171,29 @@ class Vehicle(dict):
         return self._authenticate_service(pin, "GM")
 
     def _authenticate_service(self, pin, service_name):
-        """Authenticate to specified service with the provided PIN"""
+        """Authenticate to specified service with the provided PIN
+
+        The token is reused for SERVICE_TOKEN_MAX_AGE seconds, call clear_service_tokens() if the
+        service rejects it.
+        """
+        cached = self._service_tokens.get((service_name, pin))
+        if cached and time.monotonic() - cached[0] < SERVICE_TOKEN_MAX_AGE:
+            return dict(cached[1])
+
         data = {
             "serviceName": "%s" % service_name,
             "pin": "%s" % pin}
         headers = self.connection.head.copy()
         headers["Content-Type"] = "application/vnd.wirelesscar.ngtp.if9.AuthenticateRequest-v2+json; charset=utf-8"
 
-        return self.post("users/%s/authenticate" % self.connection.user_id, headers, data)
+        result = self.post("users/%s/authenticate" % self.connection.user_id, headers, data)
+        if result:
+            self._service_tokens[(service_name, pin)] = (time.monotonic(), dict(result))
+        return result
+
+    def clear_service_tokens(self):
+        """Forget cached service authentication tokens"""
+        self._service_tokens = {}
 
     def post(self, command, headers, data):
         """Utility command to post data to VHS"""
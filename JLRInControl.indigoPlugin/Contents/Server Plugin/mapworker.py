@@ -0,0 +1,124 @@
+""" Background MapQuest car location map rendering for the JLR InControl plugin
+
+Maps are only requested when the car has moved more than a set distance since the last map, are drawn
+on a worker thread so a poll never waits for MapQuest, and are cached on disk by rounded coordinates so
+a car returning to a familiar place (home, work) reuses the image it already has. Images are written to
+a temporary file and renamed into place so a control page never reads a half written file.
+"""
+
+import logging
+import math
+import os
+import threading
+
+import requests
+
+logger = logging.getLogger('Plugin.mapworker')
+
+MAPQUEST_URL = "https://www.mapquestapi.com/staticmap/v5/map?locations={},{}&size=@2x&key={}"
+MAP_TIMEOUT = 10
+# Decimal places the coordinates are rounded to for the cache, 4 places is roughly 11m
+CACHE_PRECISION = 4
+MAX_CACHED_MAPS = 500
+DEFAULT_MOVE_DISTANCE = 50
+EARTH_RADIUS_M = 6371000
+
+
+def distance_m(lat1, lon1, lat2, lon2):
+    """Great circle distance in metres"""
+    lat1, lon1, lat2, lon2 = map(math.radians, (lat1, lon1, lat2, lon2))
+    a = math.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS_M * math.asin(math.sqrt(a))
+
+
+def atomic_write(path, data):
+    temp_path = "%s.%d.tmp" % (path, threading.get_ident())
+    with open(temp_path, 'wb') as f:
+        f.write(data)
+    os.replace(temp_path, path)
+
+
+class MapRenderer:
+    """Renders car location maps on a worker thread, only when the car has moved"""
+
+    def __init__(self, cache_folder):
+        self.cache_folder = cache_folder
+        self._lock = threading.Lock()
+        self._wakeup = threading.Condition(self._lock)
+        # image path -> (lat, lon, api key) still to be drawn, only the latest position per image is kept
+        self._pending = {}
+        # image path -> (lat, lon) of the last map drawn or queued
+        self._last = {}
+        self._thread = None
+        self._stopping = False
+        self.maps_downloaded = 0
+        self.maps_from_cache = 0
+
+    def request(self, image_path, lat, lon, api_key, min_distance=DEFAULT_MOVE_DISTANCE):
+        """Queue a map for the position if the car moved far enough, returns True if one was queued"""
+        lat = float(lat)
+        lon = float(lon)
+        with self._lock:
+            last = self._last.get(image_path)
+            if last is not None and distance_m(last[0], last[1], lat, lon) < min_distance:
+                return False
+            self._last[image_path] = (lat, lon)
+            self._pending[image_path] = (lat, lon, api_key)
+            if self._thread is None:
+                self._stopping = False
+                self._thread = threading.Thread(target=self._run, name="JLRMap", daemon=True)
+                self._thread.start()
+            self._wakeup.notify()
+        return True
+
+    def stop(self):
+        with self._lock:
+            self._stopping = True
+            self._wakeup.notify()
+
+    def _run(self):
+        while True:
+            with self._lock:
+                while not self._pending and not self._stopping:
+                    self._wakeup.wait()
+                if self._stopping:
+                    self._thread = None
+                    return
+                image_path, (lat, lon, api_key) = self._pending.popitem()
+            try:
+                self._render(image_path, lat, lon, api_key)
+            except Exception as e:
+                logger.error("Error writing Car Location Map Image: %s" % e)
+                with self._lock:
+                    # Try again on the next poll rather than waiting for the car to move
+                    self._last.pop(image_path, None)
+
+    def _render(self, image_path, lat, lon, api_key):
+        lat = round(lat, CACHE_PRECISION)
+        lon = round(lon, CACHE_PRECISION)
+        cache_path = os.path.join(self.cache_folder, "{:.{p}f}_{:.{p}f}.jpg".format(lat, lon, p=CACHE_PRECISION))
+        if os.path.exists(cache_path):
+            with open(cache_path, 'rb') as f:
+                data = f.read()
+            self.maps_from_cache += 1
+            logger.debug("Using cached map %s" % cache_path)
+        else:
+            r = requests.get(MAPQUEST_URL.format(lat, lon, api_key), timeout=MAP_TIMEOUT)
+            r.raise_for_status()
+            data = r.content
+            self.maps_downloaded += 1
+            if not os.path.isdir(self.cache_folder):
+                os.makedirs(self.cache_folder)
+            atomic_write(cache_path, data)
+            self._prune_cache()
+        atomic_write(image_path, data)
+        logger.debug("Writing Car Location Image %s" % image_path)
+
+    def _prune_cache(self):
+        """Keep the cache to MAX_CACHED_MAPS images, dropping the least recently written"""
+        names = [name for name in os.listdir(self.cache_folder) if name.endswith(".jpg")]
+        if len(names) <= MAX_CACHED_MAPS:
+            return
+        paths = sorted((os.path.join(self.cache_folder, name) for name in names), key=os.path.getmtime)
+        for path in paths[:len(paths) - MAX_CACHED_MAPS]:
+            os.remove(path)
@@ -0,0 +1,184 @@
+""" Lightweight performance statistics for the JLR InControl plugin
+
+Counts, errors, bytes (decoded and as transferred) and a latency histogram for every JLR endpoint (fed
+by jlrpy through jlrpy.set_metrics), and timings for the phases of each vehicle poll. Histograms use
+fixed, roughly logarithmic buckets so recording is a counter increment and p50/p95/p99 are read off the
+buckets. While disabled, phase() hands back a shared do-nothing timer (unless the caller wants the
+poll's own timings) and nothing is recorded.
+"""
+
+import bisect
+import datetime
+import json
+import os
+import re
+import threading
+import time
+
+# Bucket upper bounds in seconds, 0.1ms to ~2 minutes in steps of about 25%
+BUCKETS = tuple(0.0001 * 1.25 ** i for i in range(64))
+PERCENTILES = (50, 95, 99)
+# Path segments that identify a vehicle, user, service or trip, folded so one endpoint is one entry
+ID_AFTER = frozenset(('vehicles', 'users', 'services', 'trips', 'clients'))
+NUMBER = re.compile(r'^-?[\d.]+$')
+
+
+def endpoint_name(method, url):
+    """Endpoint a request belongs to, such as 'GET if9 vehicles/*/status'"""
+    path = url.split('://', 1)[-1].split('?', 1)[0]
+    segments = path.split('/')[1:]
+    service = segments[0] if segments else ''
+    # Drop the service and the /jlr/ that follows it
+    segments = segments[2:]
+    for i in range(len(segments)):
+        if (i > 0 and segments[i - 1] in ID_AFTER) or NUMBER.match(segments[i]):
+            segments[i] = '*'
+    return "%s %s %s" % (method, service, '/'.join(segments))
+
+
+class Histogram:
+    """Latency counts in the fixed BUCKETS"""
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, seconds):
+        self.counts[bisect.bisect_left(BUCKETS, seconds)] += 1
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def percentile(self, p):
+        """Upper bound of the bucket holding the p-th percentile, never more than the slowest seen"""
+        if not self.count:
+            return 0.0
+        rank = self.count * p / 100.0
+        seen = 0
+        for i, n in enumerate(self.counts):
+            seen += n
+            if seen >= rank:
+                return min(BUCKETS[i] if i < len(BUCKETS) else self.max, self.max)
+        return self.max
+
+    def summary(self):
+        result = {'count': self.count,
+                  'mean_ms': round(self.total / self.count * 1000, 1) if self.count else 0.0,
+                  'max_ms': round(self.max * 1000, 1)}
+        for p in PERCENTILES:
+            result['p%d_ms' % p] = round(self.percentile(p) * 1000, 1)
+        return result
+
+
+class EndpointStats:
+    def __init__(self):
+        self.latency = Histogram()
+        self.errors = 0
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        # Received bytes as transferred, less than bytes_received for compressed responses
+        self.bytes_wire = 0
+
+    def summary(self):
+        result = self.latency.summary()
+        result.update({'errors': self.errors, 'bytes_sent': self.bytes_sent, 'bytes_received': self.bytes_received,
+                       'bytes_wire': self.bytes_wire})
+        return result
+
+
+class _NoTimer:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+NO_TIMER = _NoTimer()
+
+
+class _PhaseTimer:
+    def __init__(self, metrics, name, timings):
+        self.metrics = metrics
+        self.name = name
+        self.timings = timings
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        seconds = time.perf_counter() - self.started
+        if self.metrics.enabled:
+            self.metrics.record_phase(self.name, seconds)
+        if self.timings is not None:
+            self.timings[self.name] = seconds
+        return False
+
+
+class Metrics:
+    """Per endpoint request statistics and per phase poll timings"""
+
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.since = datetime.datetime.now()
+            self._endpoints = {}
+            self._phases = {}
+
+    def request(self, method, url, seconds, sent, received, error, wire=None):
+        """Record one request to the JLR servers, called by jlrpy
+
+        received is the size of the decoded response body and wire its size as transferred, if different.
+        """
+        if not self.enabled:
+            return
+        name = endpoint_name(method, url)
+        with self._lock:
+            stats = self._endpoints.get(name)
+            if stats is None:
+                stats = self._endpoints[name] = EndpointStats()
+            stats.latency.add(seconds)
+            stats.bytes_sent += sent
+            stats.bytes_received += received
+            stats.bytes_wire += received if wire is None else wire
+            if error:
+                stats.errors += 1
+
+    def phase(self, name, timings=None):
+        """Context manager timing one phase of a poll, the time is also put in timings[name] if given"""
+        if not self.enabled and timings is None:
+            return NO_TIMER
+        return _PhaseTimer(self, name, timings)
+
+    def record_phase(self, name, seconds):
+        with self._lock:
+            histogram = self._phases.get(name)
+            if histogram is None:
+                histogram = self._phases[name] = Histogram()
+            histogram.add(seconds)
+
+    def snapshot(self):
+        """The statistics so far as plain dicts, ready for json"""
+        with self._lock:
+            return {'enabled': self.enabled,
+                    'since': self.since.isoformat(),
+                    'endpoints': {name: stats.summary() for name, stats in sorted(self._endpoints.items())},
+                    'phases': {name: h.summary() for name, h in sorted(self._phases.items())}}
+
+    def dump(self, path, extra=None):
+        """Write the snapshot, with any extra sections, to a json file"""
+        data = self.snapshot()
+        data.update(extra or {})
+        temp_path = path + ".tmp"
+        with open(temp_path, 'w') as f:
+            json.dump(data, f, indent=2, sort_keys=True)
+        os.replace(temp_path, path)
+        return data
@@ -10,16 +10,40 @@
 # Imports
 ################################################################################
 import indigo
-import requests
-import json
+import os
+import threading
 import time as t
+from concurrent.futures import ThreadPoolExecutor
 import jlrpy
+import accounts
+import scheduler
+import states
+import transforms
+import mapworker
+import commands
+import cassette
+import metrics
+import profiling
+import trips
+import history
+import charging
+import geofence
 
 ################################################################################
 # Globals
 ################################################################################
-kpaInPSI = 0.145038
-kpaInBar = 0.01
+# Worker threads shared by all vehicle polls, and the seconds between starting each vehicle's poll
+maxPollWorkers = 8
+pollStaggerSeconds = 2
+# Seconds between checks for vehicles that are due a poll
+schedulerTick = 5
+# Worker threads for the concurrent endpoint calls within each vehicle poll
+maxFetchWorkers = 12
+# Overall seconds a vehicle poll may spend fetching before the outstanding endpoints count as failed
+pollDeadlineSeconds = 120
+# Shortest JLR request timeout (seconds) accepted, and the timeout earlier versions shipped as their default
+minRequestTimeout = 1.0
+legacyRequestTimeout = "1"
 
 
 ####################################
@@ -51,14 +75,120 @@ class Plugin(indigo.PluginBase):
         super(Plugin, self).__init__(pluginId, pluginDisplayName, pluginVersion, pluginPrefs)
         self.debug = pluginPrefs.get("showDebugInfo", False)
         self.deviceList = []
+        # Installs from before the timeout default was raised still have the old 1 second stored, which times
+        # out perfectly good requests whenever the JLR servers are busy
+        if str(pluginPrefs.get('requeststimeout', "")).strip() == legacyRequestTimeout:
+            pluginPrefs['requeststimeout'] = str(jlrpy.DEFAULT_TIMEOUT)
+            indigo.server.log("JLR request timeout raised from " + legacyRequestTimeout + " to " +
+                              str(jlrpy.DEFAULT_TIMEOUT) + " seconds")
+        # One long-lived, authenticated jlrpy connection per InControl account, with the refresh token and
+        # device id kept in the plugin's own data folder so a restart does not need a password login
+        self.accounts = accounts.ConnectionManager(
+            accounts.TokenStore(os.path.join(self.pluginDataFolder(), "tokens.json")),
+            self.requestTimeout(pluginPrefs), self.statusMaxAge(pluginPrefs))
+        # Vehicles are polled in parallel on a bounded pool, never more than one poll per device at a time. It is
+        # made here as Indigo starts the devices, and queues their first polls, before runConcurrentThread
+        self.pollExecutor = ThreadPoolExecutor(max_workers=maxPollWorkers, thread_name_prefix="JLRPoll")
+        self.fetchExecutor = ThreadPoolExecutor(max_workers=maxFetchWorkers, thread_name_prefix="JLRFetch")
+        # Trip routes are downloaded one vehicle at a time off the poll path, at most one job queued per vehicle
+        self.routeExecutor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="JLRRoutes")
+        self.routeJobs = set()
+        self.pollLock = threading.Lock()
+        self.pollsInFlight = set()
+        self.accountSemaphores = {}
+        # Each vehicle's next poll time is picked from what the car is doing
+        self.scheduler = scheduler.PollScheduler(pluginPrefs)
+        # Near-static endpoints such as the vehicle attributes are only downloaded on their own cadence
+        self.endpointCache = scheduler.EndpointCache()
+        # Indigo state writes from the poll workers are serialised through this lock, and only states that
+        # changed since the last write are sent
+        self.stateLock = threading.Lock()
+        self.stateCache = states.StateCache()
+        # Formatters for the vehicle status keys, rebuilt when the preferences change
+        self.stateTransform = transforms.StateTransform(pluginPrefs, transforms.declared_states())
+        # Car location maps are drawn off the poll thread, with images cached by position
+        self.mapRenderer = mapworker.MapRenderer(os.path.join(self.pluginDataFolder(), "maps"))
+        # Vehicle commands are queued and followed through to completion by a worker per vehicle
+        self.commandQueue = commands.CommandQueue(self.runCommandWithVehicle, self.publishCommand,
+                                                  lambda deviceId: indigo.devices[deviceId].states,
+                                                  self.coalesceWindow(pluginPrefs))
+        # JLR traffic is recorded to a redacted cassette while switched on from the plugin menu
+        self.recorder = None
+        # Request and poll phase timings, only collected while switched on in the plugin config
+        self.metrics = metrics.Metrics(pluginPrefs.get('collectPerformanceStats', False))
+        jlrpy.set_metrics(self.metrics if self.metrics.enabled else None)
+        # cProfile capture of the next few polls from the plugin menu, and logging of slow polls
+        self.profiler = profiling.PollProfiler(os.path.join(self.pluginDataFolder(), "profiles"),
+                                               self.slowPollThreshold(pluginPrefs))
+        if not os.path.isdir(self.pluginDataFolder()):
+            os.makedirs(self.pluginDataFolder())
+        # Trip history kept locally and synced incrementally, the latest trip is shown in the device states
+        self.tripStore = trips.TripStore(os.path.join(self.pluginDataFolder(), "trips.sqlite"))
+        # Numeric states of every poll kept as time series with minute, hour and day rollups
+        self.history = history.StateHistory(os.path.join(self.pluginDataFolder(), "history.sqlite"))
+        # Charge rate, energy added and time to the target SoC worked out from successive polls
+        self.chargeTracker = charging.ChargeTracker()
+        # Geofence zones from the plugin config, with the zones each vehicle is in and the triggers on them
+        self.geofences = geofence.GeofenceTracker(pluginPrefs.get('geofences', ""))
+        self.triggers = {}
+
+    ########################################
+    def pluginDataFolder(self):
+        # Folder for files the plugin keeps between restarts
+        return "{}/Preferences/Plugins/{}".format(indigo.server.getInstallFolderPath(), self.pluginId)
+
+    ########################################
+    @staticmethod
+    def requestTimeout(prefs):
+        # Socket timeout in seconds for every request to the JLR servers
+        try:
+            return max(minRequestTimeout, float(prefs.get('requeststimeout', jlrpy.DEFAULT_TIMEOUT)))
+        except ValueError:
+            return jlrpy.DEFAULT_TIMEOUT
+
+    ########################################
+    @staticmethod
+    def statusMaxAge(prefs):
+        # Seconds a downloaded vehicle status is reused, so a poll and a command close together share it
+        try:
+            return max(0.0, float(prefs.get('statusMaxAge', jlrpy.STATUS_MAX_AGE)))
+        except ValueError:
+            return jlrpy.STATUS_MAX_AGE
+
+    ########################################
+    @staticmethod
+    def slowPollThreshold(prefs):
+        # Polls taking longer than this many seconds are logged with their phase timings, 0 for never
+        try:
+            return max(0.0, float(prefs.get('slowPollThreshold', 0)))
+        except ValueError:
+            return 0.0
+
+    ########################################
+    def shutdown(self):
+        self.debugLog("Shutting down")
+        self.pollExecutor.shutdown(wait=False)
+        self.fetchExecutor.shutdown(wait=False)
+        self.routeExecutor.shutdown(wait=False)
+        self.mapRenderer.stop()
+        self.commandQueue.stop()
+        self.tripStore.close()
+        self.history.close()
+        if self.recorder is not None:
+            self.toggleRecording()
 
     ########################################
     def deviceStartComm(self, device):
         self.debugLog("Starting device: " + device.name)
         self.debugLog(str(device.id) + " " + device.name)
         device.stateListOrDisplayStateIdChanged()
+        self.stateCache.forget(device.id)
+        self.chargeTracker.forget(device.id)
+        self.geofences.forget(device.id)
         if device.id not in self.deviceList:
-            self.update(device)
+            self.updateDeviceStates(device, [{'key': 'deviceIsOnline', 'value': True, 'uiValue': "Starting"}])
+            # First poll on the poll workers, behind any poll of this vehicle still running from before a restart
+            self.schedulePoll(device.id)
             self.deviceList.append(device.id)
 
     ########################################
@@ -66,163 +196,375 @@ class Plugin(indigo.PluginBase):
         self.debugLog("Stopping device: " + device.name)
         if device.id in self.deviceList:
             self.deviceList.remove(device.id)
+        self.scheduler.forget(device.id)
+        self.endpointCache.clear(device.id)
+        self.stateCache.forget(device.id)
 
     ########################################
     def runConcurrentThread(self):
         self.debugLog("Starting concurrent thread")
-        try:
-            pollingFreq = int(self.pluginPrefs['pollingFrequency'])
-        except:
-            pollingFreq = 60
         try:
             while True:
-                # we sleep (by a user defined amount, default 60s) first because when the plugin starts, each device
-                # is updated as they are started.
-                self.sleep(1 * pollingFreq)
-                # now we cycle through each vehicle device
-                for deviceId in self.deviceList:
-                    # call the update method with the device instance
-                    self.update(indigo.devices[deviceId])
+                # each device is updated as it is started, after that the scheduler decides when each one is due
+                self.sleep(schedulerTick)
+                # now we hand each due vehicle device to the poll workers, staggered so the calls don't all go at once
+                due = self.scheduler.due(list(self.deviceList))
+                # A profiling capture counts whole passes, with every poll handed out in them
+                cycle = self.profiler.begin_cycle(len(due))
+                for index, deviceId in enumerate(due):
+                    if index:
+                        self.sleep(pollStaggerSeconds)
+                    with self.profiler.poll_capture(cycle):
+                        self.schedulePoll(deviceId, cycle)
         except self.StopThread:
             pass
+        finally:
+            self.pollExecutor.shutdown(wait=False)
 
     ########################################
-    def update(self, device):
+    def schedulePoll(self, deviceId, cycle=None):
+        with self.pollLock:
+            if deviceId in self.pollsInFlight:
+                # Still busy with the last poll of this vehicle, skip rather than stack another behind it
+                self.debugLog("Poll of device " + str(deviceId) + " still running, skipping")
+                skipped = True
+            else:
+                self.pollsInFlight.add(deviceId)
+                skipped = False
+        if skipped:
+            self.profiledPollDone(cycle)
+            return
+        self.pollExecutor.submit(self.pollDevice, deviceId, cycle)
+
+    ########################################
+    def pollDevice(self, deviceId, cycle=None):
+        scheduled = False
         try:
-            c = jlrpy.Connection(self.pluginPrefs['InControlEmail'], self.pluginPrefs['InControlPassword'])
-            # The Car ID from the device defintion maps to the relevant car if multiple cars on one account
-            # Adjust for index starting at 0
-        except:
-            indigo.server.log("Failed to Contact JLR In Control Servers")
-            return ()
+            with self.accountSemaphore(self.pluginPrefs['InControlEmail']):
+                # call the update method with the device instance, the poll schedules the next one itself
+                self.update(indigo.devices[deviceId], cycle)
+                scheduled = True
+        except Exception as e:
+            self.errorLog("Error polling device " + str(deviceId) + ": " + str(e))
+        finally:
+            try:
+                if not scheduled:
+                    self.recordPoll(deviceId, False)
+            except Exception as e:
+                self.errorLog("Error scheduling device " + str(deviceId) + ": " + str(e))
+            with self.pollLock:
+                self.pollsInFlight.discard(deviceId)
+            self.profiledPollDone(cycle)
+
+    ########################################
+    def profiledPollDone(self, cycle):
+        # Log the profile once the last poll of the last profiled cycle has finished
+        profile = self.profiler.poll_done(cycle)
+        if profile:
+            path, summary = profile
+            indigo.server.log("Profile of the last poll cycles written to " + path)
+            for line in summary.splitlines():
+                if line.strip():
+                    indigo.server.log(line)
+
+    ########################################
+    def recordPoll(self, deviceId, success):
+        # Schedule a vehicle whose poll did not get as far as writing its states
+        device = indigo.devices[deviceId]
+        self.updateDeviceStates(device, self.scheduleStates(device, [], success))
+
+    ########################################
+    def scheduleStates(self, device, device_states, success):
+        # Work out when the vehicle is next due from the states a poll is about to write, the next poll
+        # states then go to Indigo in the same write as the rest
+        current = dict(device.states)
+        current.update((state['key'], state['value']) for state in device_states)
+        due, reason = self.scheduler.record(device.id, current, success)
+        self.debugLog(device.name + " next poll " + t.strftime("%H:%M:%S", t.localtime(due)) + " (" + reason + ")")
+        return [
+            {'key': 'nextPollDue', 'value': t.strftime("%m/%d/%Y at %H:%M:%S", t.localtime(due))},
+            {'key': 'nextPollReason', 'value': reason}]
+
+    ########################################
+    def accountSemaphore(self, email):
+        # Caps the number of vehicles polled at once on a single InControl account
+        with self.pollLock:
+            if email not in self.accountSemaphores:
+                try:
+                    limit = max(1, int(self.pluginPrefs.get('accountPollConcurrency', 2)))
+                except ValueError:
+                    limit = 2
+                self.accountSemaphores[email] = threading.BoundedSemaphore(limit)
+            return self.accountSemaphores[email]
+
+    ########################################
+    def updateDeviceStates(self, device, device_states):
+        with self.stateLock:
+            changed = self.stateCache.changes(device.id, device_states)
+            if not changed:
+                return
+            device.updateStatesOnServer(changed)
+            self.stateCache.commit(device.id, changed)
+
+    ########################################
+    def logRateLimits(self):
+        # Requests held back by the per account JLR request budget, with the queue depth and time waited
+        if not self.debug:
+            return
+        for account, services in jlrpy.rate_limit_stats().items():
+            for service, stats in services.items():
+                if stats['delayed']:
+                    self.debugLog("Rate limit " + service + ": " + str(stats['depth']) + " waiting (max " +
+                                  str(stats['max_depth']) + "), " + str(stats['delayed']) + " of " +
+                                  str(stats['acquired']) + " requests delayed, " +
+                                  "%.1fs total wait, %.1fs longest" % (stats['wait_time'], stats['max_wait']))
+
+    ########################################
+    def runWithVehicle(self, device, func, resend=True):
+        # Run func(vehicle) on the shared connection for the account, the manager logs in again if the
+        # tokens are rejected part way through
+        # The Car ID from the device defintion maps to the relevant car if multiple cars on one account
+        # Adjust for index starting at 0
         vehicle_num = int(device.pluginProps['CarID']) - 1
-        v = c.vehicles[vehicle_num]
-        device.updateStateOnServer('deviceIsOnline', value=True, uiValue="Starting")
+        return self.accounts.run(self.pluginPrefs['InControlEmail'], self.pluginPrefs['InControlPassword'],
+                                 lambda c: func(c.vehicles[vehicle_num]), resend)
+
+    ########################################
+    def fetchVehicleData(self, device):
+        # The endpoints are independent, so fetch them at the same time and let each one fail on its own.
+        # Returns the results, cached ones included, and the names of the endpoints fetched this time
+        endpoints = {
+            'status': lambda v: v.get_status_snapshot(),
+            'attributes': lambda v: v.get_attributes(),
+            'position': lambda v: v.get_position(),
+            'trips': lambda v: self.tripStore.sync(v.vin, v.get_trips),
+        }
+        futures = {}
+        results = {}
+        fetched = set()
+        for name, func in endpoints.items():
+            cached = self.endpointCache.get(device.id, name)
+            if cached is not None:
+                results[name] = cached
+            else:
+                futures[name] = self.fetchExecutor.submit(self.profiler.wrap(self.runWithVehicle), device, func)
+        deadline = t.time() + pollDeadlineSeconds
+        for name, future in futures.items():
+            try:
+                results[name] = future.result(timeout=max(0, deadline - t.time()))
+                self.endpointCache.put(device.id, name, results[name])
+                if results[name]:
+                    fetched.add(name)
+            except Exception as e:
+                self.debugLog("Failed to fetch " + name + " for " + device.name + ": " + str(e))
+                results[name] = None
+        if 'trips' in fetched:
+            self.queueRouteSync(device)
+        return results, fetched
+
+    ########################################
+    def queueRouteSync(self, device):
+        # After a trip sync, download the routes of the newest trips without one in the background, if they
+        # are wanted and the vehicle has no route job waiting already
+        if not self.pluginPrefs.get('downloadTripRoutes', False):
+            return
+        with self.pollLock:
+            if device.id in self.routeJobs:
+                return
+            self.routeJobs.add(device.id)
+        self.routeExecutor.submit(self.syncRoutes, device)
+
+    ########################################
+    def syncRoutes(self, device):
+        # Route pages wait behind the polls and commands for the account's request budget
+        try:
+            with jlrpy.request_priority(jlrpy.PRIORITY_BACKGROUND):
+                self.runWithVehicle(device, self.downloadRoutes)
+        except Exception as e:
+            self.debugLog("Failed to download trip routes for " + device.name + ": " + str(e))
+        finally:
+            with self.pollLock:
+                self.routeJobs.discard(device.id)
+
+    ########################################
+    def downloadRoutes(self, vehicle):
+        for tripId in self.tripStore.missing_routes(vehicle.vin):
+            points = self.tripStore.sync_route(vehicle.vin, tripId, vehicle.get_trip)
+            self.debugLog("Downloaded " + str(points) + " route points of trip " + str(tripId))
 
-        user_info = c.get_user_info()
-        status = v.get_status()['vehicleStatus']['coreStatus']
+    ########################################
+    def update(self, device, cycle=None):
+        # Profiled when the scheduler pass it came from is one of the cycles of a capture started from the
+        # plugin menu, and timed phase by phase when slow polls are being logged
+        timings = {} if self.profiler.slow_threshold else None
+        polled = t.perf_counter()
+        with self.profiler.poll_capture(cycle):
+            success = self.pollVehicle(device, timings)
+        polled = t.perf_counter() - polled
+        if self.metrics.enabled:
+            self.metrics.record_phase('poll', polled)
+        self.debugLog("Updated " + device.name + " in %.2fs" % polled)
+        slow = self.profiler.record_poll(device.name, polled, timings)
+        if slow:
+            indigo.server.log(slow)
+        return success
+
+    ########################################
+    def pollVehicle(self, device, timings=None):
+        vehicle_num = int(device.pluginProps['CarID']) - 1
+        with self.metrics.phase('fetch', timings):
+            results, fetched = self.fetchVehicleData(device)
+        # Cached endpoints still fill in the states, but only a live status or position counts as reaching JLR
+        if not fetched & {'status', 'position'}:
+            indigo.server.log("Failed to Contact JLR In Control Servers")
+            if jlrpy.backing_off():
+                offline = [{'key': 'deviceIsOnline', 'value': False, 'uiValue': "Backing off"}]
+            else:
+                offline = [{'key': 'deviceIsOnline', 'value': False, 'uiValue': "Offline"}]
+            self.updateDeviceStates(device, offline + self.scheduleStates(device, offline, False))
+            return False
+        snapshot = results['status']
+        status = snapshot.core if snapshot else []
         self.debugLog(status)
-        self.debugLog("and the second one ------------")
-        evstatus = v.get_status()['vehicleStatus']['evStatus']
+        evstatus = snapshot.ev if snapshot else []
         self.debugLog(evstatus)
-        attributes = v.get_attributes()
-        location = v.get_position()
+        attributes = results['attributes']
+        location = results['position']
+        latestTrip = results['trips']
         # reverse geocode call appears to be broken in jlpr
         # revgeocode = c.reverse_geocode(location['position']['latitude'],location['position']['longitude'] )
         self.debugLog("Updating device: " + device.name)
         # states = []
         # states.append({ 'key' : "address", 'value' : v['vin']})
-        device_states = []
         # Update Vehicle Status
-        #for d in v.get_status()['vehicleStatus']:
-        for d in evstatus:
-            if d['key'] == 'EV_STATE_OF_CHARGE':
-                device_states.append({'key': d['key'], 'value': d['value'], 'uiValue': (d['value'] + '%')})
-            elif d['key'] == "EV_CHARGING_RATE_SOC_PER_HOUR":
-                device_states.append({'key': d['key'], 'value': d['value'], 'uiValue': (d['value'] + '%')})
-            elif d['key'] == "EV_MINUTES_TO_FULLY_CHARGED":
-                hours = '{:02d}:{:02d}m'.format(*divmod(int(d['value']), 60))
-                device_states.append({'key': d['key'], 'value': d['value'], 'uiValue': hours})
-            elif d['key'] == "EV_CHARGING_STATUS":
-                if d['value'] == "No Message":
-                    uicharge = "Not Connected"
-                else:
-                    uicharge = d['value']
-                    device_states.append({'key': d['key'], 'value': d['value'], 'uiValue': uicharge})
-            elif d['key'] == "EV_RANGE_VSC_REVISED_HV_BATT_ENERGYx100":
-                device_states.append({'key': d['key'], 'value': d['value'], 'uiValue': (d['value'] + ' kWh')})
-            else:
-                device_states.append({'key': d['key'], 'value': d['value']})
-
-        for d in status:
-            if d['key'] == 'EV_STATE_OF_CHARGE':
-                 device_states.append({'key': d['key'], 'value': d['value'], 'uiValue': (d['value'] + '%')})
-            elif d['key'] == "EV_CHARGING_RATE_SOC_PER_HOUR":
-                 device_states.append({'key': d['key'], 'value': d['value'], 'uiValue': (d['value'] + '%')})
-            elif d['key'] == "EV_MINUTES_TO_FULLY_CHARGED":
-                 hours = '{:02d}:{:02d}m'.format(*divmod(int(d['value']), 60))
-                 device_states.append({'key': d['key'], 'value': d['value'], 'uiValue': hours})
-            elif d['key'] == "EV_CHARGING_STATUS":
-                 if d['value'] == "No Message":
-                     uicharge = "Not Connected"
-                 else:
-                     uicharge = d['value']
-                     device_states.append({'key': d['key'], 'value': d['value'], 'uiValue': uicharge})
-            elif d['key'] == "THEFT_ALARM_STATUS":
-                 if d['value'] == "ALARM_ARMED":
-                     uialarm = "Armed"
-                 elif d['value'] == "ALARM_OFF":
-                     uialarm = "Not Armed"
-                 else:
-                     uialarm = d['value']
-                 device_states.append({'key': d['key'], 'value': d['value'], 'uiValue': uialarm})
-            elif d['key'] == "EV_RANGE_VSC_REVISED_HV_BATT_ENERGYx100":
-                 device_states.append({'key': d['key'], 'value': d['value'], 'uiValue': (d['value'] + ' kWh')})
-            elif "TYRE_PRESSURE" in d['key']:
-                 if self.pluginPrefs['pressureunit'] == "Bar":
-                     convertedpressure = round(float(d['value']) * kpaInBar, 1)
-                     uipressure = str(convertedpressure) + " Bar"
-                 else:
-                     convertedpressure = round(float(d['value']) * kpaInPSI, 1)
-                     uipressure = str(convertedpressure) + " Psi"
-                 device_states.append({'key': d['key'], 'value': d['value'], 'uiValue': uipressure})
-            elif d['key'] == "DOOR_IS_ALL_DOORS_LOCKED":
-                 if d['value']:
-                     uilock = "Locked"
-                 else:
-                     uilock = "Unlocked"
-                 device_states.append({'key': d['key'], 'value': d['value'], 'uiValue': uilock})
-            else:
-                 device_states.append({'key': d['key'], 'value': d['value']})
-        device_states.append({'key': 'modelYear', 'value': attributes['modelYear']})
-        device_states.append({'key': 'vehicleBrand', 'value': attributes['vehicleBrand']})
-        device_states.append({'key': 'fuelType', 'value': attributes['fuelType']})
-        device_states.append({'key': 'vehicleType', 'value': attributes['vehicleType']})
-        device_states.append({'key': 'nickname', 'value': attributes['nickname']})
-        device_states.append({'key': 'exteriorColorName', 'value': attributes['exteriorColorName']})
-        device_states.append({'key': 'registrationNumber', 'value': attributes['registrationNumber']})
-        device_states.append({'key': 'bodyType', 'value': attributes['bodyType']})
-        device_states.append({'key': 'longitude', 'value': location['position']['longitude']})
-        device_states.append({'key': 'latitude', 'value': location['position']['latitude']})
-        device_states.append({'key': 'speed', 'value': location['position']['speed']})
-        device_states.append({'key': 'heading', 'value': location['position']['heading']})
-        # device_states.append({ 'key': 'geoaddress' , 'value' : revgeocode['formattedAddress'] })
-        # self.debugLog(device_states)
-        self.debugLog("States Updated - Generating Map")
-        baseurl = "https://www.mapquestapi.com/staticmap/v5/map?locations="
-        locationsection = str(location['position']['latitude']) + "," + str(location['position']['longitude'])
-        sizeandapikey = "&size=@2x&key=" + self.pluginPrefs['mapAPIkey']
-        mapurl = baseurl + locationsection + sizeandapikey
-        # url = "https://www.mapquestapi.com/staticmap/v5/map?locations="+str(location['position']['latitude'])+","+str(location['position']['longitude'])+"&size=@2x&key="+self.pluginPrefs['mapAPIkey']
-        imagepath = "{}/IndigoWebServer/images/controls/static/carlocation{}.jpg".format(
-            indigo.server.getInstallFolderPath(), str(vehicle_num + 1))
-        self.debugLog(imagepath)
-        if self.pluginPrefs['useMapAPI']:
-            try:
-                r = requests.get(mapurl, timeout=0.5)
-                if r.status_code == 200:
-                    with open(imagepath, 'wb') as f:
-                        f.write(r.content)
-                        self.debugLog("Writing Car Location Image")
-            except:
-                indigo.server.log("Error writing Car Location Map Image")
+        with self.metrics.phase('transform', timings):
+            device_states = self.stateTransform.transform(evstatus + status)
+        if attributes:
+            device_states.append({'key': 'modelYear', 'value': attributes['modelYear']})
+            device_states.append({'key': 'vehicleBrand', 'value': attributes['vehicleBrand']})
+            device_states.append({'key': 'fuelType', 'value': attributes['fuelType']})
+            device_states.append({'key': 'vehicleType', 'value': attributes['vehicleType']})
+            device_states.append({'key': 'nickname', 'value': attributes['nickname']})
+            device_states.append({'key': 'exteriorColorName', 'value': attributes['exteriorColorName']})
+            device_states.append({'key': 'registrationNumber', 'value': attributes['registrationNumber']})
+            device_states.append({'key': 'bodyType', 'value': attributes['bodyType']})
+        if location:
+            device_states.append({'key': 'longitude', 'value': location['position']['longitude']})
+            device_states.append({'key': 'latitude', 'value': location['position']['latitude']})
+            device_states.append({'key': 'speed', 'value': location['position']['speed']})
+            device_states.append({'key': 'heading', 'value': location['position']['heading']})
+            # device_states.append({ 'key': 'geoaddress' , 'value' : revgeocode['formattedAddress'] })
+            # self.debugLog(device_states)
+            if self.pluginPrefs['useMapAPI']:
+                # The map is drawn on the map worker and only when the car has moved far enough
+                imagepath = "{}/IndigoWebServer/images/controls/static/carlocation{}.jpg".format(
+                    indigo.server.getInstallFolderPath(), str(vehicle_num + 1))
+                try:
+                    moveDistance = float(self.pluginPrefs.get('mapMoveDistance', mapworker.DEFAULT_MOVE_DISTANCE))
+                except ValueError:
+                    moveDistance = mapworker.DEFAULT_MOVE_DISTANCE
+                with self.metrics.phase('map', timings):
+                    moved = self.mapRenderer.request(imagepath, location['position']['latitude'],
+                                                     location['position']['longitude'], self.pluginPrefs['mapAPIkey'],
+                                                     moveDistance)
+                if moved:
+                    self.debugLog("Car moved - Generating Map " + imagepath)
+        if latestTrip:
+            device_states.extend(self.tripStates(latestTrip))
+        with self.metrics.phase('charging', timings):
+            device_states.extend(self.chargeTracker.update(device.id, device_states,
+                                                           device.pluginProps.get('chargeTargetSoc')))
+        zoneEvents = []
+        if location:
+            with self.metrics.phase('geofence', timings):
+                zoneStates, zoneEvents = self.geofences.update(device.id, location['position']['latitude'],
+                                                               location['position']['longitude'], device.states)
+            device_states.extend(zoneStates)
         update_time = t.strftime("%m/%d/%Y at %H:%M")
         device_states.append({'key': 'deviceLastUpdated', 'value': update_time})
         # device.updateStateOnServer('deviceLastUpdated', value=update_time)
         # device.updateStateOnServer('deviceTimestamp', value=t.time())
         device_states.append({'key': 'deviceTimestamp', 'value': t.time()})
         device_states.append({'key': 'deviceIsOnline', 'value': True, 'uiValue': "Online"})
-        device.updateStatesOnServer(device_states)
+        device_states.extend(self.scheduleStates(device, device_states, True))
+        with self.metrics.phase('states', timings):
+            self.updateDeviceStates(device, device_states)
+        with self.metrics.phase('history', timings):
+            self.history.record(device.id, device_states)
+        for event, zone in zoneEvents:
+            indigo.server.log(device.name + (" entered " if event == 'zoneEntered' else " left ") + zone)
+            self.fireZoneTriggers(event, device, zone)
         # device.updateStateOnServer('deviceIsOnline', value=True, uiValue="Online")
-        self.debugLog("Done Updating States and Map")
-        indigo.server.log("Upating States & Map Complete")
-        return ()
+        self.debugLog("Done Updating States")
+        self.logRateLimits()
+        return True
+
+    ########################################
+    @staticmethod
+    def tripStates(trip):
+        # Device states for the latest trip in the trip store
+        def when(seconds):
+            return t.strftime("%Y-%m-%d %H:%M", t.localtime(seconds)) if seconds else ""
+        if trip['energy_kwh'] is not None:
+            efficiencyUnit = " kWh/100km"
+        else:
+            efficiencyUnit = " l/100km"
+        duration = 0
+        if trip['start_time'] and trip['end_time']:
+            duration = int(round((trip['end_time'] - trip['start_time']) / 60.0))
+        return [
+            {'key': 'lastTripStart', 'value': when(trip['start_time'])},
+            {'key': 'lastTripEnd', 'value': when(trip['end_time'])},
+            {'key': 'lastTripDistance', 'value': round(trip['distance_km'] or 0, 1),
+             'uiValue': "%.1f km" % (trip['distance_km'] or 0)},
+            {'key': 'lastTripDuration', 'value': duration, 'uiValue': transforms.hours_minutes(duration)},
+            {'key': 'lastTripEnergy', 'value': trip['energy_kwh'] or 0,
+             'uiValue': "%.1f kWh" % (trip['energy_kwh'] or 0)},
+            {'key': 'lastTripEfficiency', 'value': trip['efficiency'] or 0,
+             'uiValue': "%.1f%s" % (trip['efficiency'] or 0, efficiencyUnit)},
+            {'key': 'lastTripEcoScore', 'value': trip['eco_score'] or 0},
+            {'key': 'lastTripEndAddress', 'value': trip['end_address'] or ""},
+        ]
+
+    ########################################
+    # Triggers
+    ########################################
+    def triggerStartProcessing(self, trigger):
+        self.debugLog("Start processing trigger " + trigger.name)
+        self.triggers[trigger.id] = trigger
+
+    def triggerStopProcessing(self, trigger):
+        self.debugLog("Stop processing trigger " + trigger.name)
+        self.triggers.pop(trigger.id, None)
+
+    def fireZoneTriggers(self, event, device, zone):
+        # Triggers on this vehicle, or any vehicle, for this zone or any zone
+        for trigger in list(self.triggers.values()):
+            if trigger.pluginTypeId != event:
+                continue
+            vehicle = trigger.pluginProps.get('vehicle', "any")
+            if vehicle not in ("any", "") and str(vehicle) != str(device.id):
+                continue
+            name = trigger.pluginProps.get('zone', "").strip()
+            if name and name.lower() != zone.lower():
+                continue
+            indigo.trigger.execute(trigger)
 
     ########################################
     # UI Validate, Device Config
     ########################################
     def validateDeviceConfigUi(self, valuesDict, typeId, device):
-        c = jlrpy.Connection(self.pluginPrefs['InControlEmail'], self.pluginPrefs['InControlPassword'])
+        if valuesDict.get('chargeTargetSoc', ""):
+            try:
+                target = float(valuesDict['chargeTargetSoc'])
+            except:
+                target = -1
+            if not 0 < target <= 100:
+                self.errorLog("Invalid entry for Charge Target - must be a percentage between 1 and 100")
+                errorsDict = indigo.Dict()
+                errorsDict['chargeTargetSoc'] = "Please enter a percentage between 1 and 100, or leave it empty"
+                return (False, valuesDict, errorsDict)
+        c = self.accounts.get(self.pluginPrefs['InControlEmail'], self.pluginPrefs['InControlPassword'])
         # The Car ID from the device defintion maps to the relevant car if multiple cars on one account
         # Adjust for index starting at 0
         self.debugLog(valuesDict)
@@ -274,13 +616,77 @@ class Plugin(indigo.PluginBase):
             errorsDict[
                 'pollingFrequency'] = "Invalid entry for JLR Polling Frequency - must be a whole number greater than 0"
             return (False, valuesDict, errorsDict)
-        if int(valuesDict['requeststimeout']) == 0:
-            self.errorLog("Invalid entry for JLR Requests Timeout - must be greater than 0")
+        for key, label in (('pollingFrequencyActive', "Polling Frequency while charging or moving"),
+                           ('pollingFrequencyIdle', "Polling Frequency when parked and idle")):
+            try:
+                frequency = int(valuesDict.get(key, 60))
+            except:
+                frequency = 0
+            if frequency < 1:
+                self.errorLog("Invalid entry for " + label + " - must be a whole number greater than 0")
+                errorsDict = indigo.Dict()
+                errorsDict[key] = "Invalid entry for " + label + " - must be a whole number greater than 0"
+                return (False, valuesDict, errorsDict)
+        try:
+            moveDistance = float(valuesDict.get('mapMoveDistance', 50))
+        except:
+            moveDistance = -1
+        if moveDistance < 0:
+            self.errorLog("Invalid entry for Map Redraw Distance - must be a number of metres")
+            errorsDict = indigo.Dict()
+            errorsDict['mapMoveDistance'] = "Invalid entry for Map Redraw Distance - must be a number of metres"
+            return (False, valuesDict, errorsDict)
+        try:
+            statusMaxAge = float(valuesDict.get('statusMaxAge', 10))
+        except:
+            statusMaxAge = -1
+        if statusMaxAge < 0:
+            self.errorLog("Invalid entry for Reuse Vehicle Status - must be a number of seconds, 0 for never")
+            errorsDict = indigo.Dict()
+            errorsDict['statusMaxAge'] = "Invalid entry for Reuse Vehicle Status - must be a number of seconds, 0 for never"
+            return (False, valuesDict, errorsDict)
+        try:
+            coalesceWindow = float(valuesDict.get('commandCoalesceWindow', 5))
+        except:
+            coalesceWindow = -1
+        if coalesceWindow < 0:
+            self.errorLog("Invalid entry for Command Coalescing Window - must be a number of seconds")
+            errorsDict = indigo.Dict()
+            errorsDict['commandCoalesceWindow'] = "Invalid entry for Command Coalescing Window - must be a number of seconds"
+            return (False, valuesDict, errorsDict)
+        try:
+            slowPoll = float(valuesDict.get('slowPollThreshold', 0))
+        except:
+            slowPoll = -1
+        if slowPoll < 0:
+            self.errorLog("Invalid entry for Slow Poll Threshold - must be a number of seconds, 0 for off")
             errorsDict = indigo.Dict()
-            errorsDict['requeststimeout'] = "Invalid entry for JLR Requests Timeout - must be greater than 0"
+            errorsDict['slowPollThreshold'] = "Invalid entry for Slow Poll Threshold - must be a number of seconds, 0 for off"
             return (False, valuesDict, errorsDict)
         try:
-            connection = jlrpy.Connection(valuesDict['InControlEmail'], valuesDict['InControlPassword'])
+            concurrency = int(valuesDict.get('accountPollConcurrency', 2))
+        except:
+            concurrency = 0
+        if concurrency < 1:
+            self.errorLog("Invalid entry for Vehicles to poll at the same time - must be a whole number greater than 0")
+            errorsDict = indigo.Dict()
+            errorsDict[
+                'accountPollConcurrency'] = "Invalid entry for Vehicles to poll at the same time - must be a whole number greater than 0"
+            return (False, valuesDict, errorsDict)
+        zoneErrors = geofence.parse_zones(valuesDict.get('geofences', ""))[1]
+        if zoneErrors:
+            self.errorLog("Invalid entry for Geofence zones - " + "; ".join(zoneErrors))
+            errorsDict = indigo.Dict()
+            errorsDict['geofences'] = "Invalid entry for Geofence zones - " + "; ".join(zoneErrors)
+            return (False, valuesDict, errorsDict)
+        if float(valuesDict['requeststimeout']) < minRequestTimeout:
+            self.errorLog("Invalid entry for JLR Requests Timeout - must be at least 1 second")
+            errorsDict = indigo.Dict()
+            errorsDict['requeststimeout'] = "Invalid entry for JLR Requests Timeout - must be at least 1 second"
+            return (False, valuesDict, errorsDict)
+        try:
+            with jlrpy.request_priority(jlrpy.PRIORITY_COMMAND):
+                connection = self.accounts.get(valuesDict['InControlEmail'], valuesDict['InControlPassword'])
         except:
             self.errorLog("Error connecting to JLR Servers - Check Email and Password")
             errorsDict = indigo.Dict()
@@ -295,6 +701,24 @@ class Plugin(indigo.PluginBase):
         self.debugLog(connection.vehicles)
         return (True, valuesDict)
 
+    ########################################
+    def closedPrefsConfigUi(self, valuesDict, userCancelled):
+        if not userCancelled:
+            # Account details may have changed, log in afresh on next use
+            self.accounts.reset()
+            self.accounts.timeout = self.requestTimeout(valuesDict)
+            self.accounts.status_max_age = self.statusMaxAge(valuesDict)
+            with self.pollLock:
+                self.accountSemaphores = {}
+            self.scheduler.configure(valuesDict)
+            self.geofences.configure(valuesDict.get('geofences', ""))
+            self.stateTransform.build(valuesDict)
+            self.commandQueue.window = self.coalesceWindow(valuesDict)
+            self.debug = valuesDict.get("showDebugInfo", False)
+            self.metrics.enabled = bool(valuesDict.get('collectPerformanceStats', False))
+            self.profiler.slow_threshold = self.slowPollThreshold(valuesDict)
+            jlrpy.set_metrics(self.metrics if self.metrics.enabled else None)
+
     ########################################
     # UI Validate, Actions
     ########################################
@@ -334,6 +758,73 @@ class Plugin(indigo.PluginBase):
             self.pluginPrefs["showDebugInfo"] = True
         self.debug = not self.debug
 
+    ########################################
+    def forceFullRefresh(self):
+        indigo.server.log("Refreshing all vehicle data from JLR")
+        self.endpointCache.clear()
+        for deviceId in list(self.deviceList):
+            self.scheduler.poll_now(deviceId)
+
+    ########################################
+    def toggleRecording(self):
+        if self.recorder is None:
+            folder = os.path.join(self.pluginDataFolder(), "cassettes")
+            if not os.path.isdir(folder):
+                os.makedirs(folder)
+            path = os.path.join(folder, t.strftime("jlr-%Y%m%d-%H%M%S.jsonl.gz"))
+            self.recorder = cassette.Recorder(path)
+            jlrpy.set_cassette(self.recorder)
+            indigo.server.log("Recording JLR traffic to " + path)
+        else:
+            jlrpy.set_cassette(None)
+            self.recorder.close()
+            indigo.server.log("Stopped recording JLR traffic, " + str(self.recorder.recorded) + " requests in " +
+                              self.recorder.path)
+            self.recorder = None
+
+    ########################################
+    def showPerformanceStats(self):
+        if not self.metrics.enabled:
+            indigo.server.log("Performance statistics are not being collected, turn them on in the plugin config")
+        path = os.path.join(self.pluginDataFolder(), "performance.json")
+        if not os.path.isdir(self.pluginDataFolder()):
+            os.makedirs(self.pluginDataFolder())
+        data = self.metrics.dump(path, {
+            'rateLimits': jlrpy.rate_limit_stats(),
+            'states': {'written': self.stateCache.states_written, 'skipped': self.stateCache.states_skipped},
+            'commands': self.commandQueue.saved(),
+            'maps': {'downloaded': self.mapRenderer.maps_downloaded, 'fromCache': self.mapRenderer.maps_from_cache},
+            'slowPolls': list(self.profiler.slow_polls),
+            'trips': {'requests': self.tripStore.requests, 'added': self.tripStore.added,
+                      'routePages': self.tripStore.route_pages},
+            'history': {'samples': self.history.samples}})
+        indigo.server.log("JLR performance since " + data['since'][:19].replace("T", " "))
+        for name, stats in list(data['endpoints'].items()) + list(data['phases'].items()):
+            line = "%-45s %6d calls  p50 %7.1fms  p95 %7.1fms  p99 %7.1fms  max %7.1fms" % (
+                name, stats['count'], stats['p50_ms'], stats['p95_ms'], stats['p99_ms'], stats['max_ms'])
+            if 'errors' in stats:
+                line += "  %d errors  %d bytes in (%d transferred)" % (stats['errors'], stats['bytes_received'],
+                                                                      stats['bytes_wire'])
+            indigo.server.log(line)
+        indigo.server.log("States written " + str(self.stateCache.states_written) + ", unchanged and skipped " +
+                          str(self.stateCache.states_skipped) + ". Commands " + self.commandQueue.saved())
+        indigo.server.log("Full statistics written to " + path)
+
+    ########################################
+    def profilePolls(self, valuesDict, typeId):
+        try:
+            cycles = int(valuesDict.get('profilePolls', profiling.DEFAULT_CYCLES))
+            top = int(valuesDict.get('profileTop', profiling.DEFAULT_TOP))
+            if cycles < 1 or top < 1:
+                raise ValueError
+        except ValueError:
+            errorsDict = indigo.Dict()
+            errorsDict['profilePolls'] = "Enter whole numbers greater than 0"
+            return (False, valuesDict, errorsDict)
+        self.profiler.start(cycles, top)
+        indigo.server.log("Profiling the next " + str(cycles) + " poll cycles")
+        return True
+
     ########################################
     # Method to populate vehicle list for device configuration menu
     ########################################    
@@ -341,9 +832,13 @@ class Plugin(indigo.PluginBase):
     def genVehicleList(self, filter, valuesDict, typeId, devID):
         device = indigo.devices[devID]
         try:
-            connection = jlrpy.Connection(self.pluginPrefs['InControlEmail'], self.pluginPrefs['InControlPassword'])
+            # The user is waiting on the config dialog, so this goes ahead of background polls
+            with jlrpy.request_priority(jlrpy.PRIORITY_COMMAND):
+                connection = self.accounts.get(self.pluginPrefs['InControlEmail'],
+                                               self.pluginPrefs['InControlPassword'])
         except:
             self.errorLog("Error connecting to JLR Servers - Check Email and Password")
+            return []
         self.debugLog("Successfully Connected to JLR Servers")
         # error is HTTPError: HTTP Error 403: Forbidden
         # Retrieve the list of vehicles from JLRpy and write out the Vehicle Identification numbers to the event log so they can match to the right car
@@ -366,60 +861,99 @@ class Plugin(indigo.PluginBase):
         indigo.server.log("VIN Can be found on the assistance tab of the InControl App")
         return vid
 
-    def honkAndBlink(self, pluginAction, dev):
+    ########################################
+    # Vehicles a geofence trigger can watch, any of them or one in particular
+    ########################################
+
+    def genTriggerVehicleList(self, filter="", valuesDict=None, typeId="", targetId=0):
+        return [("any", "Any Vehicle")] + [(str(dev.id), dev.name) for dev in indigo.devices.iter("self")]
+
+    ########################################
+    # Vehicle commands, sent in order by a per-vehicle worker so the action callbacks return straight away
+    ########################################
+    def queueCommand(self, dev, name, send, on_success=None, on_failure=None, group=None, satisfied=None):
         self.debugLog(dev)
-        c = jlrpy.Connection(self.pluginPrefs['InControlEmail'], self.pluginPrefs['InControlPassword'])
-        # The Car ID from the device defintion maps to the relevant car if multiple cars on one account
-        # Adjust for index starting at 0
-        vehicle_num = int(dev.pluginProps['CarID']) - 1
-        v = c.vehicles[vehicle_num]
-        v.honk_blink()
-        self.debugLog("Honked and Blinked")
+        self.commandQueue.submit(dev.id, commands.Command(name, send, on_success, on_failure, group, satisfied))
+        self.debugLog(name + " queued for " + dev.name)
         return ()
 
+    @staticmethod
+    def coalesceWindow(prefs):
+        # Seconds repeated or opposing commands are held so only the final intent is sent
+        try:
+            return max(0.0, float(prefs.get('commandCoalesceWindow', commands.DEFAULT_COALESCE_WINDOW)))
+        except ValueError:
+            return commands.DEFAULT_COALESCE_WINDOW
+
+    @staticmethod
+    def isCharging(states):
+        return str(states.get('EV_CHARGING_STATUS', '')).upper() == "CHARGING"
+
+    @staticmethod
+    def hasNothingToStopCharging(states):
+        return str(states.get('EV_CHARGING_STATUS', '')).upper() in ("NOTCONNECTED", "NO MESSAGE", "FULLYCHARGED")
+
+    @staticmethod
+    def isNotPreconditioning(states):
+        return str(states.get('EV_IS_PRECONDITIONING', '')).upper() == "FALSE"
+
+    def runCommandWithVehicle(self, deviceId, func, resend=True):
+        with self.profiler.capture():
+            return self.runWithVehicle(indigo.devices[deviceId], func, resend)
+
+    def publishCommand(self, deviceId, command):
+        device = indigo.devices[deviceId]
+        if command.status == commands.FAILED:
+            indigo.server.log(u"%s for \"%s\" failed: %s" % (command.name, device.name, command.error), isError=True)
+        else:
+            self.debugLog(command.name + " for " + device.name + " " + command.status)
+        self.updateDeviceStates(device, [
+            {'key': 'lastCommand', 'value': command.name},
+            {'key': 'lastCommandStatus', 'value': command.status}])
+
+    def getStateHistory(self, pluginAction, dev):
+        # Hidden action for scripts and control page charts, the history of one state of the vehicle:
+        #   indigo.server.getPlugin("com.barn.indigoplugin.JLRInControl").executeAction("getStateHistory", deviceId=dev.id,
+        #       props={'key': "EV_STATE_OF_CHARGE", 'hours': 24, 'step': 3600}, waitUntilDone=True)
+        # props: key, then start and end (epoch seconds) or hours back from now, and optionally step (seconds)
+        # with how (mean, min, max, last or count) to resample, or last for only the newest samples
+        props = pluginAction.props
+        key = props.get('key', 'EV_STATE_OF_CHARGE')
+        try:
+            end = float(props.get('end') or t.time())
+            start = float(props.get('start') or end - float(props.get('hours', 24)) * 3600)
+            step = int(props.get('step') or 0)
+            if step:
+                slots = self.history.resample(dev.id, key, start, end, step, props.get('how', 'mean'))
+                times, values = [slot[0] for slot in slots], [slot[1] for slot in slots]
+            elif props.get('last'):
+                times, values = self.history.last(dev.id, key, int(props['last']))
+            else:
+                times, values = self.history.range(dev.id, key, start, end)
+        except ValueError as e:
+            self.errorLog("Unable to read the history of " + key + " for " + dev.name + ": " + str(e))
+            return None
+        return {'key': key, 'times': list(times), 'values': list(values)}
+
+    def honkAndBlink(self, pluginAction, dev):
+        return self.queueCommand(dev, "Honk and Blink", lambda v: v.honk_blink())
+
     def startCharge(self, pluginAction, dev):
-        self.debugLog(dev)
-        c = jlrpy.Connection(self.pluginPrefs['InControlEmail'], self.pluginPrefs['InControlPassword'])
-        # The Car ID from the device defintion maps to the relevant car if multiple cars on one account
-        # Adjust for index starting at 0
-        vehicle_num = int(dev.pluginProps['CarID']) - 1
-        v = c.vehicles[vehicle_num]
-        v.charging_start()
-        self.debugLog("Charge Started")
-        return ()
+        return self.queueCommand(dev, "Start Charging", lambda v: v.charging_start(),
+                                 group="charging", satisfied=self.isCharging)
 
     def stopCharge(self, pluginAction, dev):
-        self.debugLog(dev)
-        c = jlrpy.Connection(self.pluginPrefs['InControlEmail'], self.pluginPrefs['InControlPassword'])
-        # The Car ID from the device defintion maps to the relevant car if multiple cars on one account
-        # Adjust for index starting at 0
-        vehicle_num = int(dev.pluginProps['CarID']) - 1
-        v = c.vehicles[vehicle_num]
-        v.charging_start()
-        self.debugLog("Charge Stopped")
-        return ()
+        return self.queueCommand(dev, "Stop Charging", lambda v: v.charging_stop(),
+                                 group="charging", satisfied=self.hasNothingToStopCharging)
 
     def stopClimate(self, pluginAction, dev):
-        self.debugLog(dev)
-        c = jlrpy.Connection(self.pluginPrefs['InControlEmail'], self.pluginPrefs['InControlPassword'])
-        # The Car ID from the device defintion maps to the relevant car if multiple cars on one account
-        # Adjust for index starting at 0
-        vehicle_num = int(dev.pluginProps['CarID']) - 1
-        v = c.vehicles[vehicle_num]
-        v.preconditioning_stop()
-        self.debugLog("Climate Stopped")
-        return ()
+        return self.queueCommand(dev, "Stop Climate", lambda v: v.preconditioning_stop(),
+                                 group="climate", satisfied=self.isNotPreconditioning)
 
     def startClimate(self, pluginAction, dev):
-        self.debugLog(dev)
-        c = jlrpy.Connection(self.pluginPrefs['InControlEmail'], self.pluginPrefs['InControlPassword'])
-        # The Car ID from the device defintion maps to the relevant car if multiple cars on one account
-        # Adjust for index starting at 0
-        vehicle_num = int(dev.pluginProps['CarID']) - 1
-        v = c.vehicles[vehicle_num]
-        v.preconditioning_start(pluginAction.props.get('climatetemp'))
-        self.debugLog("Climate Started at " + pluginAction.props.get('climatetemp'))
-        return ()
+        climatetemp = pluginAction.props.get('climatetemp')
+        return self.queueCommand(dev, "Start Climate at " + climatetemp, lambda v: v.preconditioning_start(climatetemp),
+                                 group="climate")
 
     ########################################
     # Relay / Dimmer Action callback
@@ -428,55 +962,25 @@ class Plugin(indigo.PluginBase):
     def actionControlDevice(self, action, dev):
         ###### TURN ON Timed Climate ######
         if action.deviceAction == indigo.kDeviceAction.TurnOn:
-            jsondata = json.dumps({"on": True})
-            try:
-                c = jlrpy.Connection(self.pluginPrefs['InControlEmail'], self.pluginPrefs['InControlPassword'])
-                # The Car ID from the device defintion maps to the relevant car if multiple cars on one account
-                # Adjust for index starting at 0
-                vehicle_num = int(dev.pluginProps['CarID']) - 1
-                v = c.vehicles[vehicle_num]
-                v.preconditioning_start(dev.pluginProps['adjustedclimateTemp'])
-                self.debugLog("Climate Started at " + dev.pluginProps['adjustedclimateTemp'])
-                sendSuccess = True
-            except:
-                sendSuccess = False
+            adjustedtemp = dev.pluginProps['adjustedclimateTemp']
 
-            if sendSuccess:
-                # If success then log that the command was successfully sent.
+            def turnedOn(command):
+                # Only once the vehicle confirms do we tell the Indigo Server to update the state.
                 indigo.server.log(u"Turned Timed Climate \"%s\" %s" % (dev.name, "on"))
+                self.updateDeviceStates(dev, [{'key': 'onOffState', 'value': True}])
 
-                # And then tell the Indigo Server to update the state.
-                dev.updateStateOnServer("onOffState", True)
-            else:
-                # Else log failure but do NOT update state on Indigo Server.
-                indigo.server.log(u"Turning Timed Climate \"%s\" to %s failed" % (dev.name, "on"), isError=True)
+            self.queueCommand(dev, "Timed Climate On", lambda v: v.preconditioning_start(adjustedtemp),
+                              on_success=turnedOn, group="climate")
 
         ###### TURN OFF Timed Climate ######
         elif action.deviceAction == indigo.kDeviceAction.TurnOff:
-            # Turn WLED off
-            jsondata = json.dumps({"on": False})
-            try:
-                c = jlrpy.Connection(self.pluginPrefs['InControlEmail'], self.pluginPrefs['InControlPassword'])
-                # The Car ID from the device defintion maps to the relevant car if multiple cars on one account
-                # Adjust for index starting at 0
-                vehicle_num = int(dev.pluginProps['CarID']) - 1
-                v = c.vehicles[vehicle_num]
-                v.preconditioning_stop()
-                self.debugLog("Climate Stopped")
-                sendSuccess = True
-            except:
-                sendSuccess = False
-
-            if sendSuccess:
-                # If success then log that the command was successfully sent.
+            def turnedOff(command):
+                # Only once the vehicle confirms do we tell the Indigo Server to update the state.
                 indigo.server.log(u"sent \"%s\" %s" % (dev.name, "off"))
+                self.updateDeviceStates(dev, [{'key': 'onOffState', 'value': False}])
 
-                # And then tell the Indigo Server to update the state:
-                dev.updateStateOnServer("onOffState", False)
-            else:
-                # Else log failure but do NOT update state on Indigo Server.
-                indigo.server.log(u"send \"%s\" %s failed" % (dev.name, "off"), isError=True)
-
+            self.queueCommand(dev, "Timed Climate Off", lambda v: v.preconditioning_stop(), on_success=turnedOff,
+                              group="climate", satisfied=self.isNotPreconditioning)
 
         ###### TOGGLE ######
         elif action.deviceAction == indigo.kDeviceAction.Toggle:
@@ -0,0 +1,145 @@
+""" On-demand profiling of the JLR InControl plugin's polls
+
+cProfile only sees the thread it is enabled in, so a capture profiles each piece of work the plugin
+hands to its threads separately (scheduler passes, vehicle polls on the poll workers, the endpoint
+fetches they hand on, command workers) and merges them into one .pstats file once the requested number
+of poll cycles has finished. A cycle is one scheduler pass and every poll it handed out, and is done
+when the last of those polls is. Profiling then switches itself off.
+
+Slow poll sampling is much cheaper and can stay on: every poll is timed phase by phase and the ones
+over a threshold are kept, with their breakdown, for the event log and the performance stats.
+"""
+
+import collections
+import contextlib
+import cProfile
+import datetime
+import io
+import itertools
+import logging
+import os
+import pstats
+import threading
+
+logger = logging.getLogger('Plugin.profiling')
+
+DEFAULT_CYCLES = 5
+DEFAULT_TOP = 25
+# Slow polls kept for the performance stats
+MAX_SLOW_POLLS = 50
+
+
+class PollProfiler:
+    """Profiles the next few polls on request and samples slow polls"""
+
+    def __init__(self, folder, slow_threshold=0):
+        self.folder = folder
+        self.slow_threshold = slow_threshold
+        self.slow_polls = collections.deque(maxlen=MAX_SLOW_POLLS)
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        # Cycles still to begin, and polls still running of each cycle that has begun
+        self._cycles_left = 0
+        self._open = {}
+        self._cycle_ids = itertools.count(1)
+        self._top = DEFAULT_TOP
+        self._profiles = []
+
+    @property
+    def active(self):
+        return self._cycles_left > 0 or bool(self._open)
+
+    def start(self, cycles=DEFAULT_CYCLES, top=DEFAULT_TOP):
+        """Profile the next poll cycles, the results are handed back by poll_done() after the last one"""
+        with self._lock:
+            self._cycles_left = max(1, cycles)
+            self._open = {}
+            self._top = top
+            self._profiles = []
+
+    def begin_cycle(self, polls):
+        """A scheduler pass is handing out polls, returns its cycle for poll_capture() and poll_done()
+
+        None when the pass is not profiled, because no capture is running or its cycles have all begun.
+        """
+        with self._lock:
+            if self._cycles_left <= 0 or polls <= 0:
+                return None
+            self._cycles_left -= 1
+            cycle = next(self._cycle_ids)
+            self._open[cycle] = polls
+            return cycle
+
+    def poll_capture(self, cycle):
+        """capture() for the work of a poll, only profiled when its scheduler pass is a profiled cycle"""
+        if cycle is None:
+            return contextlib.nullcontext()
+        return self.capture()
+
+    @contextlib.contextmanager
+    def capture(self):
+        """Profile the block if a capture is running, in whichever thread it runs"""
+        if not self.active or getattr(self._local, 'profiling', False):
+            yield
+            return
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError:
+            # Another profiler (a debugger, say) already has this thread
+            logger.debug("Unable to profile %s, already profiled" % threading.current_thread().name)
+            yield
+            return
+        self._local.profiling = True
+        try:
+            yield
+        finally:
+            profile.disable()
+            self._local.profiling = False
+            with self._lock:
+                if self.active:
+                    self._profiles.append(profile)
+
+    def wrap(self, func):
+        """func profiled with capture() when called, for work a profiled thread hands to a thread pool"""
+        if not getattr(self._local, 'profiling', False):
+            return func
+
+        def profiled(*args, **kwargs):
+            with self.capture():
+                return func(*args, **kwargs)
+        return profiled
+
+    def poll_done(self, cycle):
+        """Count a finished (or skipped) poll of a cycle, after the last poll of the last cycle return
+        (pstats path, top functions)"""
+        with self._lock:
+            if cycle not in self._open:
+                return None
+            self._open[cycle] -= 1
+            if self._open[cycle] > 0:
+                return None
+            del self._open[cycle]
+            if self.active:
+                return None
+            profiles, self._profiles = self._profiles, []
+        if not profiles:
+            return None
+        if not os.path.isdir(self.folder):
+            os.makedirs(self.folder)
+        path = os.path.join(self.folder, datetime.datetime.now().strftime("poll-%Y%m%d-%H%M%S.pstats"))
+        summary = io.StringIO()
+        stats = pstats.Stats(*profiles, stream=summary)
+        stats.dump_stats(path)
+        stats.strip_dirs().sort_stats('cumulative').print_stats(self._top)
+        return path, summary.getvalue()
+
+    def record_poll(self, name, seconds, timings):
+        """Keep a poll that took longer than the threshold, returns a description of it if it did"""
+        if not self.slow_threshold or seconds < self.slow_threshold:
+            return None
+        breakdown = ", ".join("%s %.2fs" % (phase, timings[phase]) for phase in sorted(timings or {}))
+        self.slow_polls.append({'device': name, 'at': datetime.datetime.now().isoformat(),
+                                'seconds': round(seconds, 3),
+                                'phases': {phase: round(value, 3) for phase, value in (timings or {}).items()}})
+        return "Slow poll of %s took %.2fs (%s)" % (name, seconds, breakdown or "no phases completed")
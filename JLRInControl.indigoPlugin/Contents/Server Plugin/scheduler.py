@@ -0,0 +1,177 @@
+""" Vehicle state aware poll scheduling for the JLR InControl plugin
+
+Each vehicle gets its own next poll time, picked from what the car was doing at its last poll: short
+intervals while charging or moving, the normal interval while plugged in or shortly after something
+changed, a long interval when parked and idle or parked in one of the configured idle geofence zones,
+and exponential backoff after failed polls.
+
+Endpoints whose data rarely changes are refreshed on their own, slower cadence and reused in between.
+"""
+
+import threading
+import time
+
+# States that show the vehicle is doing something, any change in them resets the idle timer
+ACTIVITY_STATES = ('EV_CHARGING_STATUS', 'EV_IS_PLUGGED_IN', 'EV_STATE_OF_CHARGE', 'DOOR_IS_ALL_DOORS_LOCKED',
+                   'speed', 'latitude', 'longitude')
+CHARGING_VALUES = ('CHARGING',)
+PLUGGED_IN_VALUES = ('CONNECTED', 'PLUGGED_IN', 'TRUE', 'YES')
+
+DEFAULT_INTERVAL = 60
+DEFAULT_ACTIVE_INTERVAL = 60
+DEFAULT_IDLE_INTERVAL = 900
+# Keep polling at the normal interval for this long after any activity state changed
+RECENT_CHANGE_WINDOW = 900
+MAX_BACKOFF = 3600
+
+# Seconds between refreshes of each vehicle endpoint, 0 means every poll
+ENDPOINT_CADENCE = {
+    'status': 0,
+    'position': 0,
+    'attributes': 86400,
+    # Trip list sync, new trips only appear after a journey
+    'trips': 900,
+}
+
+
+def _int_pref(prefs, key, default):
+    try:
+        value = int(prefs.get(key, default))
+    except (TypeError, ValueError):
+        return default
+    return value if value > 0 else default
+
+
+class VehicleSchedule:
+    """Poll timing for one vehicle"""
+
+    def __init__(self):
+        self.next_due = 0
+        self.reason = "Starting"
+        self.errors = 0
+        self.last_values = None
+        self.last_change = 0
+
+
+class PollScheduler:
+    """Picks each vehicle's next poll time from its latest states"""
+
+    def __init__(self, prefs=None):
+        self._lock = threading.Lock()
+        self._vehicles = {}
+        self.configure(prefs or {})
+
+    def configure(self, prefs):
+        """Read the intervals from the plugin preferences"""
+        self.adaptive = bool(prefs.get('adaptivePolling', False))
+        self.interval = _int_pref(prefs, 'pollingFrequency', DEFAULT_INTERVAL)
+        self.active_interval = _int_pref(prefs, 'pollingFrequencyActive', DEFAULT_ACTIVE_INTERVAL)
+        self.idle_interval = _int_pref(prefs, 'pollingFrequencyIdle', DEFAULT_IDLE_INTERVAL)
+        # Geofence zones where a parked vehicle is polled at the idle interval straight away
+        self.idle_zones = frozenset(zone.strip() for zone in str(prefs.get('geofenceIdleZones', '')).split(',')
+                                    if zone.strip())
+
+    def record(self, key, states, success, now=None):
+        """Record the outcome of a poll and return (next due time, reason)"""
+        if now is None:
+            now = time.time()
+        with self._lock:
+            schedule = self._vehicles.setdefault(key, VehicleSchedule())
+            if success:
+                schedule.errors = 0
+                values = tuple(states.get(state) for state in ACTIVITY_STATES)
+                if values != schedule.last_values:
+                    schedule.last_values = values
+                    schedule.last_change = now
+                interval, schedule.reason = self._interval(states, now - schedule.last_change)
+            else:
+                schedule.errors += 1
+                interval = min(self.interval * 2 ** schedule.errors, MAX_BACKOFF)
+                schedule.reason = "Backing off after %d failed polls" % schedule.errors
+            schedule.next_due = now + interval
+            return schedule.next_due, schedule.reason
+
+    def _interval(self, states, since_change):
+        if not self.adaptive:
+            return self.interval, "Fixed interval"
+        if str(states.get('EV_CHARGING_STATUS', '')).upper() in CHARGING_VALUES:
+            # With a locally worked out time to the charge target, poll at half the time left so the
+            # polls close in on the target, never more often than the active interval
+            try:
+                to_target = float(states.get('chargeMinutesToTarget') or 0) * 60
+            except (TypeError, ValueError):
+                to_target = 0
+            if to_target > 0:
+                return (max(self.active_interval, min(self.idle_interval, int(to_target / 2))),
+                        "Charging, target in %d min" % round(to_target / 60))
+            return self.active_interval, "Charging"
+        try:
+            moving = float(states.get('speed') or 0) > 0
+        except (TypeError, ValueError):
+            moving = False
+        if moving:
+            return self.active_interval, "Moving"
+        zone = states.get('currentZone')
+        if zone and zone in self.idle_zones and \
+                str(states.get('EV_IS_PLUGGED_IN', '')).upper() not in PLUGGED_IN_VALUES:
+            return self.idle_interval, "Parked at %s" % zone
+        if since_change < RECENT_CHANGE_WINDOW:
+            return self.interval, "Recently changed"
+        if str(states.get('EV_IS_PLUGGED_IN', '')).upper() in PLUGGED_IN_VALUES:
+            return self.interval, "Plugged in"
+        return self.idle_interval, "Idle"
+
+    def due(self, keys, now=None):
+        """Return the keys whose next poll time has passed, vehicles never polled are due straight away"""
+        if now is None:
+            now = time.time()
+        with self._lock:
+            return [key for key in keys if key not in self._vehicles or self._vehicles[key].next_due <= now]
+
+    def poll_now(self, key):
+        """Make a vehicle due on the next scheduler pass"""
+        with self._lock:
+            if key in self._vehicles:
+                self._vehicles[key].next_due = 0
+
+    def forget(self, key):
+        with self._lock:
+            self._vehicles.pop(key, None)
+
+
+class EndpointCache:
+    """Last result of each vehicle endpoint, reused until the endpoint's cadence says it is stale"""
+
+    def __init__(self, cadence=None):
+        self.cadence = cadence if cadence is not None else ENDPOINT_CADENCE
+        self._lock = threading.Lock()
+        self._results = {}
+
+    def get(self, key, endpoint, now=None):
+        """Return the cached result, or None if the endpoint is due a refresh"""
+        max_age = self.cadence.get(endpoint, 0)
+        if not max_age:
+            return None
+        if now is None:
+            now = time.time()
+        with self._lock:
+            cached = self._results.get((key, endpoint))
+        if cached is None or now - cached[0] >= max_age:
+            return None
+        return cached[1]
+
+    def put(self, key, endpoint, result, now=None):
+        if not self.cadence.get(endpoint, 0) or result is None:
+            return
+        if now is None:
+            now = time.time()
+        with self._lock:
+            self._results[(key, endpoint)] = (now, result)
+
+    def clear(self, key=None):
+        """Drop the cached results for one vehicle, or for every vehicle"""
+        with self._lock:
+            if key is None:
+                self._results = {}
+            else:
+                self._results = dict(item for item in self._results.items() if item[0][0] != key)
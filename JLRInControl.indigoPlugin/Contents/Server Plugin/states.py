@@ -0,0 +1,45 @@
+""" Delta-only device state updates for the JLR InControl plugin
+
+Remembers the value and uiValue last pushed to Indigo for every device state, so a poll only sends the
+states that actually changed and sends nothing at all when only the timestamps moved.
+"""
+
+import threading
+
+# States that change on every poll, on their own they are not worth a write to the server
+TIMESTAMP_STATES = frozenset(('deviceLastUpdated', 'deviceTimestamp', 'nextPollDue'))
+
+
+class StateCache:
+    """Value and uiValue last pushed to Indigo for each device state"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._pushed = {}
+        # Number of states sent to and held back from the server
+        self.states_written = 0
+        self.states_skipped = 0
+
+    def changes(self, device_id, device_states):
+        """Return the entries of device_states that differ from what was last pushed for the device"""
+        with self._lock:
+            pushed = self._pushed.get(device_id, {})
+            changed = [state for state in device_states
+                       if pushed.get(state['key']) != (state['value'], state.get('uiValue'))]
+            if all(state['key'] in TIMESTAMP_STATES for state in changed):
+                changed = []
+            self.states_skipped += len(device_states) - len(changed)
+            return changed
+
+    def commit(self, device_id, device_states):
+        """Record states that have been written to the server"""
+        with self._lock:
+            pushed = self._pushed.setdefault(device_id, {})
+            for state in device_states:
+                pushed[state['key']] = (state['value'], state.get('uiValue'))
+            self.states_written += len(device_states)
+
+    def forget(self, device_id):
+        """Push every state of the device again on its next update"""
+        with self._lock:
+            self._pushed.pop(device_id, None)
@@ -0,0 +1,151 @@
+""" Table driven transform of JLR vehicle status entries into Indigo device states
+
+The formatter for each status key is looked up in a registry built once from the plugin preferences
+(and rebuilt when they change). Exact keys are a dict lookup, key families such as the tyre pressures
+are matched by precompiled patterns once and then remembered as exact keys. Keys that are not declared
+as states in Devices.xml are dropped, or collected into a catch-all state if Devices.xml declares one.
+"""
+
+import logging
+import os
+import re
+import threading
+import xml.etree.ElementTree as ET
+
+logger = logging.getLogger('Plugin.transforms')
+
+kpaInPSI = 0.145038
+kpaInBar = 0.01
+
+DEVICES_XML = os.path.join(os.path.dirname(os.path.abspath(__file__)), "Devices.xml")
+DEVICE_TYPE = "JLRcar"
+# Status keys without a state of their own are gathered into this state, if it is declared
+CATCH_ALL_STATE = "unmappedStatus"
+
+
+def percent(value):
+    return value + '%'
+
+
+def kwh(value):
+    # JLR sends the battery energy in hundredths of a kWh
+    return '%.1f kWh' % (float(value) / 100)
+
+
+def hours_minutes(value):
+    return '{:02d}:{:02d}m'.format(*divmod(int(value), 60))
+
+
+def charging_status(value):
+    if value == "No Message":
+        return "Not Connected"
+    return value
+
+
+def alarm_status(value):
+    if value == "ALARM_ARMED":
+        return "Armed"
+    elif value == "ALARM_OFF":
+        return "Not Armed"
+    return value
+
+
+def lock_status(value):
+    if value is True or str(value).upper() == "TRUE":
+        return "Locked"
+    return "Unlocked"
+
+
+def pressure_formatter(unit):
+    """Build the tyre pressure formatter for the chosen display unit, raw values are in kPa"""
+    if unit == "Bar":
+        factor, suffix = kpaInBar, " Bar"
+    else:
+        factor, suffix = kpaInPSI, " Psi"
+
+    def pressure(value):
+        return str(round(float(value) * factor, 1)) + suffix
+    return pressure
+
+
+def declared_states(path=DEVICES_XML, device_type=DEVICE_TYPE):
+    """State ids declared for the vehicle device in Devices.xml"""
+    try:
+        root = ET.parse(path).getroot()
+    except (IOError, OSError, ET.ParseError) as e:
+        logger.warning("Unable to read device states from %s: %s" % (path, e))
+        return None
+    for device in root.iter('Device'):
+        if device.get('id') == device_type:
+            return frozenset(state.get('id') for state in device.iter('State'))
+    return None
+
+
+class StateTransform:
+    """Turns the status entries of a poll into the list of Indigo state updates"""
+
+    def __init__(self, prefs=None, known_states=None):
+        self._lock = threading.Lock()
+        self.known_states = known_states
+        self.build(prefs or {})
+
+    def build(self, prefs):
+        """(Re)build the formatter registry from the plugin preferences"""
+        exact = {
+            'EV_STATE_OF_CHARGE': percent,
+            'EV_CHARGING_RATE_SOC_PER_HOUR': percent,
+            'EV_MINUTES_TO_FULLY_CHARGED': hours_minutes,
+            'EV_CHARGING_STATUS': charging_status,
+            'THEFT_ALARM_STATUS': alarm_status,
+            'EV_RANGE_VSC_REVISED_HV_BATT_ENERGYx100': kwh,
+            'DOOR_IS_ALL_DOORS_LOCKED': lock_status,
+        }
+        patterns = [
+            (re.compile(r'TYRE_PRESSURE'), pressure_formatter(prefs.get('pressureunit', "Psi"))),
+        ]
+        with self._lock:
+            self._exact = exact
+            self._patterns = patterns
+            # key -> formatter (or None for a plain copy), filled in as keys are first seen
+            self._resolved = dict(exact)
+
+    def _formatter(self, key):
+        try:
+            return self._resolved[key]
+        except KeyError:
+            pass
+        formatter = None
+        for pattern, candidate in self._patterns:
+            if pattern.search(key):
+                formatter = candidate
+                break
+        with self._lock:
+            self._resolved[key] = formatter
+        return formatter
+
+    def transform(self, entries):
+        """Map a list of {'key': ..., 'value': ...} status entries to Indigo state dicts"""
+        known = self.known_states
+        device_states = []
+        unmapped = []
+        for d in entries:
+            key = d['key']
+            value = d['value']
+            if known is not None and key not in known:
+                unmapped.append(d)
+                continue
+            formatter = self._formatter(key)
+            if formatter is None:
+                device_states.append({'key': key, 'value': value})
+                continue
+            try:
+                device_states.append({'key': key, 'value': value, 'uiValue': formatter(value)})
+            except (TypeError, ValueError):
+                # Value not in the expected form (empty, null...), keep the raw value
+                device_states.append({'key': key, 'value': value})
+        if unmapped and CATCH_ALL_STATE in known:
+            device_states.append({'key': CATCH_ALL_STATE,
+                                  'value': "; ".join("%s=%s" % (d['key'], d['value']) for d in unmapped)})
+        elif unmapped:
+            logger.debug("Dropped status keys without a device state: %s" % ", ".join(d['key'] for d in unmapped))
+        return device_states
@@ -0,0 +1,338 @@
+""" Local trip history for the JLR InControl plugin
+
+Trips are kept in a SQLite file in the plugin's data folder, one indexed summary row per trip (times,
+distance, energy or fuel used, efficiency, eco score and addresses) with the trip details as JSON.
+A sync asks JLR for the few most recent trips and only widens the request until it reaches a trip that
+is already stored, so once the history has been downloaded a sync is a single small request.
+
+Trip routes are read a page of waypoints at a time by a generator, each page decoded straight into a
+packed array of (latitude, longitude, time, speed) doubles and written to the store in batches, so a long
+route never sits in memory as JSON. A trip's route is marked complete once its last page has been read,
+and pages that came back full are not downloaded again.
+"""
+
+from array import array
+
+import datetime
+import json
+import logging
+import sqlite3
+import sys
+import threading
+
+logger = logging.getLogger('Plugin.trips')
+
+# Trips asked for by a sync of a vehicle that already has trips stored, widened by WIDEN_FACTOR until the
+# newest stored trip is in the reply
+SYNC_COUNT = 5
+WIDEN_FACTOR = 4
+# Most trips JLR returns, and the size of the first download for a vehicle
+MAX_TRIPS = 1000
+# Waypoints in each page of a trip route, as requested by jlrpy's Vehicle.get_trip
+ROUTE_PAGE_SIZE = 1000
+# Route pages written to the store in one transaction
+ROUTE_WRITE_BATCH = 10
+# Routes downloaded by one sync, newest trips first, the rest follow on later syncs
+ROUTE_SYNC_LIMIT = 3
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS trips (
+    vin TEXT NOT NULL,
+    id INTEGER NOT NULL,
+    start_time REAL,
+    end_time REAL,
+    distance_km REAL,
+    energy_kwh REAL,
+    regenerated_kwh REAL,
+    fuel_litres REAL,
+    efficiency REAL,
+    eco_score REAL,
+    start_address TEXT,
+    end_address TEXT,
+    details TEXT,
+    waypoints INTEGER,
+    route_complete INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (vin, id)
+);
+CREATE INDEX IF NOT EXISTS trips_by_start ON trips (vin, start_time);
+CREATE TABLE IF NOT EXISTS route_pages (
+    vin TEXT NOT NULL,
+    trip_id INTEGER NOT NULL,
+    page INTEGER NOT NULL,
+    points INTEGER NOT NULL,
+    waypoints BLOB NOT NULL,
+    received INTEGER,
+    PRIMARY KEY (vin, trip_id, page)
+);
+"""
+COLUMNS = ('vin', 'id', 'start_time', 'end_time', 'distance_km', 'energy_kwh', 'regenerated_kwh', 'fuel_litres',
+           'efficiency', 'eco_score', 'start_address', 'end_address', 'details', 'waypoints')
+NO_VALUE = float('nan')
+
+
+def parse_time(value):
+    """Seconds since the epoch for a JLR timestamp such as 2026-10-16T17:02:11+0000"""
+    if not value:
+        return None
+    if value[-5:-4] in ('+', '-') and value[-4:].isdigit():
+        # Much quicker than strptime, which matters for the thousands of waypoints in a route
+        try:
+            return datetime.datetime.fromisoformat("%s:%s" % (value[:-2], value[-2:])).timestamp()
+        except ValueError:
+            pass
+    for fmt in ("%Y-%m-%dT%H:%M:%S%z", "%Y-%m-%dT%H:%M:%S.%f%z"):
+        try:
+            return datetime.datetime.strptime(value, fmt).timestamp()
+        except ValueError:
+            continue
+    logger.debug("Unrecognised trip time %s" % value)
+    return None
+
+
+def summarise(vin, trip):
+    """The stored row for a trip from JLR's trip list"""
+    details = trip.get('tripDetails') or {}
+    distance = details.get('distance')
+    energy = details.get('electricalConsumption')
+    fuel = details.get('fuelConsumption')
+    # Consumption per 100km, electric where the car reports it
+    efficiency = details.get('averageEnergyConsumption')
+    if efficiency is None:
+        efficiency = details.get('averageFuelConsumption')
+    eco_score = (details.get('totalEcoScore') or {}).get('score')
+    return (vin, int(trip['id']), parse_time(details.get('startTime')), parse_time(details.get('endTime')),
+            distance / 1000.0 if distance is not None else None, energy, details.get('electricalRegeneration'),
+            fuel, efficiency, eco_score, (details.get('startPosition') or {}).get('address'),
+            (details.get('endPosition') or {}).get('address'), json.dumps(details, separators=(',', ':')),
+            (trip.get('routeDetails') or {}).get('totalWaypoints'))
+
+
+class RoutePoints:
+    """Waypoints packed into one array of doubles, (latitude, longitude, time, speed) per point
+
+    A time or speed the route did not include is NaN. 32 bytes a point against the several hundred of
+    a decoded JSON waypoint.
+    """
+
+    FIELDS = ('latitude', 'longitude', 'time', 'speed')
+
+    def __init__(self, values=None):
+        self.values = values if values is not None else array('d')
+
+    def append(self, latitude, longitude, time=None, speed=None):
+        self.values.extend((latitude, longitude, NO_VALUE if time is None else time,
+                            NO_VALUE if speed is None else speed))
+
+    def extend(self, other):
+        self.values.extend(other.values)
+
+    def __len__(self):
+        return len(self.values) // 4
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError(index)
+        return tuple(self.values[index * 4:index * 4 + 4])
+
+    def __iter__(self):
+        values = self.values
+        for i in range(0, len(values), 4):
+            yield values[i], values[i + 1], values[i + 2], values[i + 3]
+
+    def tobytes(self):
+        """Little endian bytes for the store, whatever the machine"""
+        if sys.byteorder == 'little':
+            return self.values.tobytes()
+        values = array('d', self.values)
+        values.byteswap()
+        return values.tobytes()
+
+    @classmethod
+    def frombytes(cls, data):
+        values = array('d')
+        values.frombytes(data)
+        if sys.byteorder != 'little':
+            values.byteswap()
+        return cls(values)
+
+
+def decode_waypoints(waypoints):
+    """Pack a page of JLR route waypoints, waypoints without a position are left out"""
+    points = RoutePoints()
+    for waypoint in waypoints:
+        position = waypoint.get('position') or {}
+        latitude = position.get('latitude')
+        longitude = position.get('longitude')
+        if latitude is None or longitude is None:
+            continue
+        points.append(latitude, longitude, parse_time(waypoint.get('timestamp')), position.get('speed'))
+    return points
+
+
+def route_pages(get_page, total=None, page_size=ROUTE_PAGE_SIZE, skip=frozenset()):
+    """Download and decode the pages of a trip route one at a time, yields (page number, RoutePoints,
+    waypoints JLR sent)
+
+    get_page(page) returns JLR's reply for a page, numbered from 1. Pages in skip are not downloaded.
+    Without a total the pages are read until one comes back short. Running to the end means the last
+    page of the route has been read.
+    """
+    page = 1
+    while total is None or (page - 1) * page_size < total:
+        if page in skip:
+            page += 1
+            continue
+        result = get_page(page) or {}
+        if total is None:
+            total = result.get('totalWaypoints')
+        waypoints = result.get('waypoints') or []
+        yield page, decode_waypoints(waypoints), len(waypoints)
+        if len(waypoints) < page_size:
+            break
+        page += 1
+
+
+class TripStore:
+    """Trip summaries for every vehicle, synced incrementally from JLR's trip list"""
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        # Shared by the fetch workers, every use is under the lock
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.row_factory = sqlite3.Row
+        self._db.executescript(SCHEMA)
+        # Requests made and trips added by syncs, and route pages downloaded
+        self.requests = 0
+        self.added = 0
+        self.route_pages = 0
+
+    def sync(self, vin, get_trips):
+        """Add the vehicle's new trips, get_trips(count) returns JLR's trip list, returns the latest trip
+
+        Nothing stored yet means one download of the whole history, otherwise SYNC_COUNT trips are asked
+        for and the count only grows while every trip in the reply is new.
+        """
+        count = SYNC_COUNT if self.count(vin) else MAX_TRIPS
+        total = 0
+        # Trips stored by this sync, a wider reply repeats them and they must not count as already stored
+        seen = set()
+        while True:
+            result = get_trips(count)
+            self.requests += 1
+            trips = [trip for trip in (result or {}).get('trips') or [] if trip.get('id') is not None]
+            rows = [summarise(vin, trip) for trip in trips if int(trip['id']) not in seen]
+            seen.update(row[1] for row in rows)
+            added, overlapped = self._store(vin, rows)
+            self.added += added
+            total += added
+            if overlapped or len(trips) < count or count >= MAX_TRIPS:
+                break
+            count = min(count * WIDEN_FACTOR, MAX_TRIPS)
+        if total or count > SYNC_COUNT:
+            logger.debug("Trip sync of %s added %d trips, asked for %d" % (vin, total, count))
+        return self.latest(vin)
+
+    def _store(self, vin, rows):
+        """Insert the rows, returns (trips added, whether any was already stored)"""
+        if not rows:
+            return 0, False
+        ids = [row[1] for row in rows]
+        with self._lock, self._db:
+            known = set()
+            # Batched to stay under SQLite's limit on query parameters
+            for i in range(0, len(ids), 500):
+                batch = ids[i:i + 500]
+                known.update(r[0] for r in self._db.execute(
+                    "SELECT id FROM trips WHERE vin = ? AND id IN (%s)" % ",".join("?" * len(batch)),
+                    [vin] + batch))
+            new_rows = [row for row in rows if row[1] not in known]
+            self._db.executemany("INSERT INTO trips (%s) VALUES (%s)" % (
+                ",".join(COLUMNS), ",".join("?" * len(COLUMNS))), new_rows)
+        return len(new_rows), bool(known)
+
+    def count(self, vin):
+        with self._lock:
+            return self._db.execute("SELECT COUNT(*) FROM trips WHERE vin = ?", (vin,)).fetchone()[0]
+
+    def latest(self, vin):
+        """Summary of the most recent trip as a dict, None if there are none"""
+        with self._lock:
+            row = self._db.execute("SELECT * FROM trips WHERE vin = ? ORDER BY start_time DESC, id DESC LIMIT 1",
+                                   (vin,)).fetchone()
+        return dict(row) if row is not None else None
+
+    def trips(self, vin, since=None, until=None):
+        """Trip summaries of a vehicle, oldest first, optionally limited to a start time range"""
+        query = "SELECT * FROM trips WHERE vin = ?"
+        args = [vin]
+        if since is not None:
+            query += " AND start_time >= ?"
+            args.append(since)
+        if until is not None:
+            query += " AND start_time < ?"
+            args.append(until)
+        with self._lock:
+            return [dict(row) for row in self._db.execute(query + " ORDER BY start_time, id", args)]
+
+    def missing_routes(self, vin, limit=ROUTE_SYNC_LIMIT):
+        """Ids of the vehicle's trips with a route whose last page has not been read, newest first"""
+        with self._lock:
+            return [row[0] for row in self._db.execute(
+                "SELECT id FROM trips WHERE vin = ? AND waypoints > 0 AND NOT route_complete "
+                "ORDER BY start_time DESC, id DESC LIMIT ?", (vin, limit))]
+
+    def sync_route(self, vin, trip_id, get_trip):
+        """Download the route pages of a trip that were not read in full, returns the waypoints downloaded
+
+        get_trip(trip_id, page) is jlrpy's Vehicle.get_trip. Pages are written ROUTE_WRITE_BATCH at a time,
+        and the trip is marked complete with the last of them. Waypoints without a position are not
+        stored, so whether a page is whole goes by the waypoints JLR sent, not the points kept.
+        """
+        with self._lock:
+            row = self._db.execute("SELECT waypoints FROM trips WHERE vin = ? AND id = ?", (vin, trip_id)).fetchone()
+            total = row[0] if row is not None else None
+            stored = self._db.execute("SELECT page, received FROM route_pages WHERE vin = ? AND trip_id = ?",
+                                      (vin, trip_id)).fetchall()
+        # Anything short of a full page is read again, it may have been the last page of an unfinished route
+        skip = frozenset(page for page, received in stored if received == ROUTE_PAGE_SIZE)
+        added = 0
+        batch = []
+        try:
+            for page, points, received in route_pages(lambda page: get_trip(trip_id, page), total, skip=skip):
+                batch.append((vin, trip_id, page, len(points), points.tobytes(), received))
+                added += len(points)
+                if len(batch) >= ROUTE_WRITE_BATCH:
+                    self._write_pages(batch)
+                    batch = []
+        except Exception:
+            # Keep the pages read before the failure, the next sync carries on after them
+            self._write_pages(batch)
+            raise
+        self._write_pages(batch, (vin, trip_id))
+        return added
+
+    def _write_pages(self, batch, complete=None):
+        """Store a batch of pages, and mark the (vin, trip id) in complete as having its whole route"""
+        if not batch and complete is None:
+            return
+        with self._lock, self._db:
+            self._db.executemany("INSERT OR REPLACE INTO route_pages (vin, trip_id, page, points, waypoints, "
+                                 "received) VALUES (?, ?, ?, ?, ?, ?)", batch)
+            if complete is not None:
+                self._db.execute("UPDATE trips SET route_complete = 1 WHERE vin = ? AND id = ?", complete)
+        self.route_pages += len(batch)
+
+    def route(self, vin, trip_id):
+        """The stored waypoints of a trip as one RoutePoints"""
+        points = RoutePoints()
+        with self._lock:
+            for (data,) in self._db.execute("SELECT waypoints FROM route_pages WHERE vin = ? AND trip_id = ? "
+                                            "ORDER BY page", (vin, trip_id)):
+                points.extend(RoutePoints.frombytes(data))
+        return points
+
+    def close(self):
+        with self._lock:
+            self._db.close()
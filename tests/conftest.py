@@ -0,0 +1,14 @@
+import json
+import os
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PLUGIN_FOLDER = os.path.join(ROOT, "JLRInControl.indigoPlugin", "Contents", "Server Plugin")
+FIXTURES = os.path.join(ROOT, "tools", "fixtures")
+
+sys.path.insert(0, PLUGIN_FOLDER)
+
+
+def load_fixture(name):
+    with open(os.path.join(FIXTURES, name)) as f:
+        return json.load(f)
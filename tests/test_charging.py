@@ -0,0 +1,55 @@
+import pytest
+
+import charging
+from conftest import load_fixture
+
+DEVICE_ID = 1
+
+
+def fixture_states():
+    status = load_fixture("status.json")['vehicleStatus']
+    return status['evStatus'] + status['coreStatus']
+
+
+def states_dict(device_states):
+    return dict((state['key'], state['value']) for state in device_states)
+
+
+def poll(soc, energy, charging_status="CHARGING"):
+    return [{'key': 'EV_STATE_OF_CHARGE', 'value': str(soc)},
+            {'key': charging.ENERGY_STATE, 'value': str(energy)},
+            {'key': 'EV_CHARGING_STATUS', 'value': charging_status}]
+
+
+def test_fixture_energy_is_read_in_kwh():
+    tracker = charging.ChargeTracker()
+    tracker.update(DEVICE_ID, fixture_states(), now=0)
+    # 66.07 kWh at 78% SoC
+    assert tracker._capacity[DEVICE_ID] == pytest.approx(66.07 / 78 * 100)
+
+
+def test_energy_added_over_a_session():
+    tracker = charging.ChargeTracker()
+    tracker.update(DEVICE_ID, poll(50, 4250), now=0)
+    states = states_dict(tracker.update(DEVICE_ID, poll(60, 5100), now=3600))
+    assert states['chargeSessionActive'] is True
+    assert states['chargeEnergyAdded'] == pytest.approx(8.5)
+
+
+@pytest.mark.parametrize("states, target, expected", [
+    ({}, None, charging.FULL_SOC),
+    ({}, "80", 80),
+    ({charging.LIMIT_CHOICE_STATE: "SET", charging.LIMIT_STATE: "90"}, None, 90),
+    ({charging.LIMIT_CHOICE_STATE: "SET", charging.LIMIT_STATE: "90"}, "80", 80),
+    ({charging.LIMIT_CHOICE_STATE: "CLEAR", charging.LIMIT_STATE: "90"}, None, charging.FULL_SOC),
+    ({charging.LIMIT_CHOICE_STATE: "SET", charging.LIMIT_STATE: ""}, None, charging.FULL_SOC),
+    ({charging.LIMIT_CHOICE_STATE: "SET", charging.LIMIT_STATE: "0"}, "", charging.FULL_SOC),
+])
+def test_target(states, target, expected):
+    assert charging.ChargeTracker.target(states, target) == expected
+
+
+def test_fixture_target_ignores_cleared_limit():
+    states = states_dict(fixture_states())
+    assert states[charging.LIMIT_CHOICE_STATE] == "CLEAR"
+    assert charging.ChargeTracker.target(states) == charging.FULL_SOC
@@ -0,0 +1,49 @@
+import pytest
+
+import jlrpy
+
+URL = "http://breaker.test/if9/jlr/vehicles"
+
+
+class FailingPool:
+    def __init__(self, error):
+        self.error = error
+
+    def request(self, method, url, body=None, headers=None):
+        raise self.error
+
+
+@pytest.fixture
+def breaker():
+    jlrpy._breakers.clear()
+    breaker = jlrpy.get_breaker("breaker.test")
+    breaker.cooldown = 0
+    for _ in range(breaker.threshold):
+        breaker.failure()
+    assert breaker.is_open
+    yield breaker
+    jlrpy._breakers.clear()
+
+
+def connection(error):
+    # Just enough of a Connection for a request, without logging in
+    conn = jlrpy.Connection.__new__(jlrpy.Connection)
+    conn.pool = FailingPool(error)
+    conn.limiter = jlrpy.RateLimiter({})
+    return conn
+
+
+def test_probe_ending_in_an_unexpected_error_lets_the_next_probe_through(breaker, monkeypatch):
+    monkeypatch.setattr(jlrpy, 'RETRY_BACKOFF', 0)
+    with pytest.raises(ValueError):
+        connection(ValueError("undecodable body"))._Connection__open(URL)
+    assert breaker.is_open
+    assert breaker.allow()
+
+
+def test_failed_probe_reopens_the_breaker(breaker, monkeypatch):
+    monkeypatch.setattr(jlrpy, 'RETRY_BACKOFF', 0)
+    with pytest.raises(OSError):
+        connection(OSError("connection refused"))._Connection__open(URL)
+    breaker.cooldown = 60
+    assert not breaker.allow()
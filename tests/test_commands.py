@@ -0,0 +1,50 @@
+import threading
+
+import pytest
+
+import commands
+
+KEY = 1000
+
+
+@pytest.fixture
+def queue():
+    sent = []
+    done = threading.Semaphore(0)
+
+    def run_with_vehicle(key, func, resend=True):
+        return func(object())
+
+    def publish(key, command):
+        if command.status in (commands.SUCCEEDED, commands.FAILED):
+            done.release()
+
+    def send(name):
+        def post(vehicle):
+            sent.append(name)
+            return {}
+        return post
+
+    queue = commands.CommandQueue(run_with_vehicle, publish, window=60)
+    queue.sent_names = sent
+    queue.done = done
+    queue.send = send
+    yield queue
+    queue.stop()
+
+
+def test_one_shot_commands_are_not_held_or_merged(queue):
+    for _ in range(2):
+        queue.submit(KEY, commands.Command("Honk and Blink", queue.send("honk")))
+    assert queue.done.acquire(timeout=5) and queue.done.acquire(timeout=5)
+    assert queue.sent_names == ["honk", "honk"]
+    assert queue.merged == 0
+
+
+@pytest.mark.parametrize("group", sorted(commands.COALESCED_GROUPS))
+def test_state_commands_are_held_and_merged(queue, group):
+    first = queue.submit(KEY, commands.Command("Start", queue.send("start"), group=group))
+    second = queue.submit(KEY, commands.Command("Start", queue.send("start"), group=group))
+    assert second is first
+    assert queue.merged == 1
+    assert queue.sent_names == []
@@ -0,0 +1,72 @@
+import threading
+from http.client import RemoteDisconnected
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+import jlrpy
+
+
+class Handler(BaseHTTPRequestHandler):
+    """Answers the first request on each connection, /drop on a reused connection is read and then the
+    connection closed without a reply, as a server timing out an idle keep-alive connection would"""
+
+    protocol_version = "HTTP/1.1"
+
+    def setup(self):
+        super().setup()
+        self.served = 0
+
+    def handle_request(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        if length:
+            self.rfile.read(length)
+        self.server.received.append((self.command, self.path))
+        if self.path == "/drop" and self.served:
+            self.close_connection = True
+            return
+        self.served += 1
+        self.send_response(200)
+        self.send_header("Content-Length", "2")
+        self.end_headers()
+        self.wfile.write(b"ok")
+
+    do_GET = do_POST = handle_request
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def server():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    server.received = []
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        yield server, "http://127.0.0.1:%d" % server.server_address[1]
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def test_get_on_stale_connection_is_sent_again(server):
+    server, url = server
+    pool = jlrpy.ConnectionPool()
+    pool.request("GET", url + "/first")
+    resp, data = pool.request("GET", url + "/drop")
+    assert data == b"ok"
+    assert server.received == [("GET", "/first"), ("GET", "/drop"), ("GET", "/drop")]
+    assert pool.connections_opened == 2
+    pool.close()
+
+
+def test_post_on_stale_connection_is_not_sent_again(server):
+    server, url = server
+    pool = jlrpy.ConnectionPool()
+    pool.request("GET", url + "/first")
+    with pytest.raises(RemoteDisconnected):
+        pool.request("POST", url + "/drop", body=b'{"command": "HBLF"}',
+                     headers={"Content-Type": "application/json"})
+    assert server.received == [("GET", "/first"), ("POST", "/drop")]
+    pool.close()
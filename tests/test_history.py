@@ -0,0 +1,62 @@
+import pytest
+
+import history
+
+DEVICE_ID = 1
+KEY = 'EV_STATE_OF_CHARGE'
+
+
+@pytest.fixture
+def store(tmp_path):
+    store = history.StateHistory(str(tmp_path / "history.sqlite"))
+    yield store
+    store.close()
+
+
+def record(store, first, count, start=1000000.0):
+    for i in range(first, first + count):
+        store.record(DEVICE_ID, [{'key': KEY, 'value': str(i)}], now=start + i * 60)
+
+
+def table_count(store, table):
+    return store._db.execute("SELECT COUNT(*) FROM %s" % table).fetchone()[0]
+
+
+def test_samples_are_staged_until_a_block_is_full(store):
+    record(store, 0, history.BLOCK_SIZE - 1)
+    assert table_count(store, "blocks") == 0
+    assert table_count(store, "staged") == history.BLOCK_SIZE - 1
+
+    record(store, history.BLOCK_SIZE - 1, 1)
+    assert table_count(store, "blocks") == 1
+    assert table_count(store, "staged") == 0
+    count, = store._db.execute("SELECT count FROM blocks").fetchone()
+    assert count == history.BLOCK_SIZE
+
+
+def test_queries_read_blocks_and_staged_samples(store):
+    total = history.BLOCK_SIZE + 10
+    record(store, 0, total)
+    times, values = store.range(DEVICE_ID, KEY)
+    assert list(values) == [float(i) for i in range(total)]
+    assert list(times) == sorted(times)
+
+    times, values = store.last(DEVICE_ID, KEY, 15)
+    assert list(values) == [float(i) for i in range(total - 15, total)]
+    times, values = store.last(DEVICE_ID, KEY, 5)
+    assert list(values) == [float(i) for i in range(total - 5, total)]
+
+
+def test_out_of_order_sample_is_dropped_after_reopening(tmp_path):
+    path = str(tmp_path / "history.sqlite")
+    store = history.StateHistory(path)
+    record(store, 0, 3)
+    store.close()
+
+    store = history.StateHistory(path)
+    try:
+        assert store.record(DEVICE_ID, [{'key': KEY, 'value': "9"}], now=1000000.0) == 0
+        record(store, 3, 1)
+        assert list(store.range(DEVICE_ID, KEY)[1]) == [0.0, 1.0, 2.0, 3.0]
+    finally:
+        store.close()
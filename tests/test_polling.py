@@ -0,0 +1,133 @@
+import argparse
+import os
+import sys
+import time
+
+import pytest
+
+from conftest import ROOT
+
+# plugin.py imports requests for the map worker
+pytest.importorskip("requests")
+
+sys.path.insert(0, os.path.join(ROOT, "tools"))
+import benchmark  # noqa: E402
+
+
+class Device(benchmark.FakeDevice):
+    """FakeDevice that also keeps the uiValue of each state"""
+
+    def __init__(self, *args):
+        super().__init__(*args)
+        self.ui_values = {}
+
+    def updateStatesOnServer(self, states):
+        super().updateStatesOnServer(states)
+        for state in states:
+            self.ui_values[state['key']] = state.get('uiValue')
+
+
+@pytest.fixture
+def polling(tmp_path, monkeypatch):
+    """A plugin polling one vehicle from a jlrstub process, yields (plugin, device, stub)"""
+    indigo = benchmark.install_fake_indigo(str(tmp_path))
+    import jlrpy
+    import plugin as plugin_module
+    stub = benchmark.StubSource(1, argparse.Namespace(latency=0.0, jitter=0.0, error_rate=0.0, seed=None,
+                                                      compression=True))
+    stub.install(jlrpy)
+    monkeypatch.setattr(jlrpy, 'RATE_LIMITS', {})
+    monkeypatch.setattr(jlrpy, 'RETRY_BACKOFF', 0)
+    jlrpy._limiters.clear()
+    jlrpy._breakers.clear()
+    prefs = {'InControlEmail': "outage@example.com", 'InControlPassword': "test", 'useMapAPI': False,
+             'requeststimeout': "5", 'statusMaxAge': "0", 'pollingFrequency': "60"}
+    plugin = plugin_module.Plugin(benchmark.PLUGIN_ID, "JLR InControl", "test", prefs)
+    device = Device(1000, "Vehicle 1", 1)
+    indigo.devices.clear()
+    indigo.devices[device.id] = device
+    try:
+        yield plugin, device, stub
+    finally:
+        plugin.shutdown()
+        if stub.process.poll() is None:
+            stub.stop(jlrpy)
+        jlrpy.set_base_urls()
+        jlrpy._breakers.clear()
+
+
+def test_outage_fails_polls_and_backs_off(polling):
+    plugin, device, stub = polling
+    import jlrpy
+    import scheduler
+
+    plugin.pollDevice(device.id)
+    assert device.states['deviceIsOnline'] is True
+    assert device.states['nextPollReason'] == "Fixed interval"
+    # The attributes and trips are now cached, they must not make a poll during the outage look successful
+    assert plugin.endpointCache.get(device.id, 'attributes') is not None
+
+    stub.stop(jlrpy)
+    jlrpy.set_base_urls(stub.url)
+    for failed in range(1, 4):
+        polled = time.time()
+        plugin.pollDevice(device.id)
+        assert device.states['deviceIsOnline'] is False
+        assert device.states['nextPollReason'] == "Backing off after %d failed polls" % failed
+        next_due = plugin.scheduler._vehicles[device.id].next_due
+        assert next_due - polled == pytest.approx(min(60 * 2 ** failed, scheduler.MAX_BACKOFF), abs=5)
+
+    # Status and position failing on every attempt opens the host's circuit breaker
+    assert jlrpy.backing_off()
+    assert device.ui_values['deviceIsOnline'] == "Backing off"
+    assert plugin.scheduler.due([device.id]) == []
+
+
+def test_legacy_request_timeout_is_raised(tmp_path):
+    benchmark.install_fake_indigo(str(tmp_path))
+    import jlrpy
+    import plugin as plugin_module
+    prefs = {'InControlEmail': "timeout@example.com", 'InControlPassword': "test", 'requeststimeout': "1"}
+    plugin = plugin_module.Plugin(benchmark.PLUGIN_ID, "JLR InControl", "test", prefs)
+    try:
+        assert prefs['requeststimeout'] == str(jlrpy.DEFAULT_TIMEOUT)
+        assert plugin.accounts.timeout == jlrpy.DEFAULT_TIMEOUT
+        assert plugin.requestTimeout({'requeststimeout': "0.2"}) == plugin_module.minRequestTimeout
+    finally:
+        plugin.shutdown()
+
+
+def test_device_start_does_not_poll_alongside_a_running_poll(polling, monkeypatch):
+    plugin, device, stub = polling
+    polled = []
+    monkeypatch.setattr(plugin, 'update', lambda device, cycle=None: polled.append(device.id))
+
+    plugin.pollsInFlight.add(device.id)
+    plugin.deviceStartComm(device)
+    assert polled == []
+
+    plugin.deviceStopComm(device)
+    plugin.pollsInFlight.discard(device.id)
+    plugin.deviceStartComm(device)
+    plugin.pollExecutor.shutdown(wait=True)
+    assert polled == [device.id]
+
+
+def test_zone_triggers_for_any_vehicle_or_this_one(tmp_path, monkeypatch):
+    benchmark.install_fake_indigo(str(tmp_path))
+    import plugin as plugin_module
+    executed = []
+    # The indigo module plugin.py was first imported with
+    monkeypatch.setattr(plugin_module.indigo, 'trigger',
+                        argparse.Namespace(execute=lambda trigger: executed.append(trigger.name)), raising=False)
+    prefs = {'InControlEmail': "zones@example.com", 'InControlPassword': "test"}
+    plugin = plugin_module.Plugin(benchmark.PLUGIN_ID, "JLR InControl", "test", prefs)
+    try:
+        for name, vehicle, zone in (("any", "any", ""), ("this", "1000", "Home"), ("other", "2000", ""),
+                                    ("elsewhere", "any", "Office")):
+            plugin.triggerStartProcessing(argparse.Namespace(
+                id=name, name=name, pluginTypeId='zoneEntered', pluginProps={'vehicle': vehicle, 'zone': zone}))
+        plugin.fireZoneTriggers('zoneEntered', Device(1000, "Vehicle 1", 1), "Home")
+        assert sorted(executed) == ["any", "this"]
+    finally:
+        plugin.shutdown()
@@ -0,0 +1,119 @@
+import pytest
+
+import transforms
+from conftest import load_fixture
+
+
+def status_entries():
+    status = load_fixture("status.json")['vehicleStatus']
+    return status['evStatus'] + status['coreStatus']
+
+
+def ui_values(device_states):
+    return dict((state['key'], state.get('uiValue')) for state in device_states)
+
+
+@pytest.mark.parametrize("formatter, value, expected", [
+    (transforms.percent, "80", "80%"),
+    (transforms.kwh, "6250", "62.5 kWh"),
+    (transforms.kwh, "6607", "66.1 kWh"),
+    (transforms.hours_minutes, "135", "02:15m"),
+    (transforms.hours_minutes, 0, "00:00m"),
+    (transforms.charging_status, "No Message", "Not Connected"),
+    (transforms.charging_status, "CHARGING", "CHARGING"),
+    (transforms.alarm_status, "ALARM_ARMED", "Armed"),
+    (transforms.alarm_status, "ALARM_OFF", "Not Armed"),
+    (transforms.alarm_status, "ALARM_UNKNOWN", "ALARM_UNKNOWN"),
+    (transforms.lock_status, "TRUE", "Locked"),
+    (transforms.lock_status, True, "Locked"),
+    (transforms.lock_status, "FALSE", "Unlocked"),
+    (transforms.lock_status, False, "Unlocked"),
+])
+def test_formatters(formatter, value, expected):
+    assert formatter(value) == expected
+
+
+@pytest.mark.parametrize("unit, expected", [("Psi", "38.0 Psi"), ("Bar", "2.6 Bar")])
+def test_pressure_formatter(unit, expected):
+    assert transforms.pressure_formatter(unit)("262") == expected
+
+
+def test_hours_minutes_rejects_empty_value():
+    with pytest.raises(ValueError):
+        transforms.hours_minutes("")
+
+
+def test_declared_states_reads_devices_xml():
+    declared = transforms.declared_states()
+    assert declared is not None
+    for state in ('EV_STATE_OF_CHARGE', 'TYRE_PRESSURE_FRONT_LEFT', 'DOOR_IS_ALL_DOORS_LOCKED',
+                  transforms.CATCH_ALL_STATE):
+        assert state in declared
+
+
+def test_declared_states_unknown_device_type():
+    assert transforms.declared_states(device_type="notADevice") is None
+
+
+def test_declared_states_missing_file(tmp_path):
+    assert transforms.declared_states(str(tmp_path / "Devices.xml")) is None
+
+
+def test_transform_fixture_payload():
+    entries = status_entries()
+    transform = transforms.StateTransform({'pressureunit': "Bar"}, transforms.declared_states())
+    device_states = transform.transform(entries)
+    ui = ui_values(device_states)
+    assert ui['TYRE_PRESSURE_FRONT_LEFT'] == "2.6 Bar"
+    assert ui['EV_STATE_OF_CHARGE'].endswith('%')
+    assert ui['EV_MINUTES_TO_FULLY_CHARGED'].endswith('m')
+    assert ui['EV_RANGE_VSC_REVISED_HV_BATT_ENERGYx100'] == "66.1 kWh"
+    declared = transforms.declared_states()
+    mapped = [entry['key'] for entry in entries if entry['key'] in declared]
+    unmapped = [entry['key'] for entry in entries if entry['key'] not in declared]
+    assert [state['key'] for state in device_states] == mapped + [transforms.CATCH_ALL_STATE]
+    catch_all = device_states[-1]['value']
+    assert [item.split('=')[0] for item in catch_all.split('; ')] == unmapped
+
+
+def test_transform_pressure_unit_follows_rebuild():
+    transform = transforms.StateTransform({'pressureunit': "Psi"})
+    entries = [{'key': 'TYRE_PRESSURE_REAR_LEFT', 'value': "270"}]
+    assert transform.transform(entries)[0]['uiValue'] == "39.2 Psi"
+    transform.build({'pressureunit': "Bar"})
+    assert transform.transform(entries)[0]['uiValue'] == "2.7 Bar"
+
+
+def test_transform_unparsable_value_is_kept_raw():
+    transform = transforms.StateTransform()
+    device_states = transform.transform([{'key': 'EV_MINUTES_TO_FULLY_CHARGED', 'value': ""}])
+    assert device_states == [{'key': 'EV_MINUTES_TO_FULLY_CHARGED', 'value': ""}]
+
+
+def test_transform_without_formatter_copies_value():
+    transform = transforms.StateTransform()
+    assert transform.transform([{'key': 'ODOMETER_METER', 'value': "1234"}]) == \
+        [{'key': 'ODOMETER_METER', 'value': "1234"}]
+
+
+def test_undeclared_keys_go_to_catch_all():
+    known = frozenset(('EV_STATE_OF_CHARGE', transforms.CATCH_ALL_STATE))
+    transform = transforms.StateTransform({}, known)
+    device_states = transform.transform([
+        {'key': 'EV_STATE_OF_CHARGE', 'value': "55"},
+        {'key': 'NEW_KEY_ONE', 'value': "1"},
+        {'key': 'NEW_KEY_TWO', 'value': "two"},
+    ])
+    assert device_states == [
+        {'key': 'EV_STATE_OF_CHARGE', 'value': "55", 'uiValue': "55%"},
+        {'key': transforms.CATCH_ALL_STATE, 'value': "NEW_KEY_ONE=1; NEW_KEY_TWO=two"},
+    ]
+
+
+def test_undeclared_keys_dropped_without_catch_all():
+    transform = transforms.StateTransform({}, frozenset(('EV_STATE_OF_CHARGE',)))
+    device_states = transform.transform([
+        {'key': 'EV_STATE_OF_CHARGE', 'value': "55"},
+        {'key': 'NEW_KEY_ONE', 'value': "1"},
+    ])
+    assert [state['key'] for state in device_states] == ['EV_STATE_OF_CHARGE']
@@ -0,0 +1,65 @@
+import pytest
+
+import trips
+
+VIN = "SALTEST0000000001"
+
+
+class RouteSource:
+    """Route pages of one trip with every other waypoint missing its position, recording the pages asked for"""
+
+    def __init__(self, total):
+        self.total = total
+        self.pages = []
+
+    def get_trip(self, trip_id, page):
+        self.pages.append(page)
+        first = (page - 1) * trips.ROUTE_PAGE_SIZE
+        count = max(0, min(trips.ROUTE_PAGE_SIZE, self.total - first))
+        waypoints = []
+        for i in range(first, first + count):
+            position = {'latitude': 52.4, 'longitude': -1.5, 'speed': 30} if i % 2 else None
+            waypoints.append({'position': position, 'timestamp': "2026-10-16T17:02:11+0000"})
+        return {'waypoints': waypoints, 'totalWaypoints': self.total}
+
+
+def trip(trip_id, waypoints):
+    return {'id': trip_id, 'tripDetails': {'startTime': "2026-10-%02dT08:00:00+0000" % trip_id},
+            'routeDetails': {'totalWaypoints': waypoints}}
+
+
+@pytest.fixture
+def store(tmp_path):
+    store = trips.TripStore(str(tmp_path / "trips.sqlite"))
+    yield store
+    store.close()
+
+
+def test_route_without_positions_is_downloaded_once(store):
+    source = RouteSource(1500)
+    store.sync(VIN, lambda count: {'trips': [trip(1, source.total)]})
+    assert store.missing_routes(VIN) == [1]
+
+    assert store.sync_route(VIN, 1, source.get_trip) == 750
+    assert source.pages == [1, 2]
+    assert store.missing_routes(VIN) == []
+    assert len(store.route(VIN, 1)) == 750
+
+
+def test_unfinished_route_reads_only_pages_not_received_in_full(store):
+    source = RouteSource(2500)
+    store.sync(VIN, lambda count: {'trips': [trip(1, source.total)]})
+
+    def fail_on_third_page(trip_id, page):
+        if page == 3:
+            raise IOError("connection reset")
+        return source.get_trip(trip_id, page)
+    with pytest.raises(IOError):
+        store.sync_route(VIN, 1, fail_on_third_page)
+    assert store.missing_routes(VIN) == [1]
+
+    source.pages = []
+    store.sync_route(VIN, 1, source.get_trip)
+    assert source.pages == [3]
+    assert store.missing_routes(VIN) == []
+
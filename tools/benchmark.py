@@ -0,0 +1,292 @@
+""" End to end poll benchmark for the JLR InControl plugin
+
+Starts the jlrstub stand-in API in its own process, loads plugin.py against a minimal fake indigo module,
+adds one device per vehicle and times Plugin.update for each of them. For every fleet size it reports,
+per poll: wall time, requests sent, response bytes received (compressed when the stub gzips them), new
+connections (TCP and TLS handshakes), device state writes sent to Indigo, CPU time and peak memory
+allocated while the poll ran. The first round includes the login and the first download of the slow
+changing endpoints, so it is reported apart from the steady state rounds.
+
+    python3 tools/benchmark.py --vehicles 1,5,50 --rounds 5 --latency 0.05
+
+With --replay the vehicles of a cassette recorded by the plugin (Start/Stop Recording JLR Traffic) are
+polled instead, from the recorded payloads, with the responses looped and optionally sped up (--speed).
+
+The plugin's own imports (requests for the map worker) must be installed. The JLR request budget is
+lifted unless --rate-limit is given, so the figures show the cost of a poll rather than the budget.
+"""
+
+import argparse
+import json
+import logging
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+import types
+import urllib.request
+
+TOOLS = os.path.dirname(os.path.abspath(__file__))
+PLUGIN_FOLDER = os.path.join(os.path.dirname(TOOLS), "JLRInControl.indigoPlugin", "Contents", "Server Plugin")
+PLUGIN_ID = "com.barn.indigoplugin.JLRInControl"
+PASSWORD = "benchmark"
+
+
+class FakeDevice:
+    """Just enough of indigo.Device for Plugin.update"""
+
+    def __init__(self, device_id, name, car_id):
+        self.id = device_id
+        self.name = name
+        self.pluginProps = {'CarID': str(car_id)}
+        self.states = {}
+        self.state_writes = 0
+
+    def updateStatesOnServer(self, states):
+        self.state_writes += 1
+        for state in states:
+            self.states[state['key']] = state['value']
+
+    def updateStateOnServer(self, key, value=None, uiValue=None):
+        self.updateStatesOnServer([{'key': key, 'value': value, 'uiValue': uiValue}])
+
+    def stateListOrDisplayStateIdChanged(self):
+        pass
+
+
+def install_fake_indigo(folder):
+    """Register a minimal indigo module so plugin.py can be imported outside Indigo"""
+    indigo = types.ModuleType("indigo")
+    log = logging.getLogger("indigo")
+
+    class PluginBase:
+        class StopThread(Exception):
+            pass
+
+        def __init__(self, pluginId, pluginDisplayName, pluginVersion, pluginPrefs):
+            self.pluginId = pluginId
+            self.pluginDisplayName = pluginDisplayName
+            self.pluginVersion = pluginVersion
+            self.pluginPrefs = pluginPrefs
+
+        def debugLog(self, msg):
+            log.debug(msg)
+
+        def errorLog(self, msg):
+            log.error(msg)
+
+        def sleep(self, seconds):
+            time.sleep(seconds)
+
+    class Server:
+        @staticmethod
+        def log(msg, isError=False):
+            (log.error if isError else log.debug)(msg)
+
+        @staticmethod
+        def getInstallFolderPath():
+            return folder
+
+    indigo.PluginBase = PluginBase
+    indigo.Dict = dict
+    indigo.List = list
+    indigo.server = Server()
+    indigo.devices = {}
+    sys.modules["indigo"] = indigo
+    return indigo
+
+
+class StubSource:
+    """Serves the plugin from a jlrstub process, requests and connections are counted by the stub"""
+
+    def __init__(self, vehicles, args):
+        command = [sys.executable, os.path.join(TOOLS, "jlrstub.py"), "--port", "0", "--vehicles", str(vehicles),
+                   "--latency", str(args.latency), "--jitter", str(args.jitter), "--error-rate", str(args.error_rate)]
+        if args.seed is not None:
+            command += ["--seed", str(args.seed)]
+        if not args.compression:
+            command.append("--no-compression")
+        self.vehicles = vehicles
+        self.process = subprocess.Popen(command, stdout=subprocess.PIPE, universal_newlines=True)
+        line = self.process.stdout.readline()
+        if not line.startswith("Listening on "):
+            self.process.kill()
+            raise RuntimeError("jlrstub did not start: %r" % line)
+        self.url = line.split()[-1]
+        self._queries = 0
+
+    def install(self, jlrpy):
+        jlrpy.set_base_urls(self.url)
+
+    def counters(self):
+        """Connections, requests and response bytes of the plugin so far"""
+        with urllib.request.urlopen(self.url + "/_stub/stats") as r:
+            stats = json.load(r)
+        # Every stats request is counted as a connection, they are not the plugin's
+        self._queries += 1
+        return stats['connections'] - self._queries, stats['requests'], stats['bytes_sent']
+
+    def stop(self, jlrpy):
+        jlrpy.set_base_urls()
+        self.process.terminate()
+        self.process.wait()
+
+
+class ReplaySource:
+    """Serves the plugin from a recorded cassette, no connections are made at all"""
+
+    def __init__(self, path, args):
+        import cassette
+        self.player = cassette.Player(path, speed=args.speed, loop=True)
+        self.vehicles = self.player.vehicles()
+
+    def install(self, jlrpy):
+        jlrpy.set_cassette(self.player)
+
+    def counters(self):
+        return 0, self.player.played, 0
+
+    def stop(self, jlrpy):
+        jlrpy.set_cassette(None)
+
+
+def run_fleet(plugin_module, indigo, source, args):
+    """Poll a fleet of vehicles for the requested rounds and return the per poll measurements"""
+    import jlrpy
+
+    try:
+        source.install(jlrpy)
+        if not args.rate_limit:
+            jlrpy.RATE_LIMITS = {}
+        jlrpy._limiters.clear()
+        jlrpy._breakers.clear()
+
+        email = "bench-%d@example.com" % source.vehicles
+        prefs = {'InControlEmail': email, 'InControlPassword': PASSWORD, 'useMapAPI': False,
+                 'pressureunit': "Psi", 'requeststimeout': "30", 'collectPerformanceStats': args.metrics,
+                 # Every poll should download the status, as it would at the normal poll interval
+                 'statusMaxAge': "0"}
+        plugin = plugin_module.Plugin(PLUGIN_ID, "JLR InControl", "bench", prefs)
+        indigo.devices.clear()
+        devices = []
+        for i in range(source.vehicles):
+            device = FakeDevice(1000 + i, "Vehicle %d" % (i + 1), i + 1)
+            indigo.devices[device.id] = device
+            devices.append(device)
+
+        rounds = []
+        for round_number in range(args.rounds):
+            polls = []
+            for device in devices:
+                polls.append(measure_poll(plugin, device, source, args.allocations))
+            rounds.append(polls)
+        plugin.shutdown()
+        return rounds, plugin.metrics.snapshot() if args.metrics else None
+    finally:
+        source.stop(jlrpy)
+
+
+def measure_poll(plugin, device, source, allocations):
+    connections, requests, received = source.counters()
+    writes = device.state_writes
+    if allocations:
+        tracemalloc.start()
+    cpu = time.process_time()
+    wall = time.perf_counter()
+    ok = plugin.update(device)
+    wall = time.perf_counter() - wall
+    cpu = time.process_time() - cpu
+    peak = 0
+    if allocations:
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    after_connections, after_requests, after_received = source.counters()
+    return {'ok': ok, 'wall': wall, 'cpu': cpu, 'requests': after_requests - requests,
+            'received': after_received - received, 'handshakes': after_connections - connections,
+            'writes': device.state_writes - writes, 'peak': peak}
+
+
+def summarise(polls):
+    walls = sorted(p['wall'] for p in polls)
+    return {
+        'polls': len(polls),
+        'failed': sum(1 for p in polls if not p['ok']),
+        'wall_ms': statistics.mean(walls) * 1000,
+        'wall_p95_ms': walls[min(len(walls) - 1, int(len(walls) * 0.95))] * 1000,
+        'requests': statistics.mean(p['requests'] for p in polls),
+        'received_kib': statistics.mean(p['received'] for p in polls) / 1024,
+        'handshakes': statistics.mean(p['handshakes'] for p in polls),
+        'writes': statistics.mean(p['writes'] for p in polls),
+        'cpu_ms': statistics.mean(p['cpu'] for p in polls) * 1000,
+        'peak_kib': statistics.mean(p['peak'] for p in polls) / 1024,
+    }
+
+
+def print_table(results):
+    header = "%-9s %-7s %6s %7s %10s %12s %9s %8s %11s %7s %8s %10s" % (
+        "vehicles", "rounds", "polls", "failed", "wall ms", "wall p95 ms", "requests", "KiB in", "handshakes",
+        "writes", "cpu ms", "peak KiB")
+    print(header)
+    print("-" * len(header))
+    for result in results:
+        for phase in ('first', 'steady'):
+            s = result[phase]
+            if s is None:
+                continue
+            print("%-9d %-7s %6d %7d %10.1f %12.1f %9.2f %8.1f %11.2f %7.2f %8.2f %10.1f" % (
+                result['vehicles'], phase, s['polls'], s['failed'], s['wall_ms'], s['wall_p95_ms'], s['requests'],
+                s['received_kib'], s['handshakes'], s['writes'], s['cpu_ms'], s['peak_kib']))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark Plugin.update against the jlrstub stand-in API")
+    parser.add_argument('--vehicles', default="1,5,50", help="comma separated fleet sizes")
+    parser.add_argument('--rounds', type=int, default=5, help="polls of every vehicle per fleet size")
+    parser.add_argument('--latency', type=float, default=0.0, help="seconds the stub adds to every response")
+    parser.add_argument('--jitter', type=float, default=0.0)
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    parser.add_argument('--seed', type=int)
+    parser.add_argument('--no-compression', dest='compression', action='store_false',
+                        help="have the stub send every response uncompressed")
+    parser.add_argument('--replay', metavar="CASSETTE",
+                        help="poll the vehicles of a recorded cassette instead of the stub")
+    parser.add_argument('--speed', type=float, default=0,
+                        help="replay speed against the recorded response times, 0 for no waiting")
+    parser.add_argument('--rate-limit', action='store_true', help="keep the plugin's JLR request budget")
+    parser.add_argument('--metrics', action='store_true',
+                        help="collect the plugin's performance statistics, included in the JSON output")
+    parser.add_argument('--no-allocations', dest='allocations', action='store_false',
+                        help="skip tracemalloc, which slows the polls down")
+    parser.add_argument('--json', action='store_true', help="print the results as JSON")
+    parser.add_argument('--verbose', action='store_true')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.WARNING)
+
+    folder = tempfile.mkdtemp(prefix="jlrbench")
+    indigo = install_fake_indigo(folder)
+    sys.path.insert(0, PLUGIN_FOLDER)
+    import plugin as plugin_module
+
+    results = []
+    if args.replay:
+        sources = [lambda: ReplaySource(args.replay, args)]
+    else:
+        sources = [lambda v=int(v): StubSource(v, args) for v in args.vehicles.split(',')]
+    for make_source in sources:
+        source = make_source()
+        rounds, stats = run_fleet(plugin_module, indigo, source, args)
+        results.append({'vehicles': source.vehicles,
+                        'metrics': stats,
+                        'first': summarise(rounds[0]),
+                        'steady': summarise([p for polls in rounds[1:] for p in polls]) if len(rounds) > 1 else None})
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        print_table(results)
+
+
+if __name__ == '__main__':
+    main()
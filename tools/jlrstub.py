@@ -0,0 +1,372 @@
+""" Local stand-in for the JLR InControl API used by the plugin's jlrpy
+
+Serves the ifas, ifop and if9 endpoints jlrpy calls (tokens, clients, users, vehicles, status, attributes,
+position, trips, services and the charging / climate / honk commands) from the fixtures folder, for any
+number of vehicles on one account. Latency, server errors and throttling can be added to see how the
+plugin copes. Point jlrpy at it with jlrpy.set_base_urls(server.url).
+
+    python3 tools/jlrstub.py --port 8080 --vehicles 5 --latency 0.2 --error-rate 0.05
+
+Responses are gzipped for clients that accept it, as the JLR servers do, unless --no-compression is given.
+GET /_stub/stats returns the number of connections accepted, requests served per endpoint and body bytes sent.
+"""
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+import argparse
+import copy
+import gzip
+import json
+import logging
+import os
+import random
+import re
+import ssl
+import threading
+import time
+import uuid
+
+logger = logging.getLogger('jlrstub')
+
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures")
+VIN_PREFIX = "SADHA2B1XK1"
+USER_ID = "stub-user"
+# Commands are reported as in progress for this many status checks before they succeed
+COMMAND_STEPS = 1
+DEFAULT_TRIPS = 20
+DEFAULT_ROUTE_POINTS = 300
+# Smaller bodies are sent uncompressed, the gzip framing would outweigh the saving
+GZIP_MIN_SIZE = 256
+
+
+def load_fixture(name):
+    with open(os.path.join(FIXTURES, name)) as f:
+        return json.load(f)
+
+
+def vin_for(index):
+    return "%s%06d" % (VIN_PREFIX, index + 1)
+
+
+class Throttle:
+    """Requests per second allowed for each JLR service before the stub answers with the throttle status"""
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self._lock = threading.Lock()
+        self._buckets = {}
+
+    def allow(self, service):
+        if not self.rate:
+            return True
+        now = time.monotonic()
+        with self._lock:
+            tokens, updated = self._buckets.get(service, (self.burst, now))
+            tokens = min(self.burst, tokens + (now - updated) * self.rate)
+            if tokens < 1:
+                self._buckets[service] = (tokens, now)
+                return False
+            self._buckets[service] = (tokens - 1, now)
+            return True
+
+
+class StubState:
+    """Fixtures, options and counters shared by the request handlers"""
+
+    def __init__(self, vehicles=1, latency=0.0, jitter=0.0, error_rate=0.0, throttle=0.0, throttle_burst=10,
+                 throttle_status=429, trips=DEFAULT_TRIPS, route_points=DEFAULT_ROUTE_POINTS, compression=True,
+                 seed=None):
+        self.vehicles = [vin_for(i) for i in range(vehicles)]
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.throttle = Throttle(throttle, throttle_burst)
+        self.throttle_status = throttle_status
+        self.trips = trips
+        self.route_points = route_points
+        self.compression = compression
+        self.random = random.Random(seed)
+        self.status = load_fixture("status.json")
+        self.attributes = load_fixture("attributes.json")
+        self.position = load_fixture("position.json")
+        self.trip = load_fixture("trip.json")
+        self.lock = threading.Lock()
+        self.services = {}
+        self.connections = 0
+        self.requests = {}
+        self.bytes_sent = 0
+
+    def count(self, endpoint):
+        with self.lock:
+            self.requests[endpoint] = self.requests.get(endpoint, 0) + 1
+
+    def sent(self, size):
+        with self.lock:
+            self.bytes_sent += size
+
+    def stats(self):
+        with self.lock:
+            return {'connections': self.connections, 'requests': sum(self.requests.values()),
+                    'bytes_sent': self.bytes_sent, 'endpoints': dict(self.requests)}
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    """Routes a request to the handler for its endpoint, see ROUTES"""
+
+    protocol_version = "HTTP/1.1"
+    server_version = "jlrstub/1.0"
+    # Headers and body go out in separate writes, without this delayed ACKs add ~40ms to every response
+    disable_nagle_algorithm = True
+
+    ROUTES = [
+        ('POST', r'^/ifas/jlr/tokens$', 'tokens'),
+        ('POST', r'^/ifop/jlr/users/(?P<email>[^/]+)/clients$', 'clients'),
+        ('GET', r'^/if9/jlr/users$', 'login'),
+        ('GET', r'^/if9/jlr/users/(?P<user>[^/]+)/vehicles$', 'vehicles'),
+        ('POST', r'^/if9/jlr/vehicles/(?P<vin>\w+)/users/(?P<user>[^/]+)/authenticate$', 'authenticate'),
+        ('GET', r'^/if9/jlr/vehicles/(?P<vin>\w+)/status$', 'status'),
+        ('GET', r'^/if9/jlr/vehicles/(?P<vin>\w+)/attributes$', 'attributes'),
+        ('GET', r'^/if9/jlr/vehicles/(?P<vin>\w+)/position$', 'position'),
+        ('GET', r'^/if9/jlr/vehicles/(?P<vin>\w+)/trips$', 'trips'),
+        ('GET', r'^/if9/jlr/vehicles/(?P<vin>\w+)/trips/(?P<trip>\d+)/route$', 'route'),
+        ('GET', r'^/if9/jlr/vehicles/(?P<vin>\w+)/services$', 'services'),
+        ('GET', r'^/if9/jlr/vehicles/(?P<vin>\w+)/services/(?P<service>[\w-]+)$', 'service_status'),
+        ('POST', r'^/if9/jlr/vehicles/(?P<vin>\w+)/(?P<command>chargeProfile|preconditioning|honkBlink|'
+                 r'engineOn|engineOff|lock|unlock|swu|healthstatus)$', 'command'),
+    ]
+    COMPILED = [(method, re.compile(pattern), name) for method, pattern, name in ROUTES]
+
+    def setup(self):
+        super().setup()
+        with self.server.state.lock:
+            self.server.state.connections += 1
+
+    def log_message(self, format, *args):
+        logger.debug("%s %s" % (self.address_string(), format % args))
+
+    def do_GET(self):
+        self.dispatch('GET')
+
+    def do_POST(self):
+        self.dispatch('POST')
+
+    def dispatch(self, method):
+        state = self.server.state
+        parts = urlsplit(self.path)
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length) if length else b''
+        if parts.path == '/_stub/stats':
+            return self.reply(200, state.stats(), count=False)
+        for route_method, pattern, name in self.COMPILED:
+            match = pattern.match(parts.path)
+            if match and route_method == method:
+                break
+        else:
+            state.count('unknown')
+            return self.reply(404, {'errorLabel': 'NotFound', 'errorDescription': parts.path})
+
+        state.count(name)
+        if state.latency or state.jitter:
+            time.sleep(max(0.0, state.latency + state.random.uniform(-state.jitter, state.jitter)))
+        if not state.throttle.allow(parts.path.split('/')[1]):
+            return self.reply(state.throttle_status, {'errorLabel': 'TooManyRequests'})
+        if state.error_rate and state.random.random() < state.error_rate:
+            return self.reply(500, {'errorLabel': 'InternalError'})
+        args = match.groupdict()
+        vin = args.get('vin')
+        if vin is not None and vin not in state.vehicles:
+            return self.reply(404, {'errorLabel': 'VehicleNotFound'})
+        try:
+            data = json.loads(body) if body else None
+        except ValueError:
+            return self.reply(400, {'errorLabel': 'BadRequest'})
+        status, result = getattr(self, 'handle_' + name)(state, args, parse_qs(parts.query), data)
+        self.reply(status, result)
+
+    def reply(self, status, result, count=True):
+        body = json.dumps(result).encode('utf8') if result is not None else b''
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        if (self.server.state.compression and len(body) >= GZIP_MIN_SIZE and
+                'gzip' in self.headers.get('Accept-Encoding', '')):
+            body = gzip.compress(body, 6)
+            self.send_header('Content-Encoding', 'gzip')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+        if count:
+            self.server.state.sent(len(body))
+
+    # Endpoints, each returns (HTTP status, JSON result or None)
+
+    @staticmethod
+    def handle_tokens(state, args, query, data):
+        return 200, {'access_token': uuid.uuid4().hex, 'authorization_token': uuid.uuid4().hex,
+                     'expires_in': "86400", 'refresh_token': uuid.uuid4().hex, 'token_type': "bearer"}
+
+    @staticmethod
+    def handle_clients(state, args, query, data):
+        return 204, None
+
+    @staticmethod
+    def handle_login(state, args, query, data):
+        return 200, {'userId': USER_ID, 'loginName': (query.get('loginName') or [''])[0], 'userType': "Customer"}
+
+    @staticmethod
+    def handle_vehicles(state, args, query, data):
+        return 200, {'vehicles': [{'userId': args['user'], 'vin': vin, 'role': "Primary"} for vin in state.vehicles]}
+
+    @staticmethod
+    def handle_authenticate(state, args, query, data):
+        return 200, {'token': uuid.uuid4().hex}
+
+    @staticmethod
+    def handle_status(state, args, query, data):
+        return 200, state.status
+
+    @staticmethod
+    def handle_attributes(state, args, query, data):
+        return 200, state.attributes
+
+    @staticmethod
+    def handle_position(state, args, query, data):
+        # Spread the vehicles out a little so each one has its own map
+        index = state.vehicles.index(args['vin'])
+        result = copy.deepcopy(state.position)
+        result['position']['latitude'] += index * 0.01
+        result['position']['longitude'] += index * 0.01
+        return 200, result
+
+    @staticmethod
+    def handle_trips(state, args, query, data):
+        count = min(int((query.get('count') or [1000])[0]), state.trips)
+        trips = []
+        for i in range(count):
+            trip = copy.deepcopy(state.trip)
+            trip['id'] = state.trips - i
+            trip['routeDetails']['totalWaypoints'] = state.route_points
+            trips.append(trip)
+        return 200, {'trips': trips}
+
+    @staticmethod
+    def handle_route(state, args, query, data):
+        page_size = int((query.get('pageSize') or [1000])[0])
+        page = int((query.get('page') or [1])[0])
+        start = (page - 1) * page_size
+        end = min(start + page_size, state.route_points)
+        trip = state.trip['tripDetails']
+        lat0, lon0 = trip['startPosition']['latitude'], trip['startPosition']['longitude']
+        lat1, lon1 = trip['endPosition']['latitude'], trip['endPosition']['longitude']
+        waypoints = []
+        for i in range(start, end):
+            f = i / max(1, state.route_points - 1)
+            waypoints.append({'position': {'latitude': lat0 + (lat1 - lat0) * f,
+                                           'longitude': lon0 + (lon1 - lon0) * f,
+                                           'speed': 48.0, 'heading': 270.0},
+                              'odometer': trip['startOdometer'] + int(trip['distance'] * f),
+                              'timestamp': "2026-10-16T17:%02d:%02d+0000" % (2 + i * 39 // state.route_points,
+                                                                             i % 60)})
+        return 200, {'waypoints': waypoints, 'totalWaypoints': state.route_points}
+
+    @staticmethod
+    def handle_services(state, args, query, data):
+        with state.lock:
+            active = [service for service in state.services.values() if service['vin'] == args['vin']]
+        return 200, {'services': [{'serviceType': s['serviceType'], 'customerServiceId': s['customerServiceId'],
+                                   'status': s['status']} for s in active]}
+
+    @staticmethod
+    def handle_service_status(state, args, query, data):
+        with state.lock:
+            service = state.services.get(args['service'])
+            if service is None:
+                return 404, {'errorLabel': 'ServiceNotFound'}
+            service['checks'] += 1
+            if service['checks'] > COMMAND_STEPS:
+                service['status'] = "Successful"
+            return 200, {'customerServiceId': service['customerServiceId'], 'status': service['status'],
+                         'serviceType': service['serviceType'], 'vehicleId': service['vin']}
+
+    @staticmethod
+    def handle_command(state, args, query, data):
+        service = {'customerServiceId': str(uuid.uuid4()), 'serviceType': (data or {}).get('serviceName') or
+                   args['command'], 'status': "Started", 'vin': args['vin'], 'checks': 0}
+        with state.lock:
+            state.services[service['customerServiceId']] = service
+        return 200, {'customerServiceId': service['customerServiceId'], 'status': service['status']}
+
+
+class StubServer(ThreadingHTTPServer):
+    """The stand-in API on a background thread, port 0 picks a free port"""
+
+    daemon_threads = True
+
+    def __init__(self, host="127.0.0.1", port=0, certfile=None, keyfile=None, **options):
+        super().__init__((host, port), StubHandler)
+        self.state = StubState(**options)
+        self.scheme = "http"
+        if certfile:
+            context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+            context.load_cert_chain(certfile, keyfile)
+            self.socket = context.wrap_socket(self.socket, server_side=True)
+            self.scheme = "https"
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self.server_address[:2]
+        return "%s://%s:%d" % (self.scheme, host, port)
+
+    def start(self):
+        self._thread = threading.Thread(target=self.serve_forever, name="JLRStub", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Local stand-in for the JLR InControl API")
+    parser.add_argument('--host', default="127.0.0.1")
+    parser.add_argument('--port', type=int, default=8080, help="0 picks a free port")
+    parser.add_argument('--vehicles', type=int, default=1, help="vehicles on the account")
+    parser.add_argument('--latency', type=float, default=0.0, help="seconds added to every response")
+    parser.add_argument('--jitter', type=float, default=0.0, help="random +/- seconds on the latency")
+    parser.add_argument('--error-rate', type=float, default=0.0, help="fraction of requests answered with a 500")
+    parser.add_argument('--throttle', type=float, default=0.0,
+                        help="requests per second allowed per service, 0 for no limit")
+    parser.add_argument('--throttle-burst', type=int, default=10)
+    parser.add_argument('--throttle-status', type=int, default=429,
+                        help="HTTP status for throttled requests, JLR itself tends to answer 403")
+    parser.add_argument('--trips', type=int, default=DEFAULT_TRIPS, help="trips per vehicle")
+    parser.add_argument('--route-points', type=int, default=DEFAULT_ROUTE_POINTS, help="waypoints per trip route")
+    parser.add_argument('--no-compression', dest='compression', action='store_false',
+                        help="never gzip responses")
+    parser.add_argument('--seed', type=int, help="seed for the error and latency randomness")
+    parser.add_argument('--certfile', help="serve https with this certificate")
+    parser.add_argument('--keyfile')
+    parser.add_argument('--verbose', action='store_true')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.INFO)
+
+    server = StubServer(args.host, args.port, args.certfile, args.keyfile, vehicles=args.vehicles,
+                        latency=args.latency, jitter=args.jitter, error_rate=args.error_rate,
+                        throttle=args.throttle, throttle_burst=args.throttle_burst,
+                        throttle_status=args.throttle_status, trips=args.trips, route_points=args.route_points,
+                        compression=args.compression, seed=args.seed)
+    # The benchmark reads the address from this line
+    print("Listening on %s" % server.url, flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,132 @@
+""" Trip route download benchmark for the JLR InControl plugin
+
+Starts the jlrstub stand-in API in its own process with one long synthetic trip route (50,000 waypoints
+by default) and downloads it with jlrpy in three ways:
+
+    all pages    every page fetched with Vehicle.get_trip and kept as decoded JSON, as a caller
+                 looping over the pages itself would
+    streamed     trips.TripStore.sync_route, pages decoded into packed arrays and written in batches
+    resync       sync_route again, every page is already stored so nothing is downloaded
+
+For each it reports wall time, pages requested, peak memory allocated (tracemalloc, measured on a
+separate pass as it slows the decoding down) and the memory or store space the waypoints take.
+
+    python3 tools/route_benchmark.py --points 50000
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+TOOLS = os.path.dirname(os.path.abspath(__file__))
+PLUGIN_FOLDER = os.path.join(os.path.dirname(TOOLS), "JLRInControl.indigoPlugin", "Contents", "Server Plugin")
+TRIP_ID = 1
+
+
+def start_stub(points):
+    command = [sys.executable, os.path.join(TOOLS, "jlrstub.py"), "--port", "0", "--trips", "1",
+               "--route-points", str(points)]
+    process = subprocess.Popen(command, stdout=subprocess.PIPE, universal_newlines=True)
+    line = process.stdout.readline()
+    if not line.startswith("Listening on "):
+        process.kill()
+        raise RuntimeError("jlrstub did not start: %r" % line)
+    return process, line.split()[-1]
+
+
+def all_pages(vehicle, store):
+    """Every page kept in memory as JSON, returns the pages"""
+    import trips
+    pages = []
+    page = 1
+    while True:
+        result = vehicle.get_trip(TRIP_ID, page)
+        pages.append(result['waypoints'])
+        if len(result['waypoints']) < trips.ROUTE_PAGE_SIZE:
+            return pages
+        page += 1
+
+
+def streamed(vehicle, store):
+    store.sync_route(vehicle.vin, TRIP_ID, vehicle.get_trip)
+    return store.route(vehicle.vin, TRIP_ID)
+
+
+def measure(name, func, vehicle, store, pool, allocations):
+    before = pool.requests
+    if allocations:
+        tracemalloc.start()
+    wall = time.perf_counter()
+    result = func(vehicle, store)
+    wall = time.perf_counter() - wall
+    peak = 0
+    if allocations:
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    return {'name': name, 'wall': wall, 'requests': pool.requests - before, 'peak': peak, 'result': result}
+
+
+def run(args):
+    import jlrpy
+    import trips
+
+    process, url = start_stub(args.points)
+    folder = tempfile.mkdtemp(prefix="jlrroute")
+    try:
+        jlrpy.set_base_urls(url)
+        # Measure the download, not the request budget
+        jlrpy.RATE_LIMITS = {}
+        connection = jlrpy.Connection("route@example.com", "benchmark")
+        vehicle = connection.vehicles[0]
+        results = []
+        for allocations in (False, True):
+            path = os.path.join(folder, "trips-%d.sqlite" % allocations)
+            store = trips.TripStore(path)
+            store.sync(vehicle.vin, vehicle.get_trips)
+            passes = [measure("all pages", all_pages, vehicle, store, connection.pool, allocations),
+                      measure("streamed", streamed, vehicle, store, connection.pool, allocations),
+                      measure("resync", streamed, vehicle, store, connection.pool, allocations)]
+            store.close()
+            if not allocations:
+                results = passes
+                for result in passes:
+                    result['stored'] = os.path.getsize(path) if result['name'] != "all pages" else 0
+            else:
+                for result, measured in zip(results, passes):
+                    result['peak'] = measured['peak']
+        for result in results:
+            value = result.pop('result')
+            result['points'] = len(value) if result['name'] != "all pages" else sum(len(page) for page in value)
+        return results
+    finally:
+        jlrpy.set_base_urls()
+        process.terminate()
+        process.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark trip route downloads against the jlrstub stand-in API")
+    parser.add_argument('--points', type=int, default=50000, help="waypoints in the synthetic route")
+    parser.add_argument('--json', action='store_true', help="print the results as JSON")
+    args = parser.parse_args()
+    sys.path.insert(0, PLUGIN_FOLDER)
+
+    results = run(args)
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+    header = "%-10s %9s %8s %7s %10s %11s" % ("download", "points", "wall s", "pages", "peak MiB", "store KiB")
+    print(header)
+    print("-" * len(header))
+    for r in results:
+        print("%-10s %9d %8.2f %7d %10.1f %11.0f" % (r['name'], r['points'], r['wall'], r['requests'],
+                                                     r['peak'] / 1048576.0, r['stored'] / 1024.0))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,130 @@
+""" Status transform microbenchmark for the JLR InControl plugin
+
+Times the table driven transforms.StateTransform against the if/elif chains it replaced in plugin.py,
+over the status payload in tools/fixtures/status.json (about 160 keys, EV and core status). Each path
+is run --rounds times, best of --repeat, and the time per transform is reported.
+
+    python3 tools/transform_benchmark.py --rounds 2000
+"""
+
+import argparse
+import json
+import os
+import sys
+import timeit
+
+TOOLS = os.path.dirname(os.path.abspath(__file__))
+PLUGIN_FOLDER = os.path.join(os.path.dirname(TOOLS), "JLRInControl.indigoPlugin", "Contents", "Server Plugin")
+STATUS_FIXTURE = os.path.join(TOOLS, "fixtures", "status.json")
+
+kpaInPSI = 0.145038
+kpaInBar = 0.01
+
+
+def legacy_transform(evstatus, status, prefs):
+    """The if/elif chains update() used before the table driven transform, kept as they were"""
+    device_states = []
+    for d in evstatus:
+        if d['key'] == 'EV_STATE_OF_CHARGE':
+            device_states.append({'key': d['key'], 'value': d['value'], 'uiValue': (d['value'] + '%')})
+        elif d['key'] == "EV_CHARGING_RATE_SOC_PER_HOUR":
+            device_states.append({'key': d['key'], 'value': d['value'], 'uiValue': (d['value'] + '%')})
+        elif d['key'] == "EV_MINUTES_TO_FULLY_CHARGED":
+            hours = '{:02d}:{:02d}m'.format(*divmod(int(d['value']), 60))
+            device_states.append({'key': d['key'], 'value': d['value'], 'uiValue': hours})
+        elif d['key'] == "EV_CHARGING_STATUS":
+            if d['value'] == "No Message":
+                uicharge = "Not Connected"
+            else:
+                uicharge = d['value']
+                device_states.append({'key': d['key'], 'value': d['value'], 'uiValue': uicharge})
+        elif d['key'] == "EV_RANGE_VSC_REVISED_HV_BATT_ENERGYx100":
+            device_states.append({'key': d['key'], 'value': d['value'], 'uiValue': (d['value'] + ' kWh')})
+        else:
+            device_states.append({'key': d['key'], 'value': d['value']})
+
+    for d in status:
+        if d['key'] == 'EV_STATE_OF_CHARGE':
+            device_states.append({'key': d['key'], 'value': d['value'], 'uiValue': (d['value'] + '%')})
+        elif d['key'] == "EV_CHARGING_RATE_SOC_PER_HOUR":
+            device_states.append({'key': d['key'], 'value': d['value'], 'uiValue': (d['value'] + '%')})
+        elif d['key'] == "EV_MINUTES_TO_FULLY_CHARGED":
+            hours = '{:02d}:{:02d}m'.format(*divmod(int(d['value']), 60))
+            device_states.append({'key': d['key'], 'value': d['value'], 'uiValue': hours})
+        elif d['key'] == "EV_CHARGING_STATUS":
+            if d['value'] == "No Message":
+                uicharge = "Not Connected"
+            else:
+                uicharge = d['value']
+                device_states.append({'key': d['key'], 'value': d['value'], 'uiValue': uicharge})
+        elif d['key'] == "THEFT_ALARM_STATUS":
+            if d['value'] == "ALARM_ARMED":
+                uialarm = "Armed"
+            elif d['value'] == "ALARM_OFF":
+                uialarm = "Not Armed"
+            else:
+                uialarm = d['value']
+            device_states.append({'key': d['key'], 'value': d['value'], 'uiValue': uialarm})
+        elif d['key'] == "EV_RANGE_VSC_REVISED_HV_BATT_ENERGYx100":
+            device_states.append({'key': d['key'], 'value': d['value'], 'uiValue': (d['value'] + ' kWh')})
+        elif "TYRE_PRESSURE" in d['key']:
+            if prefs['pressureunit'] == "Bar":
+                convertedpressure = round(float(d['value']) * kpaInBar, 1)
+                uipressure = str(convertedpressure) + " Bar"
+            else:
+                convertedpressure = round(float(d['value']) * kpaInPSI, 1)
+                uipressure = str(convertedpressure) + " Psi"
+            device_states.append({'key': d['key'], 'value': d['value'], 'uiValue': uipressure})
+        elif d['key'] == "DOOR_IS_ALL_DOORS_LOCKED":
+            if d['value']:
+                uilock = "Locked"
+            else:
+                uilock = "Unlocked"
+            device_states.append({'key': d['key'], 'value': d['value'], 'uiValue': uilock})
+        else:
+            device_states.append({'key': d['key'], 'value': d['value']})
+    return device_states
+
+
+def run(args):
+    import transforms
+
+    with open(STATUS_FIXTURE) as f:
+        status = json.load(f)['vehicleStatus']
+    evstatus, core = status['evStatus'], status['coreStatus']
+    prefs = {'pressureunit': args.unit}
+    transform = transforms.StateTransform(prefs, transforms.declared_states())
+    paths = [
+        ("if/elif", lambda: legacy_transform(evstatus, core, prefs)),
+        ("table", lambda: transform.transform(evstatus + core)),
+    ]
+    results = []
+    for name, func in paths:
+        best = min(timeit.repeat(func, number=args.rounds, repeat=args.repeat)) / args.rounds
+        results.append({'name': name, 'keys': len(evstatus) + len(core), 'states': len(func()),
+                        'us': best * 1e6})
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Time the status transform against the old if/elif chains")
+    parser.add_argument('--rounds', type=int, default=2000, help="transforms per timing")
+    parser.add_argument('--repeat', type=int, default=5, help="timings to take the best of")
+    parser.add_argument('--unit', default="Psi", choices=("Psi", "Bar"), help="tyre pressure display unit")
+    parser.add_argument('--json', action='store_true', help="print the results as JSON")
+    args = parser.parse_args()
+    sys.path.insert(0, PLUGIN_FOLDER)
+
+    results = run(args)
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+    header = "%-9s %6s %7s %14s" % ("path", "keys", "states", "us/transform")
+    print(header)
+    print("-" * len(header))
+    for r in results:
+        print("%-9s %6d %7d %14.1f" % (r['name'], r['keys'], r['states'], r['us']))
+
+
+if __name__ == '__main__':
+    main()